@@ -1,20 +1,118 @@
-from flask import Flask, request, jsonify
-from datetime import datetime, timezone
-import paho.mqtt.publish as publish
+from flask import Flask, Response, request, jsonify
+from datetime import datetime, timedelta, timezone
+import paho.mqtt.client as mqtt
 import threading
+import argparse
+import asyncio
+import concurrent.futures
+import http.client
+import multiprocessing
+import multiprocessing.connection
+import queue
+import subprocess
+import collections
+import collections.abc
+import contextlib
+import itertools
+import operator
 import random
+import heapq
 import base64
+import bisect
+import array
 import time
 import json
+import math
+import os
+import io
+import pickle
+import sys
+import urllib.parse
+import gc
+import gzip
+import tracemalloc
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # only needed for --numpy
+    np = None
+
+try:
+    import yaml
+except ImportError:  # only needed for YAML building specs
+    yaml = None
+
+try:
+    import orjson
+except ImportError:  # only needed for --uplink-encoder orjson
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for --export *.parquet
+    pa = pq = None
+
+try:
+    import uvicorn
+except ImportError:  # only needed for --runtime asyncio
+    uvicorn = None
+
+try:
+    import waitress
+except ImportError:  # only needed for --server waitress
+    waitress = None
+
+try:
+    import gunicorn.app.base as gunicorn_app
+except ImportError:  # only needed for --server gunicorn (not available on Windows)
+    gunicorn_app = None
 
 # HTTP Server Configuration
 HTTP_SERVER_PORT = 9010
 DATA_SENDING_INTERVAL = 60  # seconds
+SCHEDULER_THREADS = 4  # worker threads shared by all device ticks
+
+# Per-device-type uplink interval in seconds (falls back to DATA_SENDING_INTERVAL)
+DEVICE_INTERVALS = {
+    "aqi": DATA_SENDING_INTERVAL,
+    "wallswitch": DATA_SENDING_INTERVAL,
+    "wallsocket": DATA_SENDING_INTERVAL,
+    "curtain": DATA_SENDING_INTERVAL,
+    "peoplecounter": DATA_SENDING_INTERVAL,
+    "doorlock": DATA_SENDING_INTERVAL,
+    "scb": DATA_SENDING_INTERVAL,
+    "watermeter": DATA_SENDING_INTERVAL,
+    "gasmeter": DATA_SENDING_INTERVAL,
+    "thermostat": DATA_SENDING_INTERVAL,
+}
 
 LORAWAN_FPORT = 85
 
 MQTT_SERVER = "localhost"
 MQTT_PORT = 1883
+MQTT_KEEPALIVE = 60  # seconds
+MQTT_POOL_SIZE = 1  # persistent broker connections shared by all publishers
+MQTT_QUEUE_SIZE = 10000  # max outbound batches waiting for a connection
+MQTT_MAX_INFLIGHT = 100  # QoS 1/2 messages per connection published but not yet acknowledged
+MQTT_TRANSPORT = "mqtt"  # "mqtt": publish to MQTT_SERVER; "memory": count messages in-process (--transport)
+
+# Per-device-type uplink QoS (0, 1 or 2) and retain flag
+DEVICE_QOS = {
+    "aqi": 0,
+    "wallswitch": 0,
+    "wallsocket": 0,
+    "curtain": 0,
+    "peoplecounter": 0,
+    "doorlock": 0,
+    "scb": 0,
+    "watermeter": 0,
+    "gasmeter": 0,
+    "thermostat": 0,
+}
+DEVICE_RETAIN = dict.fromkeys(DEVICE_QOS, False)
+DOWNLINK_QOS = 0
 
 # Define apartments & device ids (extend this dict to simulate more)
 APARTMENTS = {
@@ -46,47 +144,292 @@ APARTMENTS = {
     }
 }
 
-latest_data_lock = threading.Lock()
+# ---------------------------------------------------------------------------
+# Metrics (GET /metrics)
+# Counters, histograms and scrape-time gauges for the hot paths, rendered in
+# the Prometheus text exposition format. Series are created on first use.
+# Durations are real seconds, except sim_tick_lag_seconds, which is in
+# simulated seconds so it compares directly with DEVICE_INTERVALS.
+# ---------------------------------------------------------------------------
+METRICS_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.01, 0.1, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 900.0, 3600.0)
+
+def _metric_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> count
+
+    def inc(self, *values, amount=1):
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, count in values:
+            yield f"{self.name}{_metric_labels(self.labels, labels)} {count}"
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=METRICS_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> [count per bucket (last one +Inf), sum]
+
+    def observe(self, value, *values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self.series.items())
+        bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_metric_labels(self.labels + ('le',), labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_metric_labels(self.labels, labels)} {total!r}"
+            yield f"{self.name}_count{_metric_labels(self.labels, labels)} {cumulative}"
+
+class Gauge:
+    """A value read when /metrics is scraped."""
+
+    def __init__(self, name, help_text, read):
+        self.name, self.help, self.read = name, help_text, read
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.read()}"
+
+uplinks_total = Counter("sim_uplinks_total", "Uplink payloads built, per device type (before coalescing).", ("device",))
+publish_seconds = Histogram("sim_mqtt_publish_seconds", "From a sender taking a message until the MQTT client "
+                            "accepted it, including waits for the connection and in-flight window.", ("qos",))
+publish_errors = Counter("sim_mqtt_publish_errors_total", "Publishes the MQTT client rejected; retried once reconnected.")
+messages_dropped = Counter("sim_mqtt_dropped_total", "Messages dropped because the outbound queue was full.")
+lock_wait_seconds = Histogram("sim_state_lock_wait_seconds", "Time spent waiting to acquire a state lock stripe.")
+lock_hold_seconds = Histogram("sim_state_lock_hold_seconds", "Time a state lock stripe was held.")
+tick_seconds = Histogram("sim_tick_seconds", "Duration of one scheduled device tick.", ("device",))
+tick_lag_seconds = Histogram("sim_tick_lag_seconds", "Simulated seconds a scheduled tick started after its deadline.",
+                             ("device",), LAG_BUCKETS)
+tick_overruns = Counter("sim_tick_overruns_total", "Ticks due a whole interval or more ago when they came up: the "
+                        "pass over the apartments did not finish within the device's interval.", ("device",))
+ticks_skipped = Counter("sim_ticks_skipped_total", "Tick slots dropped by the skip overrun policy.", ("device",))
+http_seconds = Histogram("sim_http_request_seconds", "HTTP request latency per route.", ("method", "route"))
+
+METRICS = [
+    uplinks_total, publish_seconds, publish_errors, messages_dropped, lock_wait_seconds, lock_hold_seconds,
+    tick_seconds, tick_lag_seconds, tick_overruns, ticks_skipped, http_seconds,
+    Gauge("sim_threads", "Live threads in this process.", threading.active_count),
+    Gauge("sim_scheduled_ticks", "Ticks and timed callbacks waiting in the scheduler (the heap on the threads "
+          "runtime, the event loop on the asyncio runtime).", lambda: scheduled_ticks()),
+    Gauge("sim_mqtt_queue_batches", "Batches waiting in the MQTT outbound queue.", lambda: mqtt_queue.qsize()),
+    Gauge("sim_apartments", "Simulated apartments.", lambda: len(APARTMENTS)),
+]
+
+def render_metrics():
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+class TimedLock:
+    """Re-entrant lock recording wait and hold time of each outermost acquisition."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._depth = 0  # only touched by the owning thread
+        self._held_at = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            self._held_at = time.perf_counter()
+            lock_wait_seconds.observe(self._held_at - start)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth:
+            self._lock.release()
+            return
+        held = time.perf_counter() - self._held_at
+        self._lock.release()
+        lock_hold_seconds.observe(held)
+
+# Locking: latest_data is guarded per apartment. Apartments are hashed onto
+# STATE_LOCK_STRIPES re-entrant locks, so readers and writers of different
+# apartments never wait for each other and the number of locks stays fixed no
+# matter how many apartments are simulated. Whole-state operations take every
+# stripe, always in index order, via all_state_locks(). Each stripe is a
+# TimedLock, so /metrics shows how long state locks are waited for and held.
+STATE_LOCK_STRIPES = 64
+
+state_locks = [TimedLock() for _ in range(STATE_LOCK_STRIPES)]
+
+def configure_state_locks(stripes):
+    global state_locks
+    state_locks = [TimedLock() for _ in range(stripes)]
+
+def state_lock(apt):
+    """The lock guarding latest_data[apt]."""
+    return state_locks[hash(apt) % len(state_locks)]
 
-latest_data = {}
-for apt, cfg in APARTMENTS.items():
+@contextlib.contextmanager
+def state_locks_for(apartments):
+    """Hold the stripes of several apartments at once (each taken once, in index order)."""
+    locks = state_locks
+    with contextlib.ExitStack() as stack:
+        for i in sorted({hash(apt) % len(locks) for apt in apartments}):
+            stack.enter_context(locks[i])
+        yield
+
+@contextlib.contextmanager
+def all_state_locks():
+    with contextlib.ExitStack() as stack:
+        for lock in state_locks:
+            stack.enter_context(lock)
+        yield
+
+# ---------------------------------------------------------------------------
+# Simulation clock and random streams
+# Simulated time goes through sim_clock: payload timestamps, doorlock relock
+# windows and the tick scheduler, whose delays and DEVICE_INTERVALS are
+# simulated seconds. With --speed N the clock runs N times faster than the
+# wall clock, so --speed 1000 produces a day of meter history in under 90
+# seconds. While a scheduled tick runs, "now" is that tick's own deadline,
+# so its timestamps do not depend on how late a worker got to it.
+# With --seed every (apartment, device) pair draws from its own
+# random.Random stream seeded from the seed and the pair, so readings repeat
+# from run to run however the scheduler threads interleave. Without a seed
+# everything draws from the shared `random` module.
+# ---------------------------------------------------------------------------
+SIM_SEED = None  # --seed; None draws from the shared `random` module
+SIM_SPEED = 1.0  # --speed; simulated seconds per wall-clock second
+SIM_START = None  # --sim-start; simulated time at startup (default: now)
+SIM_ORIGIN = None  # wall-clock epoch of SIM_START; worker processes get the parent's to share its timeline
+
+class SimClock:
+    """Simulated time: starts at `start` (UTC) when the wall clock reads `origin`, runs `speed` times faster."""
+
+    def __init__(self, speed=1.0, start=None, origin=None):
+        self.speed = speed
+        self.start = start or datetime.now(timezone.utc)
+        # wall-clock epoch rather than monotonic time, so shard processes share one timeline
+        self.origin = time.time() if origin is None else origin
+        self._tick = threading.local()
+
+    def time(self):
+        """Simulated seconds since `start`."""
+        tick = getattr(self._tick, "at", None)
+        return tick if tick is not None else self.elapsed()
+
+    def elapsed(self):
+        """Simulated seconds since `start` by the wall clock, even inside ticking()."""
+        return (time.time() - self.origin) * self.speed
+
+    def now(self):
+        return self.start + timedelta(seconds=self.time())
+
+    def isoformat(self):
+        return self.now().isoformat()
+
+    def real_seconds(self, sim_seconds):
+        """Wall-clock seconds that `sim_seconds` of simulated time take."""
+        return sim_seconds / self.speed
+
+    @contextlib.contextmanager
+    def ticking(self, at):
+        """Pin "now" to simulated time `at` for the current thread."""
+        self._tick.at = at
+        try:
+            yield
+        finally:
+            self._tick.at = None
+
+sim_clock = SimClock()
+_sim_streams = {}
+_sim_streams_lock = threading.Lock()
+
+def configure_simulation():
+    """Restart sim_clock and the random streams from the SIM_* settings (call before load_apartments())."""
+    global sim_clock
+    sim_clock = SimClock(SIM_SPEED, SIM_START, SIM_ORIGIN)
+    _sim_streams.clear()
+    _vector_streams.clear()
+
+def simulation_settings():
+    """SIM_* settings that make a worker process's configure_simulation() continue this clock."""
+    return {"SIM_SEED": SIM_SEED, "SIM_SPEED": SIM_SPEED, "SIM_START": sim_clock.start, "SIM_ORIGIN": sim_clock.origin}
+
+def sim_random(apt, device):
+    """Random source for `device` in `apt`: its own seeded stream with --seed, else `random` itself."""
+    if SIM_SEED is None:
+        return random
+    stream = _sim_streams.get((apt, device))
+    if stream is None:
+        with _sim_streams_lock:
+            stream = _sim_streams.setdefault((apt, device), random.Random(f"{SIM_SEED}:{apt}:{device}"))
+    return stream
+
+def new_apartment_state(apt, cfg, now=None):
+    """Initial latest_data entry for one apartment (randomized readings)."""
+    if now is None:
+        now = sim_clock.start.isoformat()
+    rng = sim_random(apt, "init")
     wallswitch_by_room = {}
     for room in cfg["rooms"]:
         wallswitch_by_room[room] = {
-            "current": random.randint(200, 300),
-            "voltage": round(random.uniform(230, 250), 1),
-            "active_power": random.randint(0, 100),
-            "power_consumption": random.randint(90000, 100000),
-            "power_factor": random.randint(50, 100),
+            "current": rng.randint(200, 300),
+            "voltage": round(rng.uniform(230, 250), 1),
+            "active_power": rng.randint(0, 100),
+            "power_consumption": rng.randint(90000, 100000),
+            "power_factor": rng.randint(50, 100),
             "switch_1": 1,
             "switch_2": 0,
         }
-    latest_data[apt] = {
+    state = {
         "aqi": {
-            "temp": round(random.uniform(20, 25), 1),
-            "humd": random.randint(40, 60),
-            "co2": random.randint(350, 800),
-            "battery": random.randint(50, 100)
+            "temp": round(rng.uniform(20, 25), 1),
+            "humd": rng.randint(40, 60),
+            "co2": rng.randint(350, 800),
+            "battery": rng.randint(50, 100)
         },
         "wallsocket": {
-            "voltage": round(random.uniform(230, 250), 1),
-            "current": random.randint(200, 300),
-            "active_power": random.randint(0, 100),
-            "power_consumption": random.randint(90000, 100000),
-            "power_factor": random.randint(50, 100),
+            "voltage": round(rng.uniform(230, 250), 1),
+            "current": rng.randint(200, 300),
+            "active_power": rng.randint(0, 100),
+            "power_consumption": rng.randint(90000, 100000),
+            "power_factor": rng.randint(50, 100),
             "socket_status": 1
         },
         "curtain": {
-            "battery": random.randint(50, 100),
-            "curtainstate": random.randint(0, 100)
+            "battery": rng.randint(50, 100),
+            "curtainstate": rng.randint(0, 100)
         },
         "peoplecounter": {
-            "total_in": random.randint(0, 50),
-            "total_out": random.randint(0, 50),
-            "period_in": random.randint(0, 30),
-            "period_out": random.randint(0, 30),
-            "battery": random.randint(50, 100),
-            "temperature": round(random.uniform(20.0, 30.0), 1)
+            "total_in": rng.randint(0, 50),
+            "total_out": rng.randint(0, 50),
+            "period_in": rng.randint(0, 30),
+            "period_out": rng.randint(0, 30),
+            "battery": rng.randint(50, 100),
+            "temperature": round(rng.uniform(20.0, 30.0), 1)
         },
         "scb": {
             "device_type": "SCB-100",
@@ -95,26 +438,26 @@ for apt, cfg in APARTMENTS.items():
             # switch_state: 1 = CLOSED, 0 = OPEN (integers)
             "switch_state": 1,
             "remote_control_enabled": True,
-            "voltage_A": round(random.uniform(220.0, 240.0), 1),
-            "voltage_B": round(random.uniform(220.0, 240.0), 1),
-            "voltage_C": round(random.uniform(220.0, 240.0), 1),
-            "current_A": round(random.uniform(0.0, 20.0), 2),
-            "current_B": round(random.uniform(0.0, 20.0), 2),
-            "current_C": round(random.uniform(0.0, 20.0), 2),
-            "current_N": round(random.uniform(0.0, 5.0), 2),
-            "power_A": round(random.uniform(0.0, 2000.0), 1),
-            "power_B": round(random.uniform(0.0, 2000.0), 1),
-            "power_C": round(random.uniform(0.0, 2000.0), 1),
-            "power_total": round(random.uniform(0.0, 6000.0), 1),
-            "power_factor_A": round(random.uniform(0.8, 1.0), 2),
-            "power_factor_B": round(random.uniform(0.8, 1.0), 2),
-            "power_factor_C": round(random.uniform(0.8, 1.0), 2),
+            "voltage_A": round(rng.uniform(220.0, 240.0), 1),
+            "voltage_B": round(rng.uniform(220.0, 240.0), 1),
+            "voltage_C": round(rng.uniform(220.0, 240.0), 1),
+            "current_A": round(rng.uniform(0.0, 20.0), 2),
+            "current_B": round(rng.uniform(0.0, 20.0), 2),
+            "current_C": round(rng.uniform(0.0, 20.0), 2),
+            "current_N": round(rng.uniform(0.0, 5.0), 2),
+            "power_A": round(rng.uniform(0.0, 2000.0), 1),
+            "power_B": round(rng.uniform(0.0, 2000.0), 1),
+            "power_C": round(rng.uniform(0.0, 2000.0), 1),
+            "power_total": round(rng.uniform(0.0, 6000.0), 1),
+            "power_factor_A": round(rng.uniform(0.8, 1.0), 2),
+            "power_factor_B": round(rng.uniform(0.8, 1.0), 2),
+            "power_factor_C": round(rng.uniform(0.8, 1.0), 2),
             "leakage_current": 0,
-            "temperature_device": random.randint(20, 40),
-            "temperature_terminal_A": random.randint(20, 40),
-            "temperature_terminal_B": random.randint(20, 40),
-            "temperature_terminal_C": random.randint(20, 40),
-            "temperature_terminal_N": random.randint(20, 40),
+            "temperature_device": rng.randint(20, 40),
+            "temperature_terminal_A": rng.randint(20, 40),
+            "temperature_terminal_B": rng.randint(20, 40),
+            "temperature_terminal_C": rng.randint(20, 40),
+            "temperature_terminal_N": rng.randint(20, 40),
             "alarm_short_circuit": False,
             "alarm_over_current": False,
             "alarm_over_voltage": False,
@@ -129,10 +472,10 @@ for apt, cfg in APARTMENTS.items():
         "watermeter": {
             "device_type": "WATER_METER",
             "id": f"{apt}_water",
-            "volume": round(random.uniform(0.0, 200.0), 2),
+            "volume": round(rng.uniform(0.0, 200.0), 2),
             # valve_state: 1 = CLOSED (connection made), 0 = OPEN (cut off) (integers)
             "valve_state": 0,
-            "battery": random.randint(20, 100),
+            "battery": rng.randint(20, 100),
             "low_power": False,
             "alarm": False,
             "communication_error": False
@@ -140,17 +483,17 @@ for apt, cfg in APARTMENTS.items():
         "gasmeter": {
             "device_type": "GAS_METER",
             "id": f"{apt}_gas",
-            "volume": round(random.uniform(0.0, 500.0), 2),
+            "volume": round(rng.uniform(0.0, 500.0), 2),
             # valve_state: 1 = CLOSED (connection made), 0 = OPEN (cut off) (integers)
             "valve_state": 0,
-            "battery": random.randint(20, 100),
+            "battery": rng.randint(20, 100),
             "low_power": False,
             "alarm": False
         },
         "doorlock": {
             "id": f"{apt}_door",
-            "battery": random.randint(30, 100),
-            "t": datetime.now(timezone.utc).isoformat(),
+            "battery": rng.randint(30, 100),
+            "t": now,
             "remote_lock": 0,
             "unlock_record": 0,
             "alarm": 0,
@@ -167,1047 +510,2273 @@ for apt, cfg in APARTMENTS.items():
             "last_manage_user_id": 0
         },
         "thermostat": {
-            "temperature": round(random.uniform(20.0, 24.0), 1),
-            "humidity": random.randint(30, 50),
-            "setpoint_temperature": round(random.uniform(22.0, 26.0), 1),
+            "temperature": round(rng.uniform(20.0, 24.0), 1),
+            "humidity": rng.randint(30, 50),
+            "setpoint_temperature": round(rng.uniform(22.0, 26.0), 1),
             "mode": "cool",
             "status": "home",
             "fan_setting": "auto",
             # valve_status: 1 = connection made/open, 0 = closed (integer)
             "valve_status": 0,
             "fan_status": "auto",
-            "co2": random.randint(350, 800),
+            "co2": rng.randint(350, 800),
             "power": "on",
             # track last setpoint updates
-            "last_setpoint_timestamp": datetime.now(timezone.utc).isoformat()
+            "last_setpoint_timestamp": now
         },
         "wallswitch": wallswitch_by_room
     }
     # compute initial people count (total_in - total_out) and clamp to >= 0
-    latest_data[apt]["peoplecounter"]["count"] = max(0, latest_data[apt]["peoplecounter"]["total_in"] - latest_data[apt]["peoplecounter"]["total_out"])
-
-def publish_aqi(apt_name):
-    device_id = APARTMENTS[apt_name]["aqi_device_id"]
-    with latest_data_lock:
-        aqi = latest_data[apt_name]["aqi"].copy()
-    payload = {
-        "id": device_id,
-        "gid": device_id,
-        "temperature": aqi["temp"],
-        "humidity": aqi["humd"],
-        "co2": aqi["co2"],
-        "battery": aqi["battery"],
-        "sensor_name": "AQI"
-    }
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+    state["peoplecounter"]["count"] = max(0, state["peoplecounter"]["total_in"] - state["peoplecounter"]["total_out"])
+    return state
 
-def publish_wallswitch(apt_name, room):
-    base_device = APARTMENTS[apt_name]["switch_device_id"]
-    device_id = f"{base_device}_{room}"
-    with latest_data_lock:
-        ws = latest_data[apt_name]["wallswitch"][room].copy()
-    payload = {
-        "id": device_id,
-        "gid": device_id,
-        "current": ws["current"],
-        "voltage": ws["voltage"],
-        "active_power": ws["active_power"],
-        "power_consumption": ws["power_consumption"],
-        "power_factor": ws["power_factor"],
-        "switch_1": ws["switch_1"],
-        "switch_2": ws["switch_2"],
-        "sensor_name": "Switch"
-    }
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+latest_data = {apt: new_apartment_state(apt, cfg) for apt, cfg in APARTMENTS.items()}
 
-def publish_wallsocket(apt_name):
-    device_id = APARTMENTS[apt_name]["socket_device_id"]
-    with latest_data_lock:
-        wallsocket = latest_data[apt_name]["wallsocket"].copy()
-    payload = {
-        "id": device_id,
-        "gid": device_id,
-        "current": wallsocket["current"],
-        "voltage": wallsocket["voltage"],
-        "active_power": wallsocket["active_power"],
-        "power_consumption": wallsocket["power_consumption"],
-        "power_factor": wallsocket["power_factor"],
-        "socket_status": wallsocket["socket_status"],
-        "sensor_name": "Socket"
-    }
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+# ---------------------------------------------------------------------------
+# Building generator
+# Expands a building spec into APARTMENTS, using the apartments defined above
+# (or inline "rooms") as templates. Spec, as JSON/YAML file or CLI flags:
+#   {"floors": "1-30",
+#    "units": [{"template": "1_bedroom", "count": 200},
+#              {"template": "studio_apartment", "count": 50},
+#              {"template": "penthouse", "count": 2, "rooms": ["living_room", "terrace"]}]}
+# Units are spread round-robin over the floors and named
+# <template>_f<floor>_<nn>; every device id is derived from that name.
+# ---------------------------------------------------------------------------
+DEVICE_ID_PREFIXES = {
+    "aqi_device_id": "aqi",
+    "switch_device_id": "switch",
+    "socket_device_id": "socket",
+    "curtain_device_id": "curtain",
+    "peoplecounter_device_id": "vs350",
+    "doorlock_device_id": "doorlock",
+    "thermostat_device_id": "thermo",
+    "watermeter_device_id": "water",
+    "gasmeter_device_id": "gas",
+    "scb_device_id": "scb",
+}
 
-def publish_curtain(apt_name):
-    device_id = APARTMENTS[apt_name]["curtain_device_id"]
-    with latest_data_lock:
-        curtain = latest_data[apt_name]["curtain"].copy()
-    payload = {
-        "id": device_id,
-        "gid": device_id,
-        "battery": curtain["battery"],
-        "curtainstate": curtain["curtainstate"],
-        "sensor_name": "CurtainController"
-    }
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+def parse_floors(floors):
+    """"1-30" / "1,3,5-7" / 12 (count) / [1, 2] -> sorted list of floor numbers."""
+    if isinstance(floors, int):
+        return list(range(1, floors + 1))
+    if isinstance(floors, list):
+        return sorted(set(int(f) for f in floors))
+    result = set()
+    for part in str(floors).split(","):
+        part = part.strip()
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            result.update(range(int(lo), int(hi) + 1))
+        elif part:
+            result.add(int(part))
+    return sorted(result)
 
-def publish_peoplecounter(apt_name):
-    device_id = APARTMENTS[apt_name].get("peoplecounter_device_id")
-    if not device_id:
-        return
-    with latest_data_lock:
-        pc = latest_data[apt_name]["peoplecounter"].copy()
-    payload = {
-        "total_in": pc["total_in"],
-        "total_out": pc["total_out"],
-        "period_in": pc["period_in"],
-        "period_out": pc["period_out"],
-        "battery": pc["battery"],
-        "temperature": pc["temperature"]
-    }
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+def parse_units(units):
+    """"200x1_bedroom,50xstudio_apartment" -> [{"template": ..., "count": ...}, ...]"""
+    parsed = []
+    for part in units.split(","):
+        count, sep, template = part.strip().partition("x")
+        if not sep or not count.isdigit():
+            raise ValueError(f"invalid unit spec {part!r}, expected <count>x<template>")
+        parsed.append({"template": template, "count": int(count)})
+    return parsed
 
-def publish_doorlock(apt_name):
-    device_id = APARTMENTS[apt_name].get("doorlock_device_id")
-    if not device_id:
-        return
-    with latest_data_lock:
-        dl = latest_data[apt_name]["doorlock"].copy()
-    payload = {
-        "id": dl.get("id"),
-        "t": dl.get("t"),
-        "battery": dl.get("battery"),
-        "remote_lock": dl.get("remote_lock"),
-        "unlock_record": dl.get("unlock_record"),
-        "alarm": dl.get("alarm"),
-        "auto_relock": dl.get("auto_relock"),
-        "normally_open_mode": dl.get("normally_open_mode"),
-        "tamper": dl.get("tamper"),
-        "reporting_time": dl.get("reporting_time"),
-        "last_access_method": dl.get("last_access_method"),
-        "last_access_user_id": dl.get("last_access_user_id"),
-        "last_access_timestamp": dl.get("last_access_timestamp"),
-        "last_manage_action": dl.get("last_manage_action"),
-        "last_manage_user_id": dl.get("last_manage_user_id")
-    }
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+def load_building_spec(path):
+    with open(path) as fh:
+        if path.endswith((".yml", ".yaml")):
+            if yaml is None:
+                raise RuntimeError("PyYAML is required for YAML building specs (pip install pyyaml)")
+            return yaml.safe_load(fh)
+        return json.load(fh)
 
-def publish_scb(apt_name):
-    device_id = APARTMENTS[apt_name].get("scb_device_id")
-    if not device_id:
-        return
-    with latest_data_lock:
-        scb = latest_data[apt_name]["scb"].copy()
-    payload = scb
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+def generate_apartments(spec, templates=None):
+    templates = templates if templates is not None else APARTMENTS
+    floors = parse_floors(spec.get("floors", 1))
+    if not floors:
+        raise ValueError("building spec has no floors")
+    units = spec["units"]
+    if isinstance(units, str):
+        units = parse_units(units)
 
-def publish_watermeter(apt_name):
-    device_id = APARTMENTS[apt_name].get("watermeter_device_id")
-    if not device_id:
-        return
-    with latest_data_lock:
-        wm = latest_data[apt_name]["watermeter"].copy()
-    payload = wm
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+    apartments = {}
+    per_floor = collections.Counter()
+    k = 0
+    for unit in units:
+        template = unit["template"]
+        rooms = unit.get("rooms")
+        if rooms is None:
+            if template not in templates:
+                raise ValueError(f"unknown apartment template {template!r} (known: {', '.join(templates)})")
+            rooms = templates[template]["rooms"]
+        for _ in range(int(unit.get("count", 1))):
+            floor = floors[k % len(floors)]
+            k += 1
+            per_floor[floor] += 1
+            name = f"{template}_f{floor}_{per_floor[floor]:02d}"
+            cfg = {key: f"{prefix}_{name}" for key, prefix in DEVICE_ID_PREFIXES.items()}
+            cfg["rooms"] = list(rooms)
+            cfg["floor"] = floor
+            apartments[name] = cfg
+    return apartments
 
-def publish_gasmeter(apt_name):
-    device_id = APARTMENTS[apt_name].get("gasmeter_device_id")
-    if not device_id:
-        return
-    with latest_data_lock:
-        gm = latest_data[apt_name]["gasmeter"].copy()
-    payload = gm
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+# ---------------------------------------------------------------------------
+# Columnar state backend (--state-backend columnar)
+# Same shape as the latest_data dict (latest_data[apt][device][field], and
+# latest_data[apt]["wallswitch"][room][field]) but every device type keeps its
+# fields column-wise: one typed array per numeric/bool field, one row per
+# apartment (or per wall switch room). Rows are exposed through light
+# dict-like views so the updaters and Flask handlers work unchanged, while
+# bulk code can operate on whole columns via latest_data.tables[device].
+# ---------------------------------------------------------------------------
+STATE_BACKEND = "dict"  # "dict" or "columnar"
 
-def publish_thermostat(apt_name):
-    device_id = APARTMENTS[apt_name].get("thermostat_device_id")
-    if not device_id:
-        return
-    with latest_data_lock:
-        th = latest_data[apt_name]["thermostat"].copy()
-    payload = {
-        "temperature": th["temperature"],
-        "humidity": th["humidity"],
-        "setpoint_temperature": th["setpoint_temperature"],
-        "setpoint_timestamp": th.get("last_setpoint_timestamp", ""),
-        "mode": th["mode"],
-        "status": th["status"],
-        "fan_setting": th["fan_setting"],
-        "valve_status": th["valve_status"],
-        "fan_status": th["fan_status"],
-        "co2": th["co2"],
-        "power": th["power"]
-    }
-    topic = f"sim/{device_id}/uplink"
-    try:
-        publish.single(topic, json.dumps(payload), hostname=MQTT_SERVER, port=MQTT_PORT)
-    except Exception as e:
-        print(f"[MQTT publish error] {e}")
+class DeviceColumns:
+    """One device type's fields, one column per field and one row per apartment/room.
 
-def aqi_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                latest_data[apt]["aqi"]["temp"] = round(random.uniform(20, 30), 1)
-                latest_data[apt]["aqi"]["humd"] = random.randint(40, 80)
-                latest_data[apt]["aqi"]["co2"] = random.randint(300, 1000)
-                latest_data[apt]["aqi"]["battery"] = random.randint(50, 100)
-            publish_aqi(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def wallswitch_updater():
-    while True:
-        for apt, cfg in APARTMENTS.items():
-            for room in cfg["rooms"]:
-                with latest_data_lock:
-                    latest_data[apt]["wallswitch"][room]["current"] = random.randint(200, 300)
-                    latest_data[apt]["wallswitch"][room]["voltage"] = round(random.uniform(230, 250), 1)
-                    latest_data[apt]["wallswitch"][room]["active_power"] = random.randint(0, 100)
-                    latest_data[apt]["wallswitch"][room]["power_consumption"] = random.randint(90000, 100000)
-                    latest_data[apt]["wallswitch"][room]["power_factor"] = random.randint(50, 100)
-                publish_wallswitch(apt, room)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def wallsocket_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                latest_data[apt]["wallsocket"]["current"] = random.randint(200, 300)
-                latest_data[apt]["wallsocket"]["voltage"] = round(random.uniform(230, 250), 1)
-                latest_data[apt]["wallsocket"]["active_power"] = random.randint(0, 100)
-                latest_data[apt]["wallsocket"]["power_consumption"] = random.randint(90000, 100000)
-                latest_data[apt]["wallsocket"]["power_factor"] = random.randint(50, 100)
-            publish_wallsocket(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def curtain_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                latest_data[apt]["curtain"]["battery"] = random.randint(50, 100)
-                # curtainstate remains as set unless changed by PUT; keep current value
-            publish_curtain(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def peoplecounter_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                # increment totals a bit to simulate accumulation
-                latest_data[apt]["peoplecounter"]["total_in"] += random.randint(0, 3)
-                latest_data[apt]["peoplecounter"]["total_out"] += random.randint(0, 3)
-                latest_data[apt]["peoplecounter"]["period_in"] = random.randint(0, 30)
-                latest_data[apt]["peoplecounter"]["period_out"] = random.randint(0, 30)
-                latest_data[apt]["peoplecounter"]["battery"] = max(0, latest_data[apt]["peoplecounter"]["battery"] - random.randint(0, 1))
-                latest_data[apt]["peoplecounter"]["temperature"] = round(random.uniform(20.0, 30.0), 1)
-                # maintain computed count field (in - out) and ensure non-negative
-                latest_data[apt]["peoplecounter"]["count"] = max(0, latest_data[apt]["peoplecounter"]["total_in"] - latest_data[apt]["peoplecounter"]["total_out"])
-            publish_peoplecounter(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def doorlock_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                dl = latest_data[apt]["doorlock"]
-                
-                # --- NEW LOGIC START ---
-                # 1. Get Configuration
-                # normally_open_mode: 0=Disabled, 1=Mode 1 (Permanent), 2=Mode 2 (Delayed)
-                norm_open = dl.get('normally_open_mode', 0)
-                
-                # auto_relock: Time in seconds before door locks
-                # honor explicit enable/disable flag: if auto_relock_enabled is False -> no auto-relocK
-                relock_enabled = dl.get('auto_relock_enabled', True)
-                relock_time = dl.get('auto_relock', 0) if relock_enabled else None
-                # default short relock_time only when field is missing and enabled
-                if relock_enabled and (not relock_time):
-                    relock_time = 5
-
-                # 2. Determine Status
-                calculated_status = 1  # Default to 1 = Locked
-
-                # Priority 1: Normally Open Mode forces UNLOCKED
-                if norm_open > 0:
-                    calculated_status = 0  # 0 = Unlocked
-                else:
-                    # If last action was a remote control, honor remote_lock intent.
-                    last_method = dl.get('last_access_method', '')
-                    last_access = dl.get('last_access_timestamp')
-
-                    # Helper to compute elapsed seconds safely
-                    def _elapsed_seconds(ts):
-                        try:
-                            last_ts = datetime.fromisoformat(ts)
-                            return (datetime.now(timezone.utc) - last_ts).total_seconds()
-                        except Exception:
-                            return None
-
-                    # Case: remote control command - explicit lock/unlock
-                    if last_method == 'remote':
-                        # remote_lock: 1 = remote-unlock request, 0 = remote-lock request
-                        if dl.get('remote_lock') == 1:
-                            # If relock is disabled, remain unlocked until explicit lock
-                            if relock_time is None:
-                                calculated_status = 0
-                            else:
-                                # if within relock window, consider unlocked; otherwise re-lock
-                                elapsed = _elapsed_seconds(last_access) if last_access else None
-                                if elapsed is None or elapsed < relock_time:
-                                    calculated_status = 0
-                                else:
-                                    calculated_status = 1
-                        else:
-                            # explicit remote lock -> locked immediately
-                            calculated_status = 1
-                    else:
-                        # Non-remote access (manual, card, password) uses transient unlock window
-                        if last_access:
-                            # if relock disabled: once unlocked by access event, remain unlocked
-                            if relock_time is None:
-                                calculated_status = 0
-                            else:
-                                elapsed = _elapsed_seconds(last_access)
-                                if elapsed is not None and elapsed < relock_time:
-                                    calculated_status = 0
-
-                # 3. Store the status
-                # 1 = Locked, 0 = Unlocked (Standard convention for door sensors)
-                dl["current_status"] = calculated_status
-                # --- NEW LOGIC END ---
-
-                # Existing updates (timestamp, slight battery decay)
-                dl["t"] = datetime.now(timezone.utc).isoformat()
-                dl["battery"] = max(0, dl["battery"] - random.randint(0, 1))
-                
-            publish_doorlock(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def scb_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                scb = latest_data[apt]["scb"]
-                # simulate small fluctuations
-                scb["voltage_A"] = round(scb["voltage_A"] + random.uniform(-1.0, 1.0), 1)
-                scb["voltage_B"] = round(scb["voltage_B"] + random.uniform(-1.0, 1.0), 1)
-                scb["voltage_C"] = round(scb["voltage_C"] + random.uniform(-1.0, 1.0), 1)
-                scb["current_A"] = round(max(0.0, scb["current_A"] + random.uniform(-0.5, 0.5)), 2)
-                scb["current_B"] = round(max(0.0, scb["current_B"] + random.uniform(-0.5, 0.5)), 2)
-                scb["current_C"] = round(max(0.0, scb["current_C"] + random.uniform(-0.5, 0.5)), 2)
-                scb["power_A"] = round(scb["current_A"] * scb["voltage_A"], 1)
-                scb["power_B"] = round(scb["current_B"] * scb["voltage_B"], 1)
-                scb["power_C"] = round(scb["current_C"] * scb["voltage_C"], 1)
-                scb["power_total"] = round(scb["power_A"] + scb["power_B"] + scb["power_C"], 1)
-                scb["temperature_device"] = random.randint(20, 40)
-            publish_scb(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def watermeter_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                latest_data[apt]["watermeter"]["volume"] = round(latest_data[apt]["watermeter"]["volume"] + random.uniform(0.0, 2.0), 2)
-                # battery slowly decays
-                latest_data[apt]["watermeter"]["battery"] = max(0, latest_data[apt]["watermeter"]["battery"] - random.randint(0, 1))
-            publish_watermeter(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def gasmeter_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                latest_data[apt]["gasmeter"]["volume"] = round(latest_data[apt]["gasmeter"]["volume"] + random.uniform(0.0, 5.0), 2)
-                latest_data[apt]["gasmeter"]["battery"] = max(0, latest_data[apt]["gasmeter"]["battery"] - random.randint(0, 1))
-            publish_gasmeter(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-def thermostat_updater():
-    while True:
-        for apt in APARTMENTS:
-            with latest_data_lock:
-                th = latest_data[apt]["thermostat"]
-                # small random walk around temperature and humidity
-                th["temperature"] = round(th["temperature"] + random.uniform(-0.3, 0.3), 1)
-                th["humidity"] = max(0, min(100, th["humidity"] + random.randint(-1, 1)))
-                th["co2"] = max(200, th["co2"] + random.randint(-5, 5))
-                # fan_status follows fan_setting
-                th["fan_status"] = th["fan_setting"]
-            publish_thermostat(apt)
-        time.sleep(DATA_SENDING_INTERVAL)
-
-threading.Thread(target=aqi_updater, daemon=True).start()
-threading.Thread(target=wallswitch_updater, daemon=True).start()
-threading.Thread(target=wallsocket_updater, daemon=True).start()
-threading.Thread(target=curtain_updater, daemon=True).start()
-threading.Thread(target=peoplecounter_updater, daemon=True).start()
-threading.Thread(target=doorlock_updater, daemon=True).start()
-threading.Thread(target=scb_updater, daemon=True).start()
-threading.Thread(target=watermeter_updater, daemon=True).start()
-threading.Thread(target=gasmeter_updater, daemon=True).start()
-threading.Thread(target=thermostat_updater, daemon=True).start()
+    ints, floats and bools go into typed array.array columns; strings (or a
+    field whose type changes at runtime) fall back to a plain list column.
+    """
+    TYPECODES = {bool: "b", int: "q", float: "d"}
 
-app = Flask(__name__)
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
 
-@app.route("/<apartment>/items/<item_name>/state", methods=["GET"])
-def get_item_state(apartment, item_name):
-    if apartment not in latest_data:
-        return "Apartment not found", 404
+    def append(self, values):
+        row = self.rows
+        self.rows += 1
+        for column in self.columns.values():
+            column.append(column[0] if isinstance(column, array.array) else None)
+        for field, value in values.items():
+            if field not in self.columns and row == 0 and type(value) in self.TYPECODES:
+                self.columns[field] = array.array(self.TYPECODES[type(value)], [value])
+            else:
+                self.set(row, field, value)
+        return row
 
-    # AQI mappings (apartment-level)
-    if item_name.endswith("_temp"):
-        return str(latest_data[apartment]["aqi"]["temp"])
-    if item_name.endswith("_humd"):
-        return str(latest_data[apartment]["aqi"]["humd"])
-    if item_name.endswith("_co2"):
-        return str(latest_data[apartment]["aqi"]["co2"])
-    if item_name.endswith("_battery"):
-        return str(latest_data[apartment]["aqi"]["battery"])
-
-    # Wall Socket mappings (apartment-level)
-    if item_name.endswith("_socket_current"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallsocket"]["current"])
-    if item_name.endswith("_socket_voltage"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallsocket"]["voltage"])
-    if item_name.endswith("_socket_active_power"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallsocket"]["active_power"])
-    if item_name.endswith("_socket_power_consumption"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallsocket"]["power_consumption"])
-    if item_name.endswith("_socket_power_factor"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallsocket"]["power_factor"])
-    if item_name.endswith("_socket_status"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallsocket"]["socket_status"])
-        
-    # Curtain mappings (apartment-level)
-    if item_name.endswith("_curtainstate"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["curtain"]["curtainstate"])
-    if item_name.endswith("_curtain_battery"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["curtain"]["battery"])
-
-    # PeopleCounter mappings (apartment-level)
-    if "PeopleCounter" in item_name and item_name.endswith("_total_in"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["peoplecounter"]["total_in"])
-    if "PeopleCounter" in item_name and item_name.endswith("_total_out"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["peoplecounter"]["total_out"])
-    if "PeopleCounter" in item_name and item_name.endswith("_period_in"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["peoplecounter"]["period_in"])
-    if "PeopleCounter" in item_name and item_name.endswith("_period_out"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["peoplecounter"]["period_out"])
-    if "PeopleCounter" in item_name and item_name.endswith("_battery"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["peoplecounter"]["battery"])
-    if "PeopleCounter" in item_name and item_name.endswith("_temperature"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["peoplecounter"]["temperature"])
-     # People count (total_in - total_out)
-    if "PeopleCounter" in item_name and item_name.endswith("_count"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["peoplecounter"].get("count", latest_data[apartment]["peoplecounter"]["total_in"] - latest_data[apartment]["peoplecounter"]["total_out"]))
-    
-    # Door Lock mappings (apartment-level) removed in favor of generic DoorLock_* mapping below.
-        
-    # Circuit Breaker mappings (apartment-level)
-    if "CircuitBreaker" in item_name and item_name.endswith("_device_type"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["device_type"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_breaker_address"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["breaker_address"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_breaker_type"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["breaker_type"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_switch_state"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["switch_state"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_remote_control_enabled"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["remote_control_enabled"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_voltage_A"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["voltage_A"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_voltage_B"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["voltage_B"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_voltage_C"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["voltage_C"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_current_A"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["current_A"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_current_B"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["current_B"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_current_C"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["current_C"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_power_total"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["power_total"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_leakage_current"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["leakage_current"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_temperature_device"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["temperature_device"])
-    if "CircuitBreaker" in item_name and item_name.endswith("_alarm_overload"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["scb"]["alarm_overload"])
-    # Thermostat mappings (apartment-level)
-    # check setpoint BEFORE generic temperature because item names like
-    # Thermostat_setpoint_temperature also end with '_temperature'
-    if "Thermostat" in item_name and item_name.endswith("_setpoint_temperature"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["setpoint_temperature"])
-    if "Thermostat" in item_name and item_name.endswith("_temperature"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["temperature"])
-    if "Thermostat" in item_name and item_name.endswith("_humidity"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["humidity"])
-    if "Thermostat" in item_name and item_name.endswith("_mode"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["mode"])
-    if "Thermostat" in item_name and item_name.endswith("_status"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["status"])
-    if "Thermostat" in item_name and item_name.endswith("_fan_setting"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["fan_setting"])
-    if "Thermostat" in item_name and item_name.endswith("_valve_status"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["valve_status"])
-    if "Thermostat" in item_name and item_name.endswith("_fan_status"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["fan_status"])
-    if "Thermostat" in item_name and item_name.endswith("_co2"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["co2"])
-    if "Thermostat" in item_name and item_name.endswith("_power"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["thermostat"]["power"])
-    # Water Meter mappings (apartment-level)
-    if "WaterMeter" in item_name and item_name.endswith("_volume"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["watermeter"]["volume"])
-    if "WaterMeter" in item_name and item_name.endswith("_valve_state"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["watermeter"]["valve_state"])
-    if "WaterMeter" in item_name and item_name.endswith("_battery"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["watermeter"]["battery"])
-    if "WaterMeter" in item_name and item_name.endswith("_low_power"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["watermeter"]["low_power"])
-    if "WaterMeter" in item_name and item_name.endswith("_alarm"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["watermeter"]["alarm"])
-    if "WaterMeter" in item_name and item_name.endswith("_communication_error"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["watermeter"]["communication_error"])
-    # Gas Meter mappings (apartment-level)
-    if "GasMeter" in item_name and item_name.endswith("_volume"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["gasmeter"]["volume"])
-    if "GasMeter" in item_name and item_name.endswith("_valve_state"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["gasmeter"]["valve_state"])
-    if "GasMeter" in item_name and item_name.endswith("_battery"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["gasmeter"]["battery"])
-    if "GasMeter" in item_name and item_name.endswith("_low_power"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["gasmeter"]["low_power"])
-    if "GasMeter" in item_name and item_name.endswith("_alarm"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["gasmeter"]["alarm"])
+    def get(self, row, field):
+        column = self.columns[field]
+        value = column[row]
+        if isinstance(column, array.array):
+            return bool(value) if column.typecode == "b" else value
+        if value is None:
+            raise KeyError(field)
+        return value
 
-    if "Switch" in item_name:
-        return "This switch item requires a room segment in the URL. Use /<apartment>/items/<item_name>/<room>/state", 400
+    def set(self, row, field, value):
+        column = self.columns.get(field)
+        if column is None:
+            column = self.columns[field] = [None] * self.rows
+        elif isinstance(column, array.array) and self.TYPECODES.get(type(value)) != column.typecode:
+            # type changed (e.g. int field assigned a float): keep exact values in a list column
+            column = self.columns[field] = [bool(v) for v in column] if column.typecode == "b" else list(column)
+        column[row] = value
 
-    # Generic mapping for DoorLock: allow GETs for any existing key under latest_data[apartment]['doorlock']
-    if "DoorLock" in item_name and "_door_" in item_name:
-        # extract the key portion after 'DoorLock_' then strip 'door_' if present
-        field = item_name.split('DoorLock_', 1)[-1]
-        if field.startswith('door_'):
-            field = field[len('door_'):]
-        with latest_data_lock:
-            val = latest_data[apartment]['doorlock'].get(field)
-            if val is not None:
-                return str(val)
+    def fields(self, row):
+        return [f for f, c in self.columns.items() if isinstance(c, array.array) or c[row] is not None]
 
-    return "Item not found", 404
+class RowView(collections.abc.MutableMapping):
+    """dict-like view of one row of a DeviceColumns table."""
+    __slots__ = ("_table", "_row")
 
-@app.route("/<apartment>/items/<item_name>/<room>/state", methods=["GET"])
-def get_wallswitch_item_state(apartment, item_name, room):
-    if apartment not in latest_data:
-        return "Apartment not found", 404
-    if room not in APARTMENTS[apartment]["rooms"]:
-        return "Room not found", 404
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
 
-    if item_name.endswith("_current"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallswitch"][room]["current"])
-    if item_name.endswith("_voltage"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallswitch"][room]["voltage"])
-    if item_name.endswith("_active_power"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallswitch"][room]["active_power"])
-    if item_name.endswith("_power_consumption"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallswitch"][room]["power_consumption"])
-    if item_name.endswith("_power_factor"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallswitch"][room]["power_factor"])
-    if item_name.endswith("_switch_1"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallswitch"][room]["switch_1"])
-    if item_name.endswith("_switch_2"):
-        with latest_data_lock:
-            return str(latest_data[apartment]["wallswitch"][room]["switch_2"])
-
-    return "Item not found", 404
+    def __getitem__(self, field):
+        return self._table.get(self._row, field)
 
-@app.route('/<apartment>/items/Update_Apartment_smart_Switch/<room>/state', methods=['PUT'])
-def change_wallswitch(apartment, room):
-    if apartment not in latest_data:
-        return jsonify({'error': 'Apartment not found'}), 404
-    if room not in APARTMENTS[apartment]["rooms"]:
-        return jsonify({'error': 'Room not found'}), 404
+    def __setitem__(self, field, value):
+        self._table.set(self._row, field, value)
 
-    switch_states = {}
-    for param, value in request.args.items():
-        if param.startswith('switch_'):
-            try:
-                switch_num = int(param.split('_')[1])
-            except Exception:
-                continue
-            state = value.lower() in ('true', '1', 'on')
-            switch_states[switch_num] = state
-            with latest_data_lock:
-                latest_data[apartment]["wallswitch"][room][f"switch_{switch_num}"] = 1 if state else 0
+    def __delitem__(self, field):
+        raise TypeError("columnar state rows have a fixed set of fields")
 
-    switch_control = 0
-    for switch_num, state in switch_states.items():
-        if 1 <= switch_num <= 4:
-            switch_control |= 1 << (switch_num + 3)
-            if state:
-                switch_control |= 1 << (switch_num - 1)
+    def __iter__(self):
+        return iter(self._table.fields(self._row))
 
-    command_bytes = bytes([8, switch_control, 255])
-    command = base64.b64encode(command_bytes).decode()
+    def __len__(self):
+        return len(self._table.fields(self._row))
 
-    device_id = f"{APARTMENTS[apartment]['switch_device_id']}_{room}"
-    message = json.dumps({"confirmed": True, "fport": 85, "data": command})
-    topic = f'milesight/downlink/{device_id}'
+    def copy(self):
+        return {f: self._table.get(self._row, f) for f in self._table.fields(self._row)}
 
-    try:
-        publish.single(topic, message, hostname=MQTT_SERVER, port=MQTT_PORT)
+class ApartmentView(collections.abc.Mapping):
+    """latest_data[apt] for the columnar backend."""
+    __slots__ = ("_tables", "_row", "_ws_start", "_rooms")
 
-        threading.Timer(1.0, publish_wallswitch, args=(apartment, room)).start()
-        
-        with latest_data_lock:
-            new_state = latest_data[apartment]["wallswitch"][room].copy()
-        return jsonify({
-            'status': f"Switch updated, command {command} published to {topic}",
-            'new_state': new_state
-        }), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    def __init__(self, tables, row, ws_start, rooms):
+        self._tables = tables
+        self._row = row
+        self._ws_start = ws_start
+        self._rooms = rooms
 
-@app.route('/<apartment>/items/Update_Apartment_smart_Socket/state', methods=['PUT'])
-def change_wallsocket(apartment):
-    if apartment not in latest_data:
-        return jsonify({'error': 'Apartment not found'}), 404
-    
-    if 'socket_status' not in request.args:
-        return jsonify({'error': 'socket_status parameter is required'}), 400
-    socket_status = request.args.get('socket_status').lower() in ('true', '1', 'on')
-    with latest_data_lock:
-        latest_data[apartment]["wallsocket"]["socket_status"] = 1 if socket_status else 0
+    def __getitem__(self, device):
+        table = self._tables[device]
+        if device == "wallswitch":
+            return {room: RowView(table, self._ws_start + i) for i, room in enumerate(self._rooms)}
+        return RowView(table, self._row)
 
-    if socket_status == True:
-        command = "CAEA/w=="
-    else:
-        command = "CAAA/w=="
+    def __iter__(self):
+        return iter(self._tables)
 
-    device_id = f"{APARTMENTS[apartment]['socket_device_id']}"
-    message = json.dumps({"confirmed": True, "fport": 85, "data": command})
-    topic = f'milesight/downlink/{device_id}'
+    def __len__(self):
+        return len(self._tables)
 
-    try:
-        publish.single(topic, message, hostname=MQTT_SERVER, port=MQTT_PORT)
+class ColumnarState(collections.abc.Mapping):
+    """Drop-in replacement for the latest_data dict backed by DeviceColumns tables."""
 
-        threading.Timer(1.0, publish_wallsocket, args=(apartment,)).start()
-        
-        with latest_data_lock:
-            new_state = latest_data[apartment]["wallsocket"].copy()
-        return jsonify({
-            'status': f"Socket updated, command {command} published to {topic}",
-            'new_state': new_state
-        }), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    def __init__(self, apartments, now=None):
+        self.tables = {}
+        self._index = {}
+        # row -> owner, for code that works on whole columns
+        self.row_apartments = []
+        self.ws_apartments = []
+        self.ws_rooms = []
+        for apt, cfg in apartments.items():
+            self.add(apt, cfg["rooms"], new_apartment_state(apt, cfg, now))
 
-@app.route('/<apartment>/items/Update_Apartment_smart_Curtain/state', methods=['PUT'])
-def change_curtain(apartment):
-    if apartment not in latest_data:
-        return jsonify({'error': 'Apartment not found'}), 404
+    def add(self, apt, rooms, state):
+        row = None
+        for device, values in state.items():
+            table = self.tables.setdefault(device, DeviceColumns())
+            if device == "wallswitch":
+                ws_start = table.rows
+                for room in rooms:
+                    table.append(values[room])
+                    self.ws_apartments.append(apt)
+                    self.ws_rooms.append(room)
+            else:
+                row = table.append(values)
+        self.row_apartments.append(apt)
+        self._index[apt] = (row, ws_start, rooms)
 
-    if 'curtainstate' not in request.args:
-        return jsonify({'error': 'curtainstate parameter is required (0-100)'}), 400
-    try:
-        pos = int(request.args.get('curtainstate'))
-    except Exception:
-        return jsonify({'error': 'curtainstate must be integer 0-100'}), 400
-    if pos < 0 or pos > 100:
-        return jsonify({'error': 'curtainstate must be in range 0-100'}), 400
+    def __getitem__(self, apt):
+        return ApartmentView(self.tables, *self._index[apt])
 
-    with latest_data_lock:
-        latest_data[apartment]["curtain"]["curtainstate"] = pos
+    def __contains__(self, apt):
+        return apt in self._index
 
-    # Build downlink command: [9, position, 255]
-    command_bytes = bytes([9, pos, 255])
-    command = base64.b64encode(command_bytes).decode()
+    def __iter__(self):
+        return iter(self._index)
 
-    device_id = f"{APARTMENTS[apartment]['curtain_device_id']}"
-    message = json.dumps({"confirmed": True, "fport": 85, "data": command})
-    topic = f'milesight/downlink/{device_id}'
+    def __len__(self):
+        return len(self._index)
 
-    try:
-        publish.single(topic, message, hostname=MQTT_SERVER, port=MQTT_PORT)
+def build_state(apartments):
+    # initial readings are stamped with the start of simulated time
+    now = sim_clock.start.isoformat()
+    if STATE_BACKEND == "columnar":
+        return ColumnarState(apartments, now)
+    return {apt: new_apartment_state(apt, cfg, now) for apt, cfg in apartments.items()}
 
-        # delayed publish of the updated curtain packet for this apartment
-        threading.Timer(1.0, publish_curtain, args=(apartment,)).start()
+def load_apartments(apartments):
+    """Replace the simulated apartments and their state. Call before start_scheduler()."""
+    global latest_data
+    apartments = dict(apartments)
+    state = build_state(apartments)
+    with all_state_locks():
+        APARTMENTS.clear()
+        APARTMENTS.update(apartments)
+        latest_data = state
+        with report_lock:
+            reported_uplinks.clear()
 
-        with latest_data_lock:
-            new_state = latest_data[apartment]["curtain"].copy()
-        return jsonify({
-            'status': f"Curtain updated to {pos}, command {command} published to {topic}",
-            'new_state': new_state
-        }), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+# ---------------------------------------------------------------------------
+# Change log
+# Every mutation of latest_data made inside track_changes() is diffed and
+# appended as (version, apartment, device, field, value). Versions increase
+# by one per delta, so a client can resume from the last version it saw as
+# long as that delta is still within the last CHANGE_LOG_SIZE entries.
+# ---------------------------------------------------------------------------
+CHANGE_LOG_SIZE = 10000
 
-@app.route('/<apartment>/items/Update_Apartment_smart_DoorLock/state', methods=['PUT'])
-def change_doorlock(apartment):
-    """Unified doorlock control/update endpoint (PUT).
-    Supported query params (action):
-    - action=remote_control&state=unlock|lock
-    - action=manage_password&user_id=<int>&password=<6-digit>
-    - action=manage_card&user_id=<int>&card_key_hex=<10 hex chars>
-    - action=access_event&access_method=<password|card|remote>&user_id=<int>&timestamp=<iso>
-    Note: This keeps a single consistent URL for control and simulation updates.
-    """
-    if apartment not in latest_data:
-        return jsonify({'error': 'Apartment not found'}), 404
+change_log = collections.deque(maxlen=CHANGE_LOG_SIZE)
+change_cond = threading.Condition()
+change_version = 0
 
-    action = request.args.get('action')
-    if not action:
-        return jsonify({'error': 'action parameter is required'}), 400
-    action = action.lower()
+def record_changes(apt, device, before, after, prefix=""):
+    global change_version
+    deltas = [(prefix + k, v) for k, v in after.items() if k not in before or before[k] != v]
+    if not deltas:
+        return
+    with change_cond:
+        for field, value in deltas:
+            change_version += 1
+            change_log.append((change_version, apt, device, field, value))
+        change_cond.notify_all()
+        _notify_async_changes()
 
-    device_id = APARTMENTS[apartment].get('doorlock_device_id')
-    if not device_id:
-        return jsonify({'error': 'doorlock not configured for apartment'}), 404
+@contextlib.contextmanager
+def track_changes(apt, device, room=None):
+    """Record the fields of latest_data[apt][device] (or one wall switch room) changed inside the block.
 
+    Must be entered while holding state_lock(apt) so deltas are logged in mutation order.
+    """
+    state = latest_data[apt][device] if room is None else latest_data[apt][device][room]
+    before = dict(state)
     try:
-        with latest_data_lock:
-            dl = latest_data[apartment]['doorlock']
-
-        if action == 'remote_control':
-            state = request.args.get('state')
-            if not state or state.lower() not in ('unlock', 'lock', "0", "1"):
-                return jsonify({'error': 'state must be "unlock" or "lock"'}), 400
-            state = state.lower()
-            # Command 0x36: 36 01 01 (unlock) or 36 01 00 (lock)
-            cmd_hex = '360101' if state == 'unlock' or state == "0" else '360100'
-            cmd_bytes = bytes.fromhex(cmd_hex)
-            # Update internal state to reflect lock/unlock
-            with latest_data_lock:
-                    dl['remote_lock'] = 1 if state == 'unlock' or state == "0" else 0
-                    # reflect immediate current status for API GETs
-                    dl['current_status'] = 0 if state == 'unlock' or state == "0" else 1
-                    if state == 'unlock':
-                        dl['unlock_record'] = dl.get('unlock_record', 0) + 1
-                    dl['t'] = datetime.now(timezone.utc).isoformat()
-                    dl['last_access_method'] = 'remote'
-                    dl['last_access_user_id'] = 0
-                    dl['last_access_timestamp'] = dl['t']
-
-        elif action == 'manage_password':
-            # require user_id and password
-            user_id = request.args.get('user_id')
-            password = request.args.get('password')
-            if not user_id or not password:
-                return jsonify({'error': 'user_id and password are required'}), 400
-            try:
-                uid = int(user_id)
-            except Exception:
-                return jsonify({'error': 'invalid user_id'}), 400
-            if not (isinstance(password, str) and len(password) == 6 and password.isdigit()):
-                return jsonify({'error': 'password must be 6 digits'}), 400
-            header = bytes.fromhex('4E0900')
-            uid_b = uid.to_bytes(1, 'big')
-            len_b = bytes([6])
-            pwd_b = bytes([int(d) for d in password])
-            cmd_bytes = header + uid_b + len_b + pwd_b
-            # record management action so it appears in next uplink
-            with latest_data_lock:
-                dl['t'] = datetime.now(timezone.utc).isoformat()
-                dl['last_manage_action'] = 'manage_password'
-                dl['last_manage_user_id'] = uid
-
-        elif action == 'manage_card':
-            user_id = request.args.get('user_id')
-            card_key_hex = request.args.get('card_key_hex')
-            if not user_id or not card_key_hex:
-                return jsonify({'error': 'user_id and card_key_hex are required'}), 400
-            try:
-                uid = int(user_id)
-            except Exception:
-                return jsonify({'error': 'invalid user_id'}), 400
-            if not (isinstance(card_key_hex, str) and len(card_key_hex) == 10):
-                return jsonify({'error': 'card_key_hex must be 10 hex chars'}), 400
-            try:
-                card_b = bytes.fromhex(card_key_hex)
-            except Exception:
-                return jsonify({'error': 'card_key_hex invalid hex'}), 400
-            header = bytes.fromhex('4D0700')
-            uid_b = uid.to_bytes(1, 'big')
-            cmd_bytes = header + uid_b + card_b
-            # record management action so it appears in next uplink
-            with latest_data_lock:
-                dl['t'] = datetime.now(timezone.utc).isoformat()
-                dl['last_manage_action'] = 'manage_card'
-                dl['last_manage_user_id'] = uid
-
-        elif action == 'access_event':
-            # Simulates device reporting a user access (unlock via password/card/remote)
-            method = request.args.get('access_method') or request.args.get('method')
-            user_id = request.args.get('user_id')
-            ts = request.args.get('timestamp') or datetime.now(timezone.utc).isoformat()
-            if not method or not user_id:
-                return jsonify({'error': 'access_method and user_id are required'}), 400
-            method = method.lower()
-            try:
-                uid = int(user_id)
-            except Exception:
-                return jsonify({'error': 'invalid user_id'}), 400
-            with latest_data_lock:
-                dl['last_access_method'] = method
-                dl['last_access_user_id'] = uid
-                dl['last_access_timestamp'] = ts
-                dl['t'] = datetime.now(timezone.utc).isoformat()
-                # Increment unlock counter on any access event (successful unlock)
-                dl['unlock_record'] = dl.get('unlock_record', 0) + 1
-            # no downlink for access_event; we just simulate device reporting
-            threading.Timer(1.0, publish_doorlock, args=(apartment,)).start()
-            with latest_data_lock:
-                new_state = latest_data[apartment]['doorlock'].copy()
-            return jsonify({'status': 'access_event recorded', 'new_state': new_state}), 200
-
-        elif action == 'set_auto_relock':
-            # set_auto_relock?enabled=true|false&timeout=<seconds>
-            enabled = request.args.get('enabled')
-            timeout = request.args.get('timeout')
-            with latest_data_lock:
-                if enabled is not None:
-                    en = enabled.lower() in ('1', 'true', 'yes', 'on')
-                    dl['auto_relock_enabled'] = en
-                if timeout is not None:
-                    try:
-                        to = int(timeout)
-                        dl['auto_relock'] = to
-                    except Exception:
-                        return jsonify({'error': 'invalid timeout'}), 400
-                dl['t'] = datetime.now(timezone.utc).isoformat()
-            threading.Timer(1.0, publish_doorlock, args=(apartment,)).start()
-            with latest_data_lock:
-                new_state = latest_data[apartment]['doorlock'].copy()
-            return jsonify({'status': 'auto_relock updated', 'new_state': new_state}), 200
+        yield state
+    finally:
+        record_changes(apt, device, before, state, prefix=f"{room}." if room else "")
 
-        else:
-            return jsonify({'error': 'unsupported action'}), 400
-
-        # If we reach here we have cmd_bytes to send downlink
-        command_b64 = base64.b64encode(cmd_bytes).decode()
-        message = json.dumps({"confirmed": True, "fport": LORAWAN_FPORT, "data": command_b64})
-        topic = f'milesight/downlink/{device_id}'
-        publish.single(topic, message, hostname=MQTT_SERVER, port=MQTT_PORT)
-        threading.Timer(1.0, publish_doorlock, args=(apartment,)).start()
-        with latest_data_lock:
-            new_state = latest_data[apartment]['doorlock'].copy()
-        return jsonify({'status': 'command sent', 'downlink': command_b64, 'new_state': new_state}), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+def changes_since(since, apartment=None, device=None):
+    """Return (deltas newer than `since`, gap, head).
 
-@app.route('/<apartment>/items/Update_Apartment_smart_CircuitBreaker/state', methods=['PUT'])
-def change_scb(apartment):
-    """Control Circuit Breaker: use param `action=on|off` to change switch_state."""
-    if apartment not in latest_data:
-        return jsonify({'error': 'Apartment not found'}), 404
+    gap=True means deltas after `since` were already evicted (or the cursor is
+    from before a restart); head is the newest version examined, i.e. the
+    cursor to resume from.
+    """
+    with change_cond:
+        head = change_version
+        if since > head:
+            return [], True, head
+        if not change_log:
+            return [], False, head
+        first = change_log[0][0]
+        gap = since < first - 1
+        entries = list(itertools.islice(change_log, max(0, since - first + 1), None))
+    return [e for e in entries if (apartment is None or e[1] == apartment) and (device is None or e[2] == device)], gap, head
 
-    if 'action' not in request.args:
-        return jsonify({'error': 'action parameter is required (on|off or 1|0)'}), 400
-    action = request.args.get('action').lower()
-    # normalize numeric values to on/off
-    if action in ('1', 'true'):
-        action = 'on'
-    elif action in ('0', 'false'):
-        action = 'off'
-    if action not in ('on', 'off'):
-        return jsonify({'error': 'action must be "on" or "off" (or 1/0)'}), 400
+def _delta_json(entry):
+    version, apt, device, field, value = entry
+    return {"apartment": apt, "device": device, "field": field, "value": value, "version": version}
 
-    with latest_data_lock:
-        scb = latest_data[apartment]['scb']
-        # store as integer: 1 = connection made (CLOSED/on), 0 = connection broken (OPEN/off)
-        scb['switch_state'] = 1 if action == 'on' else 0
+# ---------------------------------------------------------------------------
+# Persistent MQTT connection pool
+# All uplinks and downlinks go through mqtt_publish_batch(), which only
+# enqueues them. Queue entries are batches of (topic, payload, qos, retain)
+# messages, published back to back by one sender. MQTT_POOL_SIZE long-lived
+# clients drain the queue; paho's network loop reconnects them automatically
+# if the broker goes away, and batches wait in the (bounded) queue until a
+# connection is back.
+# Senders never wait for a PUBACK before the next publish: each client keeps
+# up to MQTT_MAX_INFLIGHT QoS 1/2 messages unacknowledged (InflightWindow) and
+# only blocks when that window is full.
+# ---------------------------------------------------------------------------
+QOS_LATENCY_SAMPLES = 10000  # ack latencies kept per QoS level for /mqtt/stats
+QOS_RATE_WINDOW = 10  # seconds over which /mqtt/stats reports acks per second
 
-    # Use provided example raw commands
-    if action == 'off':
-        cmd_bytes = bytes.fromhex('AA030101003DCC55')
-    else:
-        cmd_bytes = bytes.fromhex('AA03010101FC0C55')
-    command = base64.b64encode(cmd_bytes).decode()
+mqtt_queue = queue.Queue(maxsize=MQTT_QUEUE_SIZE)
+mqtt_clients = []
 
-    device_id = f"{APARTMENTS[apartment]['scb_device_id']}"
-    message = json.dumps({"confirmed": True, "fport": 85, "data": command})
-    topic = f'milesight/downlink/{device_id}'
-    try:
-        publish.single(topic, message, hostname=MQTT_SERVER, port=MQTT_PORT)
-        threading.Timer(1.0, publish_scb, args=(apartment,)).start()
-        with latest_data_lock:
-            new_state = latest_data[apartment]['scb'].copy()
-        return jsonify({'status': f'scb {action} command sent', 'new_state': new_state}), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+qos_stats_lock = threading.Lock()
+qos_stats = {qos: {"published": 0, "acked": 0, "acks": collections.deque(maxlen=QOS_LATENCY_SAMPLES)}
+             for qos in (0, 1, 2)}
 
-@app.route('/<apartment>/items/Update_Apartment_smart_WaterMeter/state', methods=['PUT'])
-def change_watermeter(apartment):
-    if apartment not in latest_data:
-        return jsonify({'error': 'Apartment not found'}), 404
+def _record_ack(qos, published_at, acked_at):
+    with qos_stats_lock:
+        stats = qos_stats[qos]
+        stats["acked"] += 1
+        stats["acks"].append((acked_at, acked_at - published_at))
 
-    # Accept 'action' (open/close) or 'valve' (on/off/1/0)
-    action = request.args.get('action') or request.args.get('valve')
-    if not action:
-        return jsonify({'error': 'action or valve parameter required (open/close or on/off)'}), 400
-    action = action.lower()
-    # Interpret 'open', 'off', '0', 'false' as valve OPEN (cut off)
-    open_values = ('open', 'off', '0', 'false')
-    # Interpret 'close', 'on', '1', 'true' as valve CLOSED (connection made)
-    close_values = ('close', 'on', '1', 'true')
-    if action in open_values:
-        state_str = 'OPEN'
-        state_int = 0
-    elif action in close_values:
-        state_str = 'CLOSED'
-        state_int = 1
-    else:
-        return jsonify({'error': 'invalid action'}), 400
+class InflightWindow:
+    """One client's published but not yet acknowledged messages.
 
-    with latest_data_lock:
-        latest_data[apartment]['watermeter']['valve_state'] = state_int
+    QoS 1/2 publishes wait while `size` of them are unacknowledged. Every
+    acknowledgment (for QoS 0: the write to the socket) records its latency
+    in qos_stats.
+    """
 
-    # command encoding uses 1 for OPEN, 0 for CLOSED per device spec
-    cmd_byte = 1 if state_str == 'OPEN' else 0
-    command_bytes = bytes([12, cmd_byte, 255])
-    command = base64.b64encode(command_bytes).decode()
-    device_id = f"{APARTMENTS[apartment]['watermeter_device_id']}"
-    message = json.dumps({"confirmed": True, "fport": 85, "data": command})
-    topic = f'milesight/downlink/{device_id}'
-    try:
-        publish.single(topic, message, hostname=MQTT_SERVER, port=MQTT_PORT)
-        threading.Timer(1.0, publish_watermeter, args=(apartment,)).start()
-        with latest_data_lock:
-            new_state = latest_data[apartment]['watermeter'].copy()
-        return jsonify({'status': f'watermeter valve {state_str}', 'new_state': new_state}), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    def __init__(self, size):
+        self.size = size
+        self.cond = threading.Condition()
+        self.pending = {}  # mid -> (qos, published at)
+        self.early = {}  # mid -> acked at, for acks that arrive before publish() returns
+        self.waiting = 0  # QoS 1/2 messages in pending
+        self.room = None  # asyncio.Event set on every ack, on the asyncio runtime
 
-@app.route('/<apartment>/items/Update_Apartment_smart_GasMeter/state', methods=['PUT'])
-def change_gasmeter(apartment):
-    if apartment not in latest_data:
-        return jsonify({'error': 'Apartment not found'}), 404
+    def full(self):
+        return self.waiting >= self.size
 
-    action = request.args.get('action') or request.args.get('valve')
-    if not action:
-        return jsonify({'error': 'action or valve parameter required (open/close or on/off)'}), 400
-    action = action.lower()
-    # Interpret 'open', 'off', '0', 'false' as valve OPEN (cut off)
-    if action in ('open', 'off', '0', 'false'):
-        state_str = 'OPEN'
-        state_int = 0
-    elif action in ('close', 'on', '1', 'true'):
-        state_str = 'CLOSED'
-        state_int = 1
+    def wait_for_room(self):
+        with self.cond:
+            while self.waiting >= self.size:
+                self.cond.wait()
+
+    def published(self, mid, qos, published_at):
+        with self.cond:
+            acked_at = self.early.pop(mid, None)
+            if acked_at is None:
+                self.pending[mid] = (qos, published_at)
+                self.waiting += qos > 0
+        with qos_stats_lock:
+            qos_stats[qos]["published"] += 1
+        if acked_at is not None:
+            _record_ack(qos, published_at, acked_at)
+
+    def acked(self, mid):
+        acked_at = time.perf_counter()
+        with self.cond:
+            entry = self.pending.pop(mid, None)
+            if entry is None:
+                self.early[mid] = acked_at
+                return
+            if entry[0]:
+                self.waiting -= 1
+                self.cond.notify()
+        if self.room is not None:
+            self.room.set()
+        _record_ack(entry[0], entry[1], acked_at)
+
+def mqtt_stats():
+    """Published/acked counts, ack latency and ack rate per QoS level (plus "sink" with --transport memory)."""
+    now = time.perf_counter()
+    stats = {}
+    with qos_stats_lock:
+        for qos, entry in qos_stats.items():
+            latencies = [latency for _, latency in entry["acks"]]
+            recent = sum(1 for acked_at, _ in entry["acks"] if acked_at >= now - QOS_RATE_WINDOW)
+            stats[str(qos)] = {
+                "published": entry["published"],
+                "acked": entry["acked"],
+                "in_flight": entry["published"] - entry["acked"],
+                "acks_per_s": round(recent / QOS_RATE_WINDOW, 1),
+                "ack_ms": {f"p{pct}": round(_percentile(latencies, pct) * 1000, 2) if latencies else None
+                           for pct in (50, 95, 99)},
+            }
+    if MQTT_TRANSPORT == "memory":
+        stats["sink"] = memory_sink.snapshot()
+    return stats
+
+def _new_mqtt_client(inflight=None):
+    if MQTT_TRANSPORT == "memory":
+        client = MemoryClient()
+    # paho-mqtt >= 2.0 requires the callback API version to be chosen explicitly
+    elif hasattr(mqtt, "CallbackAPIVersion"):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     else:
-        return jsonify({'error': 'invalid action'}), 400
+        client = mqtt.Client()
+    connected = threading.Event()
+    window = InflightWindow(inflight or MQTT_MAX_INFLIGHT)
+    client.max_inflight_messages_set(window.size)
 
-    with latest_data_lock:
-        latest_data[apartment]['gasmeter']['valve_state'] = state_int
+    # callback signatures differ between paho 1.x and 2.x; rc is always args[1]
+    def on_connect(client, userdata, *args):
+        if args[1] == 0:
+            connected.set()
+        else:
+            print(f"[MQTT connect error] rc={args[1]}")
 
-    cmd_byte = 1 if state_str == 'OPEN' else 0
-    command_bytes = bytes([13, cmd_byte, 255])
-    command = base64.b64encode(command_bytes).decode()
-    device_id = f"{APARTMENTS[apartment]['gasmeter_device_id']}"
-    message = json.dumps({"confirmed": True, "fport": 85, "data": command})
-    topic = f'milesight/downlink/{device_id}'
+    def on_disconnect(client, userdata, *args):
+        connected.clear()
+
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_publish = lambda client, userdata, mid, *args: window.acked(mid)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    return client, connected, window
+
+def _publish_accepted(info, qos):
+    # while disconnected paho keeps QoS 1/2 messages and sends them on reconnect
+    return info.rc == mqtt.MQTT_ERR_SUCCESS or (qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN)
+
+def publish_message(client, connected, window, message):
+    """Publish one (topic, payload, qos, retain) message, waiting for the connection and,
+    at QoS 1/2, for room in the client's in-flight window."""
+    topic, payload, qos, retain = message
+    start = time.perf_counter()
+    if qos:
+        window.wait_for_room()
+    while True:
+        connected.wait()
+        published_at = time.perf_counter()
+        info = client.publish(topic, payload, qos, retain)
+        if _publish_accepted(info, qos):
+            window.published(info.mid, qos, published_at)
+            publish_seconds.observe(time.perf_counter() - start, qos)
+            return
+        # connection dropped between wait() and publish(); retry once reconnected
+        publish_errors.inc()
+        connected.clear()
+        time.sleep(0.1)
+
+def mqtt_sender(client, connected, window):
+    while True:
+        messages, commands = mqtt_queue.get()
+        for message in messages:
+            publish_message(client, connected, window, message)
+        if commands:
+            for command_id, count in commands.items():
+                downlink_sent(command_id, count)
+
+def start_mqtt_pool():
+    for _ in range(MQTT_POOL_SIZE):
+        client, connected, window = _new_mqtt_client()
+        client.connect_async(MQTT_SERVER, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+        client.loop_start()
+        mqtt_clients.append(client)
+        threading.Thread(target=mqtt_sender, args=(client, connected, window), daemon=True).start()
+
+def mqtt_publish_batch(messages, commands=None):
+    """Queue (topic, payload, qos, retain) messages for the shared MQTT connections as one batch (never blocks).
+
+    `commands` maps the id of each command with downlinks in the batch to
+    its number of messages; they are marked sent once the batch is out.
+    """
+    try:
+        mqtt_queue.put_nowait((messages, commands))
+        if mqtt_wakeup is not None:
+            mqtt_wakeup.set()
+    except queue.Full:
+        messages_dropped.inc(amount=len(messages))
+        raise RuntimeError(f"MQTT outbound queue full ({MQTT_QUEUE_SIZE} batches), "
+                           f"dropped {len(messages)} message(s) to {messages[0][0]}")
+
+_FLAGS = {"1": True, "true": True, "on": True, "yes": True, "0": False, "false": False, "off": False, "no": False}
+
+def parse_qos(value):
+    if value not in ("0", "1", "2"):
+        raise ValueError(f"invalid QoS {value!r}, expected 0, 1 or 2")
+    return int(value)
+
+def parse_flag(value):
+    if value.lower() not in _FLAGS:
+        raise ValueError(f"invalid flag {value!r}, expected on/off")
+    return _FLAGS[value.lower()]
+
+def parse_device_values(spec, convert):
+    """"1" / "scb=1,doorlock=2" / "0,scb=2" -> {device: value}; a bare value applies to every device type."""
+    values = {}
+    for part in spec.split(","):
+        device, sep, value = part.strip().rpartition("=")
+        if not sep:
+            values.update(dict.fromkeys(DEVICE_QOS, convert(value)))
+        elif device not in DEVICE_QOS:
+            raise ValueError(f"unknown device type {device!r}")
+        else:
+            values[device] = convert(value)
+    return values
+
+# ---------------------------------------------------------------------------
+# In-memory transport (--transport memory)
+# MemoryClient stands in for paho's Client when no broker is available. It
+# accepts every publish at once, acknowledges it immediately and records it
+# in memory_sink instead of sending it. Everything up to the socket still
+# runs as usual: outbox, queue, senders and in-flight window. /mqtt/stats
+# and --bench transport then measure the simulator's own publish throughput,
+# independent of any broker.
+# ---------------------------------------------------------------------------
+MEMORY_SINK_SAMPLES = 1000  # most recent (time, topic, bytes) kept per direction
+
+class MemorySink:
+    """Count, bytes and arrival time of every message published through a MemoryClient, per direction."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.directions = {direction: {"messages": 0, "bytes": 0, "first": None, "last": None,
+                                           "recent": collections.deque(maxlen=MEMORY_SINK_SAMPLES)}
+                               for direction in ("uplink", "downlink")}
+
+    def record(self, topic, payload):
+        now = time.time()
+        with self.lock:
+            entry = self.directions["downlink" if "/downlink/" in topic else "uplink"]
+            entry["messages"] += 1
+            entry["bytes"] += len(payload)
+            if entry["first"] is None:
+                entry["first"] = now
+            entry["last"] = now
+            entry["recent"].append((now, topic, len(payload)))
+
+    def count(self, direction):
+        with self.lock:
+            return self.directions[direction]["messages"]
+
+    def snapshot(self, recent=10):
+        """Per direction: totals, first/last arrival (Unix time), messages/s in between and the latest arrivals."""
+        with self.lock:
+            snapshot = {}
+            for direction, entry in self.directions.items():
+                span = entry["last"] - entry["first"] if entry["messages"] > 1 else 0
+                snapshot[direction] = {
+                    "messages": entry["messages"],
+                    "bytes": entry["bytes"],
+                    "first": entry["first"],
+                    "last": entry["last"],
+                    "per_s": round((entry["messages"] - 1) / span, 1) if span else None,
+                    "recent": [{"t": t, "topic": topic, "bytes": size}
+                               for t, topic, size in itertools.islice(reversed(entry["recent"]), recent)],
+                }
+        return snapshot
+
+memory_sink = MemorySink()
+
+MemoryPublishInfo = collections.namedtuple("MemoryPublishInfo", "rc mid")
+
+class MemoryClient:
+    """The parts of paho's Client that the MQTT pool uses; publishes go to memory_sink."""
+
+    def __init__(self):
+        self.on_connect = self.on_disconnect = self.on_publish = None
+        self._mids = itertools.count(1)
+        self._socket = None
+
+    def max_inflight_messages_set(self, size):
+        pass
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect(self, host=None, port=None, keepalive=None):
+        self._socket = object()  # stands for the connection mqtt_async_client() checks for
+        self.on_connect(self, None, {}, 0, None)
+
+    connect_async = connect
+
+    def loop_start(self):
+        pass
+
+    def loop_misc(self):
+        pass
+
+    def socket(self):
+        return self._socket
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        mid = next(self._mids)
+        memory_sink.record(topic, payload)
+        # paho reports QoS 0 once written and QoS 1/2 once acknowledged; here both happen at once
+        self.on_publish(self, None, mid, None, None)
+        return MemoryPublishInfo(mqtt.MQTT_ERR_SUCCESS, mid)
+
+# ---------------------------------------------------------------------------
+# Uplink serializers
+# Every uplink has a fixed layout per device type, so each layout is compiled
+# once into a %-format template whose keys and constant values are already
+# JSON-encoded; a publish only encodes the changing values. The output is
+# byte-for-byte what json.dumps() gives for the equivalent dict.
+# UPLINK_ENCODER selects "template" (default), "json" (build the dict and
+# json.dumps it, the old way) or "orjson" (needs the orjson package; compact
+# separators, same JSON document).
+# ---------------------------------------------------------------------------
+UPLINK_ENCODER = "template"
+
+DEVICE_ID = object()  # layout source: the publishing device's id
+Const = collections.namedtuple("Const", "value")  # layout source: a fixed value
+
+def _whole_state_layout(device):
+    """Layout that publishes every field of the device state, in state order."""
+    return [(field, field) for field in new_apartment_state("", {"rooms": []})[device]]
+
+# device type -> [(payload key, state field | DEVICE_ID | Const(value)[, default if field missing])]
+UPLINK_LAYOUTS = {
+    "aqi": [("id", DEVICE_ID), ("gid", DEVICE_ID), ("temperature", "temp"), ("humidity", "humd"),
+            ("co2", "co2"), ("battery", "battery"), ("sensor_name", Const("AQI"))],
+    "wallswitch": [("id", DEVICE_ID), ("gid", DEVICE_ID), ("current", "current"), ("voltage", "voltage"),
+                   ("active_power", "active_power"), ("power_consumption", "power_consumption"),
+                   ("power_factor", "power_factor"), ("switch_1", "switch_1"), ("switch_2", "switch_2"),
+                   ("sensor_name", Const("Switch"))],
+    "wallsocket": [("id", DEVICE_ID), ("gid", DEVICE_ID), ("current", "current"), ("voltage", "voltage"),
+                   ("active_power", "active_power"), ("power_consumption", "power_consumption"),
+                   ("power_factor", "power_factor"), ("socket_status", "socket_status"),
+                   ("sensor_name", Const("Socket"))],
+    "curtain": [("id", DEVICE_ID), ("gid", DEVICE_ID), ("battery", "battery"), ("curtainstate", "curtainstate"),
+                ("sensor_name", Const("CurtainController"))],
+    "peoplecounter": [("total_in", "total_in"), ("total_out", "total_out"), ("period_in", "period_in"),
+                      ("period_out", "period_out"), ("battery", "battery"), ("temperature", "temperature")],
+    "doorlock": [(field, field) for field in ("id", "t", "battery", "remote_lock", "unlock_record", "alarm",
+                                              "auto_relock", "normally_open_mode", "tamper", "reporting_time",
+                                              "last_access_method", "last_access_user_id", "last_access_timestamp",
+                                              "last_manage_action", "last_manage_user_id")],
+    "scb": _whole_state_layout("scb"),
+    "watermeter": _whole_state_layout("watermeter"),
+    "gasmeter": _whole_state_layout("gasmeter"),
+    "thermostat": [("temperature", "temperature"), ("humidity", "humidity"),
+                   ("setpoint_temperature", "setpoint_temperature"),
+                   ("setpoint_timestamp", "last_setpoint_timestamp", ""), ("mode", "mode"), ("status", "status"),
+                   ("fan_setting", "fan_setting"), ("valve_status", "valve_status"), ("fan_status", "fan_status"),
+                   ("co2", "co2"), ("power", "power")],
+}
+# these publish the whole state dict; fall back to json.dumps if its fields ever differ from the layout
+WHOLE_STATE_UPLINKS = {"scb", "watermeter", "gasmeter"}
+
+def _json_float(value):
+    # json.dumps spells the non-finite floats NaN / Infinity / -Infinity
+    return float.__repr__(value) if math.isfinite(value) else json.dumps(value)
+
+_JSON_SCALARS = {
+    str: json.encoder.encode_basestring_ascii,
+    int: int.__repr__,
+    float: _json_float,
+    bool: {True: "true", False: "false"}.__getitem__,
+    type(None): {None: "null"}.__getitem__,
+}
+# the serializers format floats with plain repr() and check the text for a
+# non-finite value afterwards, which is cheaper than testing every float
+_TEMPLATE_SCALARS = {**_JSON_SCALARS, float: float.__repr__}
+
+def _json_default(value):
+    # numpy scalars (e.g. written by a --numpy pass) encode as the Python value they hold
+    if np is not None and isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _json_value(value):
+    """`value` encoded exactly as json.dumps() writes it."""
+    encode = _JSON_SCALARS.get(type(value))
+    return encode(value) if encode else json.dumps(value, default=_json_default)
+
+class UplinkSerializer:
+    """One device type's payload layout, compiled to a format template.
+
+    Keys and constant values are encoded once into the template; every other
+    slot (state fields and the device id) is JSON-encoded on each call by
+    value type, so bools, None, NaN and numpy scalars give the same text as
+    json.dumps. A state missing a layout field falls back to building the
+    dict and json.dumps.
+    """
+
+    def __init__(self, layout, whole_state=False):
+        self.layout = layout
+        self.whole_state = whole_state
+        self.fields = []
+        self.id_slots = []  # %s slots taking the device id
+        parts = []
+        slot = 0
+        for key, source, *default in layout:
+            if isinstance(source, Const):
+                value = json.dumps(source.value).replace("%", "%%")
+            else:
+                if source is DEVICE_ID:
+                    self.id_slots.append(slot)
+                else:
+                    self.fields.append(source)
+                value, slot = "%s", slot + 1
+            parts.append(f"{json.dumps(key).replace('%', '%%')}: {value}")
+        self.template = "{" + ", ".join(parts) + "}"
+        self._get = operator.itemgetter(*self.fields) if len(self.fields) > 1 else (
+            lambda state, field=self.fields[0]: (state[field],))
+
+    def payload(self, state, device_id, fields=None):
+        """The uplink as a dict, in layout order; only the id/constant keys and `fields` if given."""
+        if self.whole_state:
+            return dict(state) if fields is None else {k: v for k, v in state.items() if k in fields}
+        payload = {}
+        for key, source, *default in self.layout:
+            if isinstance(source, Const):
+                payload[key] = source.value
+            elif source is DEVICE_ID:
+                payload[key] = device_id
+            elif fields is None or source in fields:
+                payload[key] = state.get(source, default[0] if default else None)
+        return payload
+
+    def values(self, state):
+        """The state fields this uplink reports, as a tuple in self.fields order."""
+        try:
+            return tuple(self._get(state))
+        except KeyError:
+            return tuple(state.get(field) for field in self.fields)
+
+    def __call__(self, state, device_id):
+        """The uplink as a JSON string."""
+        if self.whole_state and len(state) != len(self.fields):
+            return json.dumps(dict(state), default=_json_default)
+        try:
+            values = self._get(state)
+        except KeyError:
+            return json.dumps(self.payload(state, device_id), default=_json_default)
+        encoders = _TEMPLATE_SCALARS
+        args = [(encoders.get(type(value)) or _json_value)(value) for value in values]
+        if self.id_slots:
+            encoded_id = _json_value(device_id)
+            for slot in self.id_slots:
+                args.insert(slot, encoded_id)
+        text = self.template % tuple(args)
+        if "nan" in text or "inf" in text:
+            return json.dumps(self.payload(state, device_id), default=_json_default)
+        return text
+
+UPLINK_SERIALIZERS = {
+    device: UplinkSerializer(layout, device in WHOLE_STATE_UPLINKS) for device, layout in UPLINK_LAYOUTS.items()
+}
+
+def serialize_uplink(device, device_id, state):
+    """Encode one uplink payload for `device` with the configured UPLINK_ENCODER."""
+    serializer = UPLINK_SERIALIZERS[device]
+    if UPLINK_ENCODER == "template":
+        return serializer(state, device_id)
+    if UPLINK_ENCODER == "orjson":
+        return orjson.dumps(serializer.payload(state, device_id), default=_json_default).decode()
+    return json.dumps(serializer.payload(state, device_id), default=_json_default)
+
+# ---------------------------------------------------------------------------
+# Report on change (--report-on-change)
+# By default every tick sends the device's full payload. With
+# REPORT_ON_CHANGE a tick only sends an uplink when a payload field differs
+# from what was last sent on that topic, or as a full-payload heartbeat once
+# REPORT_MAX_INTERVAL simulated seconds have passed since the last full one.
+# REPORT_DELTAS sends just the changed fields between heartbeats, plus the
+# id and constant keys and the identifying fields in REPORT_DELTA_KEYS.
+# Fields in REPORT_NOISY_FIELDS (battery jitter and decay) and
+# REPORT_IGNORE_FIELDS (reading timestamps) are sent along but do not make a
+# device dirty by themselves, so an idle device stays quiet until its
+# heartbeat.
+# ---------------------------------------------------------------------------
+REPORT_ON_CHANGE = False
+REPORT_MAX_INTERVAL = 300  # simulated seconds between full payloads; 0 disables the heartbeat
+REPORT_DELTAS = False
+REPORT_NOISY_FIELDS = {"battery"}
+REPORT_IGNORE_FIELDS = {"doorlock": {"t"}}
+REPORT_DELTA_KEYS = {"doorlock": {"id"}, "scb": {"device_type", "breaker_address"},
+                     "watermeter": {"device_type", "id"}, "gasmeter": {"device_type", "id"}}
+
+def report_settings():
+    """REPORT_* globals to hand to shard / state service processes."""
+    return {"REPORT_ON_CHANGE": REPORT_ON_CHANGE, "REPORT_MAX_INTERVAL": REPORT_MAX_INTERVAL,
+            "REPORT_DELTAS": REPORT_DELTAS}
+
+# scheduler threads of different apartments (different lock stripes) share these, so they are guarded by report_lock
+report_lock = threading.Lock()
+reported_uplinks = {}  # topic -> (field values last sent, simulated time of the last full payload)
+uplinks_unchanged = 0  # ticks that sent nothing because the device was clean
+
+def changed_uplink(device, topic, device_id, state):
+    """Payload to send on `topic` under report-on-change, or None while the device is clean."""
+    global uplinks_unchanged
+    serializer = UPLINK_SERIALIZERS[device]
+    values = serializer.values(state)
+    now = sim_clock.time()
+    ignored = REPORT_NOISY_FIELDS | REPORT_IGNORE_FIELDS.get(device, set())
+    with report_lock:
+        last = reported_uplinks.get(topic)
+        if last is None or (REPORT_MAX_INTERVAL and now - last[1] >= REPORT_MAX_INTERVAL):
+            reported_uplinks[topic] = (values, now)
+            changed = None
+        else:
+            changed = {field for field, old, new in zip(serializer.fields, last[0], values) if old != new}
+            if changed <= ignored:
+                uplinks_unchanged += 1
+                return None
+            reported_uplinks[topic] = (values, last[1])
+    if changed is None or not REPORT_DELTAS:
+        return serialize_uplink(device, device_id, state)
+    delta = serializer.payload(state, device_id, changed | REPORT_DELTA_KEYS.get(device, set()))
+    if UPLINK_ENCODER == "orjson":
+        return orjson.dumps(delta, default=_json_default).decode()
+    return json.dumps(delta, default=_json_default)
+
+# ---------------------------------------------------------------------------
+# Uplink batching
+# A tick serializes all uplinks of its device (every room of a wallswitch,
+# every apartment of a vectorized pass) under one lock acquisition into a
+# list of (topic, payload) pairs, and hands the whole list to
+# publish_uplinks(). Pending uplinks wait up to UPLINK_COALESCE_WINDOW in an
+# outbox keyed by topic: when a control command's follow-up uplink and a
+# scheduled tick report the same device within the window, only the newest
+# payload is sent. One flush then queues the outbox as a single batch that an
+# MQTT sender publishes in one pass.
+# ---------------------------------------------------------------------------
+UPLINK_COALESCE_WINDOW = 0.05  # simulated seconds; 0 queues every batch at once, without coalescing
+
+# APARTMENTS key holding each device type's id (default: "<device>_device_id")
+DEVICE_ID_KEYS = {"aqi": "aqi_device_id", "wallswitch": "switch_device_id", "wallsocket": "socket_device_id"}
+
+uplink_outbox = {}  # topic -> (newest pending message, simulated time it was added)
+outbox_lock = threading.Lock()
+uplinks_coalesced = 0  # payloads replaced by a newer one before they were sent
+
+def device_uplinks(device, apt, rooms=None):
+    """(topic, payload, qos, retain) of every uplink `device` sends for `apt`; the caller holds state_lock(apt)."""
+    device_id = APARTMENTS[apt].get(DEVICE_ID_KEYS.get(device, f"{device}_device_id"))
+    if not device_id:
+        return []
+    qos, retain = DEVICE_QOS.get(device, 0), DEVICE_RETAIN.get(device, False)
+    if device == "wallswitch":
+        # one uplink per room switch
+        switches = latest_data[apt]["wallswitch"]
+        sources = [(f"{device_id}_{room}", switches[room])
+                   for room in (APARTMENTS[apt]["rooms"] if rooms is None else rooms)]
+    else:
+        sources = [(device_id, latest_data[apt][device])]
+    if not REPORT_ON_CHANGE:
+        messages = [(f"sim/{uplink_id}/uplink", serialize_uplink(device, uplink_id, state), qos, retain)
+                    for uplink_id, state in sources]
+    else:
+        messages = []
+        for uplink_id, state in sources:
+            topic = f"sim/{uplink_id}/uplink"
+            payload = changed_uplink(device, topic, uplink_id, state)
+            if payload is not None:
+                messages.append((topic, payload, qos, retain))
+    uplinks_total.inc(device, amount=len(messages))
+    return messages
+
+def publish_uplinks(messages):
+    """Add uplink messages to the outbox, replacing pending payloads on the same topics."""
+    global uplinks_coalesced
+    if not messages:
+        return
+    if not UPLINK_COALESCE_WINDOW:
+        flush_uplinks(messages)
+        return
+    now = sim_clock.time()
+    expired = []
+    with outbox_lock:
+        arm = not uplink_outbox
+        for message in messages:
+            pending = uplink_outbox.get(message[0])
+            if pending is not None:
+                if now - pending[1] <= UPLINK_COALESCE_WINDOW and not REPORT_DELTAS:
+                    uplinks_coalesced += 1
+                else:
+                    # a tick that ran late (e.g. catching up at --speed), or a delta payload:
+                    # a newer message does not carry its fields
+                    expired.append(pending[0])
+            uplink_outbox[message[0]] = (message, now)
+    if expired:
+        flush_uplinks(expired)
+    if arm:
+        schedule(UPLINK_COALESCE_WINDOW, flush_uplinks)
+
+def flush_uplinks(messages=None):
+    """Queue the outbox (or `messages`) on the MQTT pool as one batch."""
+    global uplink_outbox
+    if messages is None:
+        with outbox_lock:
+            pending, uplink_outbox = uplink_outbox, {}
+        messages = [message for message, _ in pending.values()]
+    try:
+        mqtt_publish_batch(messages)
+    except RuntimeError as e:
+        print(f"[MQTT publish error] {e}")
+
+def publish_device(device, apt):
+    with state_lock(apt):
+        messages = device_uplinks(device, apt)
+    publish_uplinks(messages)
+
+def publish_wallswitch(apt_name, room):
+    with state_lock(apt_name):
+        messages = device_uplinks("wallswitch", apt_name, [room])
+    publish_uplinks(messages)
+
+def update_aqi(apt):
+    rng = sim_random(apt, "aqi")
+    with state_lock(apt), track_changes(apt, "aqi"):
+        latest_data[apt]["aqi"]["temp"] = round(rng.uniform(20, 30), 1)
+        latest_data[apt]["aqi"]["humd"] = rng.randint(40, 80)
+        latest_data[apt]["aqi"]["co2"] = rng.randint(300, 1000)
+        latest_data[apt]["aqi"]["battery"] = rng.randint(50, 100)
+
+def update_wallswitch(apt):
+    rng = sim_random(apt, "wallswitch")
+    for room in APARTMENTS[apt]["rooms"]:
+        with state_lock(apt), track_changes(apt, "wallswitch", room):
+            latest_data[apt]["wallswitch"][room]["current"] = rng.randint(200, 300)
+            latest_data[apt]["wallswitch"][room]["voltage"] = round(rng.uniform(230, 250), 1)
+            latest_data[apt]["wallswitch"][room]["active_power"] = rng.randint(0, 100)
+            latest_data[apt]["wallswitch"][room]["power_consumption"] = rng.randint(90000, 100000)
+            latest_data[apt]["wallswitch"][room]["power_factor"] = rng.randint(50, 100)
+
+def update_wallsocket(apt):
+    rng = sim_random(apt, "wallsocket")
+    with state_lock(apt), track_changes(apt, "wallsocket"):
+        latest_data[apt]["wallsocket"]["current"] = rng.randint(200, 300)
+        latest_data[apt]["wallsocket"]["voltage"] = round(rng.uniform(230, 250), 1)
+        latest_data[apt]["wallsocket"]["active_power"] = rng.randint(0, 100)
+        latest_data[apt]["wallsocket"]["power_consumption"] = rng.randint(90000, 100000)
+        latest_data[apt]["wallsocket"]["power_factor"] = rng.randint(50, 100)
+
+def update_curtain(apt):
+    rng = sim_random(apt, "curtain")
+    with state_lock(apt), track_changes(apt, "curtain"):
+        latest_data[apt]["curtain"]["battery"] = rng.randint(50, 100)
+        # curtainstate remains as set unless changed by PUT; keep current value
+
+def update_peoplecounter(apt):
+    rng = sim_random(apt, "peoplecounter")
+    with state_lock(apt), track_changes(apt, "peoplecounter"):
+        # increment totals a bit to simulate accumulation
+        latest_data[apt]["peoplecounter"]["total_in"] += rng.randint(0, 3)
+        latest_data[apt]["peoplecounter"]["total_out"] += rng.randint(0, 3)
+        latest_data[apt]["peoplecounter"]["period_in"] = rng.randint(0, 30)
+        latest_data[apt]["peoplecounter"]["period_out"] = rng.randint(0, 30)
+        latest_data[apt]["peoplecounter"]["battery"] = max(0, latest_data[apt]["peoplecounter"]["battery"] - rng.randint(0, 1))
+        latest_data[apt]["peoplecounter"]["temperature"] = round(rng.uniform(20.0, 30.0), 1)
+        # maintain computed count field (in - out) and ensure non-negative
+        latest_data[apt]["peoplecounter"]["count"] = max(0, latest_data[apt]["peoplecounter"]["total_in"] - latest_data[apt]["peoplecounter"]["total_out"])
+
+def update_doorlock(apt):
+    rng = sim_random(apt, "doorlock")
+    with state_lock(apt), track_changes(apt, "doorlock"):
+        dl = latest_data[apt]["doorlock"]
+        
+        # --- NEW LOGIC START ---
+        # 1. Get Configuration
+        # normally_open_mode: 0=Disabled, 1=Mode 1 (Permanent), 2=Mode 2 (Delayed)
+        norm_open = dl.get('normally_open_mode', 0)
+        
+        # auto_relock: Time in seconds before door locks
+        # honor explicit enable/disable flag: if auto_relock_enabled is False -> no auto-relocK
+        relock_enabled = dl.get('auto_relock_enabled', True)
+        relock_time = dl.get('auto_relock', 0) if relock_enabled else None
+        # default short relock_time only when field is missing and enabled
+        if relock_enabled and (not relock_time):
+            relock_time = 5
+
+        # 2. Determine Status
+        calculated_status = 1  # Default to 1 = Locked
+
+        # Priority 1: Normally Open Mode forces UNLOCKED
+        if norm_open > 0:
+            calculated_status = 0  # 0 = Unlocked
+        else:
+            # If last action was a remote control, honor remote_lock intent.
+            last_method = dl.get('last_access_method', '')
+            last_access = dl.get('last_access_timestamp')
+
+            # Helper to compute elapsed seconds safely
+            def _elapsed_seconds(ts):
+                try:
+                    last_ts = datetime.fromisoformat(ts)
+                    return (sim_clock.now() - last_ts).total_seconds()
+                except Exception:
+                    return None
+
+            # Case: remote control command - explicit lock/unlock
+            if last_method == 'remote':
+                # remote_lock: 1 = remote-unlock request, 0 = remote-lock request
+                if dl.get('remote_lock') == 1:
+                    # If relock is disabled, remain unlocked until explicit lock
+                    if relock_time is None:
+                        calculated_status = 0
+                    else:
+                        # if within relock window, consider unlocked; otherwise re-lock
+                        elapsed = _elapsed_seconds(last_access) if last_access else None
+                        if elapsed is None or elapsed < relock_time:
+                            calculated_status = 0
+                        else:
+                            calculated_status = 1
+                else:
+                    # explicit remote lock -> locked immediately
+                    calculated_status = 1
+            else:
+                # Non-remote access (manual, card, password) uses transient unlock window
+                if last_access:
+                    # if relock disabled: once unlocked by access event, remain unlocked
+                    if relock_time is None:
+                        calculated_status = 0
+                    else:
+                        elapsed = _elapsed_seconds(last_access)
+                        if elapsed is not None and elapsed < relock_time:
+                            calculated_status = 0
+
+        # 3. Store the status
+        # 1 = Locked, 0 = Unlocked (Standard convention for door sensors)
+        dl["current_status"] = calculated_status
+        # --- NEW LOGIC END ---
+
+        # Existing updates (timestamp, slight battery decay)
+        dl["t"] = sim_clock.isoformat()
+        dl["battery"] = max(0, dl["battery"] - rng.randint(0, 1))
+        
+
+def update_scb(apt):
+    rng = sim_random(apt, "scb")
+    with state_lock(apt), track_changes(apt, "scb"):
+        scb = latest_data[apt]["scb"]
+        # simulate small fluctuations
+        scb["voltage_A"] = round(scb["voltage_A"] + rng.uniform(-1.0, 1.0), 1)
+        scb["voltage_B"] = round(scb["voltage_B"] + rng.uniform(-1.0, 1.0), 1)
+        scb["voltage_C"] = round(scb["voltage_C"] + rng.uniform(-1.0, 1.0), 1)
+        scb["current_A"] = round(max(0.0, scb["current_A"] + rng.uniform(-0.5, 0.5)), 2)
+        scb["current_B"] = round(max(0.0, scb["current_B"] + rng.uniform(-0.5, 0.5)), 2)
+        scb["current_C"] = round(max(0.0, scb["current_C"] + rng.uniform(-0.5, 0.5)), 2)
+        scb["power_A"] = round(scb["current_A"] * scb["voltage_A"], 1)
+        scb["power_B"] = round(scb["current_B"] * scb["voltage_B"], 1)
+        scb["power_C"] = round(scb["current_C"] * scb["voltage_C"], 1)
+        scb["power_total"] = round(scb["power_A"] + scb["power_B"] + scb["power_C"], 1)
+        scb["temperature_device"] = rng.randint(20, 40)
+
+def update_watermeter(apt):
+    rng = sim_random(apt, "watermeter")
+    with state_lock(apt), track_changes(apt, "watermeter"):
+        latest_data[apt]["watermeter"]["volume"] = round(latest_data[apt]["watermeter"]["volume"] + rng.uniform(0.0, 2.0), 2)
+        # battery slowly decays
+        latest_data[apt]["watermeter"]["battery"] = max(0, latest_data[apt]["watermeter"]["battery"] - rng.randint(0, 1))
+
+def update_gasmeter(apt):
+    rng = sim_random(apt, "gasmeter")
+    with state_lock(apt), track_changes(apt, "gasmeter"):
+        latest_data[apt]["gasmeter"]["volume"] = round(latest_data[apt]["gasmeter"]["volume"] + rng.uniform(0.0, 5.0), 2)
+        latest_data[apt]["gasmeter"]["battery"] = max(0, latest_data[apt]["gasmeter"]["battery"] - rng.randint(0, 1))
+
+def update_thermostat(apt):
+    rng = sim_random(apt, "thermostat")
+    with state_lock(apt), track_changes(apt, "thermostat"):
+        th = latest_data[apt]["thermostat"]
+        # small random walk around temperature and humidity
+        th["temperature"] = round(th["temperature"] + rng.uniform(-0.3, 0.3), 1)
+        th["humidity"] = max(0, min(100, th["humidity"] + rng.randint(-1, 1)))
+        th["co2"] = max(200, th["co2"] + rng.randint(-5, 5))
+        # fan_status follows fan_setting
+        th["fan_status"] = th["fan_setting"]
+
+# Updater registry: device type -> per-apartment state update
+DEVICE_UPDATERS = {
+    "aqi": update_aqi,
+    "wallswitch": update_wallswitch,
+    "wallsocket": update_wallsocket,
+    "curtain": update_curtain,
+    "peoplecounter": update_peoplecounter,
+    "doorlock": update_doorlock,
+    "scb": update_scb,
+    "watermeter": update_watermeter,
+    "gasmeter": update_gasmeter,
+    "thermostat": update_thermostat,
+}
+
+def tick_uplinks(device, apt):
+    """Advance the device's simulated readings and return its uplink messages."""
+    with state_lock(apt):
+        DEVICE_UPDATERS[device](apt)
+        return device_uplinks(device, apt)
+
+@contextlib.contextmanager
+def timed_tick(device):
+    """Record a scheduled tick's lag behind its deadline (sim_clock.time() inside ticking()) and its duration."""
+    tick_lag_seconds.observe(sim_clock.elapsed() - sim_clock.time(), device)
+    start = time.perf_counter()
+    yield
+    tick_seconds.observe(time.perf_counter() - start, device)
+
+def tick_device(device, apt):
+    """One scheduled tick: advance the device's simulated readings, then send its uplinks."""
+    with timed_tick(device):
+        publish_uplinks(tick_uplinks(device, apt))
+
+# ---------------------------------------------------------------------------
+# Vectorized updates (--numpy, implies --state-backend columnar)
+# Advances one device type for every apartment at once with one NumPy
+# operation per field, using the same ranges, clamps and rounding as the
+# update_* functions above. Each such device type is then a single scheduler
+# entry per interval instead of one entry per apartment. doorlock has no
+# vectorized form (its relock logic is per-apartment) and keeps per-apartment
+# ticks.
+# ---------------------------------------------------------------------------
+VECTORIZED = False
+np_rng = np.random.default_rng() if np is not None else None
+_vector_streams = {}
+
+def vector_rng(device):
+    """NumPy generator for a vectorized pass over `device`: one seeded stream per device type with --seed."""
+    if SIM_SEED is None:
+        return np_rng
+    if device not in _vector_streams:
+        _vector_streams[device] = np.random.default_rng([zlib.crc32(f"{SIM_SEED}:{device}".encode())])
+    return _vector_streams[device]
+
+_NUMPY_DTYPES = {"b": "int8", "q": "int64", "d": "float64"}
+
+def _column_view(table, field):
+    """Writable NumPy view over a typed DeviceColumns column (no copy)."""
+    column = table.columns[field]
+    if not isinstance(column, array.array):
+        raise TypeError(f"column {field!r} holds mixed types and cannot be updated vectorized")
+    return np.frombuffer(column, dtype=_NUMPY_DTYPES[column.typecode])
+
+def _columns(table, *fields):
+    return [_column_view(table, f) for f in fields]
+
+def vector_update_aqi(t, n, rng):
+    temp, humd, co2, battery = _columns(t, "temp", "humd", "co2", "battery")
+    temp[:] = np.round(rng.uniform(20, 30, n), 1)
+    humd[:] = rng.integers(40, 80, n, endpoint=True)
+    co2[:] = rng.integers(300, 1000, n, endpoint=True)
+    battery[:] = rng.integers(50, 100, n, endpoint=True)
+
+def _vector_update_power_meter(t, n, rng):
+    # shared by the per-room wall switches and the wall socket
+    current, voltage, active_power, consumption, power_factor = _columns(
+        t, "current", "voltage", "active_power", "power_consumption", "power_factor")
+    current[:] = rng.integers(200, 300, n, endpoint=True)
+    voltage[:] = np.round(rng.uniform(230, 250, n), 1)
+    active_power[:] = rng.integers(0, 100, n, endpoint=True)
+    consumption[:] = rng.integers(90000, 100000, n, endpoint=True)
+    power_factor[:] = rng.integers(50, 100, n, endpoint=True)
+
+def vector_update_curtain(t, n, rng):
+    battery, = _columns(t, "battery")
+    battery[:] = rng.integers(50, 100, n, endpoint=True)
+
+def vector_update_peoplecounter(t, n, rng):
+    total_in, total_out, period_in, period_out, battery, temperature, count = _columns(
+        t, "total_in", "total_out", "period_in", "period_out", "battery", "temperature", "count")
+    total_in += rng.integers(0, 3, n, endpoint=True)
+    total_out += rng.integers(0, 3, n, endpoint=True)
+    period_in[:] = rng.integers(0, 30, n, endpoint=True)
+    period_out[:] = rng.integers(0, 30, n, endpoint=True)
+    battery[:] = np.maximum(0, battery - rng.integers(0, 1, n, endpoint=True))
+    temperature[:] = np.round(rng.uniform(20.0, 30.0, n), 1)
+    count[:] = np.maximum(0, total_in - total_out)
+
+def vector_update_scb(t, n, rng):
+    powers = []
+    for phase in "ABC":
+        voltage, current, power = _columns(t, f"voltage_{phase}", f"current_{phase}", f"power_{phase}")
+        voltage[:] = np.round(voltage + rng.uniform(-1.0, 1.0, n), 1)
+        current[:] = np.round(np.maximum(0.0, current + rng.uniform(-0.5, 0.5, n)), 2)
+        power[:] = np.round(current * voltage, 1)
+        powers.append(power)
+    power_total, temperature_device = _columns(t, "power_total", "temperature_device")
+    power_total[:] = np.round(powers[0] + powers[1] + powers[2], 1)
+    temperature_device[:] = rng.integers(20, 40, n, endpoint=True)
+
+def _vector_update_meter(t, n, rng, max_step):
+    volume, battery = _columns(t, "volume", "battery")
+    volume[:] = np.round(volume + rng.uniform(0.0, max_step, n), 2)
+    battery[:] = np.maximum(0, battery - rng.integers(0, 1, n, endpoint=True))
+
+def vector_update_thermostat(t, n, rng):
+    temperature, humidity, co2 = _columns(t, "temperature", "humidity", "co2")
+    temperature[:] = np.round(temperature + rng.uniform(-0.3, 0.3, n), 1)
+    humidity[:] = np.clip(humidity + rng.integers(-1, 1, n, endpoint=True), 0, 100)
+    co2[:] = np.maximum(200, co2 + rng.integers(-5, 5, n, endpoint=True))
+    # fan_status follows fan_setting
+    t.columns["fan_status"][:] = t.columns["fan_setting"]
+
+VECTOR_UPDATERS = {
+    "aqi": vector_update_aqi,
+    "wallswitch": _vector_update_power_meter,
+    "wallsocket": _vector_update_power_meter,
+    "curtain": vector_update_curtain,
+    "peoplecounter": vector_update_peoplecounter,
+    "scb": vector_update_scb,
+    "watermeter": lambda t, n, rng: _vector_update_meter(t, n, rng, 2.0),
+    "gasmeter": lambda t, n, rng: _vector_update_meter(t, n, rng, 5.0),
+    "thermostat": vector_update_thermostat,
+}
+
+def _snapshot_columns(table):
+    return {f: c.copy() if isinstance(c, list) else _column_view(table, f).copy() for f, c in table.columns.items()}
+
+def _record_column_changes(device, table, before):
+    # column-wise equivalent of track_changes(); caller holds all_state_locks()
+    global change_version
+    deltas = []
+    for field, old in before.items():
+        column = table.columns[field]
+        if isinstance(column, list):
+            rows = [i for i, (a, b) in enumerate(zip(old, column)) if a != b]
+            values = [column[i] for i in rows]
+        else:
+            new = _column_view(table, field)
+            rows = np.flatnonzero(old != new).tolist()
+            values = new[rows].tolist()
+            if column.typecode == "b":
+                values = [bool(v) for v in values]
+        deltas.extend(zip(rows, itertools.repeat(field), values))
+    if not deltas:
+        return
+    if device == "wallswitch":
+        owners, rooms = latest_data.ws_apartments, latest_data.ws_rooms
+    else:
+        owners, rooms = latest_data.row_apartments, None
+    with change_cond:
+        # deltas beyond the log size would be evicted immediately; just account for their versions
+        skipped = max(0, len(deltas) - CHANGE_LOG_SIZE)
+        change_version += skipped
+        for row, field, value in itertools.islice(deltas, skipped, None):
+            change_version += 1
+            change_log.append((change_version, owners[row], device, f"{rooms[row]}.{field}" if rooms else field, value))
+        change_cond.notify_all()
+        _notify_async_changes()
+
+def advance_vectorized(device):
+    """Advance `device` for every apartment in one batched pass."""
+    with all_state_locks():
+        table = latest_data.tables[device]
+        before = _snapshot_columns(table)
+        VECTOR_UPDATERS[device](table, table.rows, vector_rng(device))
+        _record_column_changes(device, table, before)
+
+def tick_vectorized(device):
+    with timed_tick(device):
+        with all_state_locks():
+            advance_vectorized(device)
+            messages = [message for apt in list(APARTMENTS) for message in device_uplinks(device, apt)]
+        publish_uplinks(messages)
+
+# ---------------------------------------------------------------------------
+# Device tick scheduler
+# One min-heap of (run at, seq, fn, args, interval, deadline) entries drained
+# by a fixed pool of SCHEDULER_THREADS workers. Times and intervals are
+# simulated seconds on sim_clock; a tick runs pinned to its deadline, and
+# "run at" only differs from it while the spread policy paces a backlog.
+# Every (device type, apartment) pair is its own periodic entry; start
+# offsets are spread evenly over the interval so ticks trickle out instead of
+# all apartments waking at once.
+#
+# Periodic entries are re-armed against absolute deadlines, so the period
+# never drifts with the work done. A tick whose deadline is a whole interval
+# or more in the past when it comes up is an overrun: the pass over the
+# apartments did not fit in the interval. TICK_OVERRUN_POLICY decides what
+# happens to the missed slots:
+#   compress  run every missed slot back to back until caught up (a burst)
+#   skip      run only the latest due slot and drop the older ones (gaps, but
+#             the uplink rate never exceeds the configured one)
+#   spread    run every missed slot, at most two per interval per entry, so
+#             the backlog is worked off over the following intervals
+# Overruns are counted in /metrics and summarized in the log every
+# OVERRUN_LOG_INTERVAL seconds.
+# ---------------------------------------------------------------------------
+TICK_OVERRUN_POLICY = "compress"  # "compress", "skip" or "spread" (--overrun)
+OVERRUN_LOG_INTERVAL = 10  # real seconds between overrun summaries per device type
+
+scheduler_heap = []
+scheduler_cond = threading.Condition()
+_scheduler_seq = itertools.count()
+
+_overrun_lock = threading.Lock()
+_overrun_log = {}  # device -> [overruns, slots skipped, most intervals behind, last summary (time.time())]
+
+def tick_overrun(device, deadline, interval, now):
+    """Whole intervals that have passed since a tick due at `deadline` (0 if it is on time); counts and logs overruns."""
+    missed = int((now - deadline) // interval) if interval else 0
+    if missed <= 0:
+        return 0
+    tick_overruns.inc(device)
+    if TICK_OVERRUN_POLICY == "skip":
+        ticks_skipped.inc(device, amount=missed)
+    with _overrun_lock:
+        entry = _overrun_log.setdefault(device, [0, 0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += missed if TICK_OVERRUN_POLICY == "skip" else 0
+        entry[2] = max(entry[2], (now - deadline) / interval)
+        wall = time.time()
+        if wall - entry[3] < OVERRUN_LOG_INTERVAL:
+            return missed
+        overruns, skipped, behind = entry[:3]
+        _overrun_log[device] = [0, 0, 0, wall]
+    action = f"dropped {skipped:,} slots" if TICK_OVERRUN_POLICY == "skip" else "catching up"
+    print(f"[scheduler] {device}: {overruns:,} ticks overran their {interval:g}s interval, up to {behind:.1f} "
+          f"intervals behind; {TICK_OVERRUN_POLICY}: {action}")
+    return missed
+
+def scheduled_ticks():
+    """Entries waiting in whichever scheduler is active (for the sim_scheduled_ticks gauge)."""
+    if event_loop is not None:
+        return loop_callbacks + sum(updater_slots.values())
+    return len(scheduler_heap)
+
+def _tick_device_name(fn, args):
+    return args[0] if args else getattr(fn, "__name__", str(fn))
+
+def schedule(delay, fn, *args, interval=None):
+    """Run fn(*args) after `delay` simulated seconds, then every `interval` simulated seconds if given."""
+    schedule_at(sim_clock.time() + delay, fn, *args, interval=interval)
+
+def schedule_at(deadline, fn, *args, interval=None):
+    """Like schedule(), at simulated time `deadline` (seconds since sim_clock.start)."""
+    global loop_callbacks
+    if event_loop is not None:
+        # asyncio runtime: the event loop is the scheduler
+        loop_callbacks += 1
+        event_loop.call_at(_loop_deadline(deadline), _loop_call, deadline, fn, args, interval)
+        return
+    with scheduler_cond:
+        heapq.heappush(scheduler_heap, (deadline, next(_scheduler_seq), fn, args, interval, deadline))
+        scheduler_cond.notify()
+
+def scheduler_worker():
+    while True:
+        with scheduler_cond:
+            while True:
+                now = sim_clock.time()
+                if scheduler_heap and scheduler_heap[0][0] <= now:
+                    break
+                scheduler_cond.wait(sim_clock.real_seconds(scheduler_heap[0][0] - now) if scheduler_heap else None)
+            _, _, fn, args, interval, deadline = heapq.heappop(scheduler_heap)
+        run_next = None
+        missed = tick_overrun(_tick_device_name(fn, args), deadline, interval, now)
+        if missed and TICK_OVERRUN_POLICY == "skip":
+            deadline += missed * interval
+        elif missed and TICK_OVERRUN_POLICY == "spread":
+            run_next = now + interval / 2
+        try:
+            with sim_clock.ticking(deadline):
+                fn(*args)
+        except Exception as e:
+            print(f"[scheduler error] {getattr(fn, '__name__', fn)}{args}: {e}")
+        if interval:
+            # re-arm against the absolute deadline so the period does not drift; re-arming only
+            # after the tick ran keeps a late entry from overlapping itself while it catches up
+            deadline += interval
+            with scheduler_cond:
+                heapq.heappush(scheduler_heap, (max(deadline, run_next or deadline), next(_scheduler_seq), fn, args,
+                                                interval, deadline))
+                scheduler_cond.notify()
+
+def start_scheduler():
+    apartments = list(APARTMENTS)
+    n_apts = len(apartments)
+    n_types = len(DEVICE_UPDATERS)
+    # slots are anchored at the start of simulated time, so a seeded run repeats exactly
+    for k, device in enumerate(DEVICE_UPDATERS):
+        interval = DEVICE_INTERVALS.get(device, DATA_SENDING_INTERVAL)
+        if VECTORIZED and device in VECTOR_UPDATERS:
+            schedule_at(interval * k / n_types, tick_vectorized, device, interval=interval)
+            continue
+        for i, apt in enumerate(apartments):
+            # interleave device types too, so slot i of every type does not coincide
+            offset = interval * (i * n_types + k) / (n_apts * n_types)
+            schedule_at(offset, tick_device, device, apt, interval=interval)
+    for _ in range(SCHEDULER_THREADS):
+        threading.Thread(target=scheduler_worker, daemon=True).start()
+
+# ---------------------------------------------------------------------------
+# Item name resolution
+# Item names do not depend on the apartment, so every name the API serves is
+# expanded once into ITEM_NAMES / SWITCH_ITEM_NAMES (name -> (device, field))
+# and a GET is a dict lookup instead of a walk down ~80 endswith() checks.
+# Besides the Postman names (AQI_temp, Thermostat_co2, ...) the bare names of
+# the apartment-wide AQI/socket/curtain fields are kept, because the old chain
+# matched any item ending in them. A name that misses is retried on its
+# "_"-separated tails, so prefixed names like Studio_Thermostat_co2 resolve too.
+# ---------------------------------------------------------------------------
+SWITCH_ITEM_FIELDS = ["current", "voltage", "active_power", "power_consumption", "power_factor", "switch_1", "switch_2"]
+
+def _item_names(device, fields, *prefixes):
+    """{prefix + suffix: (device, field)}; `fields` is a list or a {suffix: field} dict."""
+    if not isinstance(fields, dict):
+        fields = {field: field for field in fields}
+    return {prefix + suffix: (device, field) for prefix in prefixes for suffix, field in fields.items()}
+
+ITEM_NAMES = {
+    **_item_names("aqi", ["temp", "humd", "co2", "battery"], "", "AQI_"),
+    **_item_names("wallsocket", {"socket_current": "current", "socket_voltage": "voltage",
+                                 "socket_active_power": "active_power", "socket_power_consumption": "power_consumption",
+                                 "socket_power_factor": "power_factor", "socket_status": "socket_status"}, "", "WallSocket_"),
+    **_item_names("curtain", {"curtainstate": "curtainstate", "curtain_battery": "battery"}, "", "Curtain_"),
+    **_item_names("peoplecounter", ["total_in", "total_out", "period_in", "period_out", "battery", "temperature", "count"],
+                  "PeopleCounter_"),
+    **_item_names("scb", ["device_type", "breaker_address", "breaker_type", "switch_state", "remote_control_enabled",
+                          "voltage_A", "voltage_B", "voltage_C", "current_A", "current_B", "current_C",
+                          "power_total", "leakage_current", "temperature_device", "alarm_overload"], "CircuitBreaker_"),
+    **_item_names("thermostat", ["setpoint_temperature", "temperature", "humidity", "mode", "status", "fan_setting",
+                                 "valve_status", "fan_status", "co2", "power"], "Thermostat_"),
+    **_item_names("watermeter", ["volume", "valve_state", "battery", "low_power", "alarm", "communication_error"],
+                  "WaterMeter_"),
+    **_item_names("gasmeter", ["volume", "valve_state", "battery", "low_power", "alarm"], "GasMeter_"),
+    # any field of the door lock state, as DoorLock_door_<field>
+    **_item_names("doorlock", list(next(iter(latest_data.values()))["doorlock"]), "DoorLock_door_"),
+    # switch items live per room, see get_wallswitch_item_state
+    **{f"Switch_{field}": ("wallswitch", None) for field in SWITCH_ITEM_FIELDS},
+}
+
+SWITCH_ITEM_NAMES = _item_names("wallswitch", SWITCH_ITEM_FIELDS, "", "Switch_")
+
+def _lookup_item(names, item_name):
+    key = names.get(item_name)
+    while key is None and "_" in item_name:
+        item_name = item_name.split("_", 1)[1]
+        key = names.get(item_name)
+    return key
+
+def resolve_item(item_name):
+    """Map an apartment-level item name to (device, field), or None."""
+    return _lookup_item(ITEM_NAMES, item_name)
+
+def resolve_switch_item(item_name):
+    """Map a per-room wall switch item name to (device, field), or None."""
+    return _lookup_item(SWITCH_ITEM_NAMES, item_name)
+
+app = Flask(__name__)
+
+@app.before_request
+def _start_request_timer():
+    request.environ["sim.request_start"] = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    start = request.environ.get("sim.request_start")
+    if start is not None:
+        http_seconds.observe(time.perf_counter() - start, request.method,
+                             request.url_rule.rule if request.url_rule else "unmatched")
+    return response
+
+@app.route("/<apartment>/items/<item_name>/state", methods=["GET"])
+def get_item_state(apartment, item_name):
+    if apartment not in latest_data:
+        return "Apartment not found", 404
+
+    key = resolve_item(item_name)
+    if key is None:
+        return "Item not found", 404
+    device, field = key
+    if device == "wallswitch":
+        return "This switch item requires a room segment in the URL. Use /<apartment>/items/<item_name>/<room>/state", 400
+
+    with state_lock(apartment):
+        val = latest_data[apartment][device].get(field)
+    if val is None:
+        return "Item not found", 404
+    return str(val)
+
+@app.route("/<apartment>/items/<item_name>/<room>/state", methods=["GET"])
+def get_wallswitch_item_state(apartment, item_name, room):
+    if apartment not in latest_data:
+        return "Apartment not found", 404
+    if room not in APARTMENTS[apartment]["rooms"]:
+        return "Room not found", 404
+
+    key = resolve_switch_item(item_name)
+    if key is None:
+        return "Item not found", 404
+    with state_lock(apartment):
+        return str(latest_data[apartment]["wallswitch"][room][key[1]])
+
+def _parse_fields(fields_arg):
+    """Parse fields=aqi,scb.voltage_A,wallswitch.kitchen into {device: set(fields) or None}."""
+    projection = {}
+    for entry in fields_arg.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        device, _, field = entry.partition(".")
+        if field:
+            if projection.get(device, set()) is not None:
+                projection.setdefault(device, set()).add(field)
+        else:
+            projection[device] = None
+    return projection
+
+def _copy_state(value):
+    if isinstance(value, collections.abc.Mapping):
+        return {k: _copy_state(v) for k, v in value.items()}
+    return value
+
+def _snapshot_apartment(apt, projection):
+    # caller holds state_lock(apt)
+    data = latest_data[apt]
+    if not projection:
+        return _copy_state(data)
+    snapshot = {}
+    for device, fields in projection.items():
+        if device not in data:
+            continue
+        if fields is None:
+            snapshot[device] = _copy_state(data[device])
+        else:
+            snapshot[device] = {f: _copy_state(data[device][f]) for f in fields if f in data[device]}
+    return snapshot
+
+def _snapshot(apartments, fields_arg):
+    """Copy the state of `apartments`; each apartment is copied under one acquisition of its lock."""
+    projection = _parse_fields(fields_arg)
+    unknown = [d for d in projection if d not in DEVICE_UPDATERS]
+    if unknown:
+        return None, f"unknown device(s) in fields: {', '.join(unknown)}"
+    snapshot = {}
+    for apt in apartments:
+        with state_lock(apt):
+            snapshot[apt] = _snapshot_apartment(apt, projection)
+    return snapshot, None
+
+@app.route("/<apartment>/state", methods=["GET"])
+def get_apartment_state(apartment):
+    """Whole apartment state in one read. Optional fields=device[.field],... projection."""
+    if apartment not in latest_data:
+        return jsonify({'error': 'Apartment not found'}), 404
+    snapshot, error = _snapshot([apartment], request.args.get("fields", ""))
+    if error:
+        return jsonify({'error': error}), 400
+    return jsonify(snapshot[apartment])
+
+@app.route("/state", methods=["GET"])
+def get_all_state():
+    """State of every apartment, keyed by apartment name."""
+    snapshot, error = _snapshot(list(latest_data), request.args.get("fields", ""))
+    if error:
+        return jsonify({'error': error}), 400
+    return jsonify(snapshot)
+
+CHANGES_MAX_WAIT = 60  # seconds a long-poll request may block
+CHANGES_KEEPALIVE = 15  # seconds between SSE keep-alive comments
+
+def _changes_cursor():
+    # explicit ?since= wins; SSE clients reconnecting send Last-Event-ID
+    cursor = request.args.get("since", request.headers.get("Last-Event-ID"))
+    if cursor is None:
+        return change_version
+    return int(cursor)
+
+@app.route("/changes", methods=["GET"])
+def get_changes():
+    """Long-poll for state deltas newer than ?since=<version>.
+
+    Optional filters: apartment=<name>, device=<device>. Blocks up to
+    ?timeout=<seconds> (default 30) until at least one matching delta exists.
+    If the cursor is older than the retained log, "gap" is true and the client
+    should re-read /state before continuing from "version".
+    """
+    try:
+        since = _changes_cursor()
+        timeout = min(float(request.args.get("timeout", 30)), CHANGES_MAX_WAIT)
+    except ValueError:
+        return jsonify({'error': 'since and timeout must be numeric'}), 400
+    apartment = request.args.get("apartment")
+    device = request.args.get("device")
+    if apartment is not None and apartment not in latest_data:
+        return jsonify({'error': 'Apartment not found'}), 404
+
+    deadline = time.monotonic() + timeout
+    while True:
+        deltas, gap, head = changes_since(since, apartment, device)
+        remaining = deadline - time.monotonic()
+        if deltas or gap or remaining <= 0:
+            break
+        # nothing matched the filters up to head; wait for newer deltas
+        since = head
+        with change_cond:
+            change_cond.wait_for(lambda: change_version > since, remaining)
+    return jsonify({
+        "version": head,
+        "gap": gap,
+        "changes": [_delta_json(e) for e in deltas],
+    })
+
+@app.route("/changes/stream", methods=["GET"])
+def stream_changes():
+    """Server-Sent Events stream of state deltas (same filters as /changes).
+
+    Each event carries its version as the SSE id, so a reconnecting client
+    resumes automatically via Last-Event-ID.
+    """
     try:
-        publish.single(topic, message, hostname=MQTT_SERVER, port=MQTT_PORT)
-        threading.Timer(1.0, publish_gasmeter, args=(apartment,)).start()
-        with latest_data_lock:
-            new_state = latest_data[apartment]['gasmeter'].copy()
-        return jsonify({'status': f'gasmeter valve {state_str}', 'new_state': new_state}), 200
+        since = _changes_cursor()
+    except ValueError:
+        return jsonify({'error': 'since must be numeric'}), 400
+    apartment = request.args.get("apartment")
+    device = request.args.get("device")
+    if apartment is not None and apartment not in latest_data:
+        return jsonify({'error': 'Apartment not found'}), 404
+
+    def events(cursor):
+        while True:
+            deltas, gap, head = changes_since(cursor, apartment, device)
+            if gap:
+                yield f"event: gap\ndata: {json.dumps({'version': head})}\n\n"
+            for entry in deltas:
+                yield f"id: {entry[0]}\ndata: {json.dumps(_delta_json(entry))}\n\n"
+            cursor = head
+            with change_cond:
+                changed = change_cond.wait_for(lambda: change_version > cursor, CHANGES_KEEPALIVE)
+            if not changed:
+                yield ": keep-alive\n\n"
+
+    return Response(events(since), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ---------------------------------------------------------------------------
+# Downlink encoding
+# Most control commands come from small, fixed command spaces (on/off, a
+# curtain position, a switch bitmask byte, ...). Their base64 data and the
+# complete MQTT message bytes are built once here, so a control request only
+# does a table lookup. Open-ended commands (thermostat setpoint, doorlock
+# passwords and cards) go through encode_downlink() per request.
+# ---------------------------------------------------------------------------
+Downlink = collections.namedtuple("Downlink", "raw data payload")
+
+def encode_downlink(raw):
+    """Downlink for raw command bytes: base64 `data` plus the ready-to-send MQTT message."""
+    data = base64.b64encode(raw).decode()
+    payload = json.dumps({"confirmed": True, "fport": LORAWAN_FPORT, "data": data}).encode()
+    return Downlink(raw, data, payload)
+
+def _downlink_table(commands):
+    return {key: encode_downlink(raw) for key, raw in commands.items()}
+
+# switch_control byte (bits 4-7 select switches 1-4, bits 0-3 their new state)
+WALLSWITCH_DOWNLINKS = _downlink_table({control: bytes([8, control, 255]) for control in range(256)})
+WALLSOCKET_DOWNLINKS = _downlink_table({True: bytes([8, 1, 0, 255]), False: bytes([8, 0, 0, 255])})
+CURTAIN_DOWNLINKS = _downlink_table({pos: bytes([9, pos, 255]) for pos in range(101)})
+SCB_DOWNLINKS = _downlink_table({"on": bytes.fromhex('AA03010101FC0C55'), "off": bytes.fromhex('AA030101003DCC55')})
+# valve command byte uses 1 for OPEN, 0 for CLOSED per device spec
+WATERMETER_DOWNLINKS = _downlink_table({"OPEN": bytes([12, 1, 255]), "CLOSED": bytes([12, 0, 255])})
+GASMETER_DOWNLINKS = _downlink_table({"OPEN": bytes([13, 1, 255]), "CLOSED": bytes([13, 0, 255])})
+THERMOSTAT_POWER_DOWNLINKS = _downlink_table({"on": bytes([0x00, 0x01, 0x01]), "off": bytes([0x00, 0x01, 0x00])})
+THERMOSTAT_FAN_DOWNLINKS = _downlink_table({
+    fan: bytes([0x01, 0x01, code]) for fan, code in {'high': 0x00, 'medium': 0x01, 'low': 0x02, 'auto': 0x03}.items()})
+THERMOSTAT_MODE_DOWNLINKS = _downlink_table({
+    mode: bytes([0x02, 0x01, code])
+    for mode, code in {'off': 0x00, 'cool': 0x01, 'heat': 0x02, 'vent': 0x03, 'dehumidify': 0x04, 'auto': 0x05}.items()})
+# Command 0x36: 36 01 01 (unlock) or 36 01 00 (lock)
+DOORLOCK_REMOTE_DOWNLINKS = _downlink_table({"unlock": bytes.fromhex('360101'), "lock": bytes.fromhex('360100')})
+
+# ---------------------------------------------------------------------------
+# Downlink command dispatch
+# Control PUTs never wait on the broker: run_controls() queues the downlinks
+# of one or many commands as a single batch on the MQTT pool, arms each
+# device's follow-up uplink on the shared tick scheduler and hands back the
+# command ids at once. Each command record moves queued -> sent (or failed)
+# and gets `reported_at` once the follow-up uplink has been queued; poll it
+# at GET /commands/<id>. Record times are simulated time (sim_clock), like
+# uplinks and /changes.
+# ---------------------------------------------------------------------------
+COMMAND_HISTORY_SIZE = 10000  # command records kept for GET /commands/<id>
+UPLINK_AFTER_DOWNLINK = 1.0  # seconds before a device reports its new state
+
+command_records = collections.OrderedDict()
+commands_lock = threading.Lock()
+_command_ids = itertools.count(1)
+
+def new_command(apartment, device, topic, downlinks):
+    """Register a queued command with `downlinks` messages; returns its id."""
+    command_id = next(_command_ids)
+    record = {"id": command_id, "apartment": apartment, "device": device, "topic": topic,
+              "status": "queued", "downlinks": downlinks, "sent": 0,
+              "created_at": sim_clock.isoformat(), "sent_at": None, "reported_at": None, "error": None}
+    with commands_lock:
+        command_records[command_id] = record
+        while len(command_records) > COMMAND_HISTORY_SIZE:
+            command_records.popitem(last=False)
+    return command_id
+
+def fail_commands(command_ids, error):
+    with commands_lock:
+        for command_id in command_ids:
+            record = command_records.get(command_id)
+            if record is not None:
+                record["status"] = "failed"
+                record["error"] = error
+
+def downlink_sent(command_id, count=1):
+    """Called by the MQTT senders once `count` of a command's downlinks left for the broker."""
+    with commands_lock:
+        record = command_records.get(command_id)
+        if record is None:
+            return
+        record["sent"] += count
+        if record["sent"] >= record["downlinks"] and record["status"] == "queued":
+            record["status"] = "sent"
+            record["sent_at"] = sim_clock.isoformat()
+
+def report_command(command_id, publisher, args):
+    publisher(*args)
+    with commands_lock:
+        record = command_records.get(command_id)
+        if record is not None:
+            record["reported_at"] = sim_clock.isoformat()
+
+@app.route("/commands/<int:command_id>", methods=["GET"])
+def get_command(command_id):
+    with commands_lock:
+        record = command_records.get(command_id)
+        record = dict(record) if record is not None else None
+    if record is None:
+        return jsonify({'error': 'Command not found'}), 404
+    return jsonify(record)
+
+@app.route("/mqtt/stats", methods=["GET"])
+def get_mqtt_stats():
+    return jsonify(mqtt_stats())
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+class ControlError(Exception):
+    """A control request that cannot be applied; `status` is the HTTP code to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def control_plan(device, topic, messages, publisher, publisher_args, body):
+    """What a control_* function decided: downlinks to queue and the uplink to follow."""
+    return {"device": device, "topic": topic, "messages": messages,
+            "publisher": publisher, "publisher_args": publisher_args, "body": body}
+
+def run_controls(plans):
+    """Queue the downlinks of every (apartment, plan) pair as one MQTT batch.
+
+    Returns a (body, HTTP status) per plan: 202 with a command_id, 200 for a
+    state-only change, or 503 with the failed command_id when the outbound
+    queue is full. The plans' state changes are applied either way.
+    """
+    results, messages, commands = [], [], {}
+    for apartment, plan in plans:
+        body = plan["body"]
+        if not plan["messages"]:
+            # state-only change (no downlink): just let the device report it
+            schedule(UPLINK_AFTER_DOWNLINK, plan["publisher"], *plan["publisher_args"])
+            results.append((body, 200))
+            continue
+        body["command_id"] = new_command(apartment, plan["device"], plan["topic"], len(plan["messages"]))
+        commands[body["command_id"]] = len(plan["messages"])
+        messages.extend((plan["topic"], message, DOWNLINK_QOS, False) for message in plan["messages"])
+        results.append((body, 202))
+    if not commands:
+        return results
+    try:
+        mqtt_publish_batch(messages, commands)
+    except RuntimeError as e:
+        fail_commands(commands, str(e))
+        return [({'error': str(e), 'command_id': body['command_id']}, 503) if status == 202 else (body, status)
+                for body, status in results]
+    for (apartment, plan), (body, status) in zip(plans, results):
+        if status == 202:
+            schedule(UPLINK_AFTER_DOWNLINK, report_command, body["command_id"], plan["publisher"], plan["publisher_args"])
+    return results
+
+def run_control(apartment, plan):
+    """Queue one plan's downlinks; returns (body, HTTP status)."""
+    return run_controls([(apartment, plan)])[0]
+
+def control_response(control, apartment, *args):
+    """Run one control_* function for a PUT endpoint and build its response."""
+    try:
+        plan = control(apartment, *args)
+    except ControlError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    try:
+        body, status = run_control(apartment, plan)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    response = jsonify(body)
+    response.status_code = status
+    if "command_id" in body:
+        response.headers["Location"] = f"/commands/{body['command_id']}"
+    return response
+
+def _require_apartment(apartment):
+    if apartment not in latest_data:
+        raise ControlError('Apartment not found', 404)
+
+def control_wallswitch(apartment, args, room):
+    _require_apartment(apartment)
+    if room not in APARTMENTS[apartment]["rooms"]:
+        raise ControlError('Room not found', 404)
+
+    switch_states = {}
+    for param, value in args.items():
+        if param.startswith('switch_'):
+            try:
+                switch_num = int(param.split('_')[1])
+            except Exception:
+                continue
+            state = value.lower() in ('true', '1', 'on')
+            switch_states[switch_num] = state
+            with state_lock(apartment), track_changes(apartment, "wallswitch", room):
+                latest_data[apartment]["wallswitch"][room][f"switch_{switch_num}"] = 1 if state else 0
+
+    switch_control = 0
+    for switch_num, state in switch_states.items():
+        if 1 <= switch_num <= 4:
+            switch_control |= 1 << (switch_num + 3)
+            if state:
+                switch_control |= 1 << (switch_num - 1)
+
+    downlink = WALLSWITCH_DOWNLINKS[switch_control]
+
+    device_id = f"{APARTMENTS[apartment]['switch_device_id']}_{room}"
+    topic = f'milesight/downlink/{device_id}'
+
+    with state_lock(apartment):
+        new_state = latest_data[apartment]["wallswitch"][room].copy()
+    return control_plan("wallswitch", topic, [downlink.payload], publish_wallswitch, (apartment, room), {
+        'status': f"Switch updated, command {downlink.data} queued for {topic}",
+        'new_state': new_state
+    })
+
+def control_wallsocket(apartment, args):
+    _require_apartment(apartment)
+
+    if 'socket_status' not in args:
+        raise ControlError('socket_status parameter is required')
+    socket_status = args.get('socket_status').lower() in ('true', '1', 'on')
+    with state_lock(apartment), track_changes(apartment, "wallsocket"):
+        latest_data[apartment]["wallsocket"]["socket_status"] = 1 if socket_status else 0
+
+    downlink = WALLSOCKET_DOWNLINKS[socket_status]
+
+    device_id = f"{APARTMENTS[apartment]['socket_device_id']}"
+    topic = f'milesight/downlink/{device_id}'
+
+    with state_lock(apartment):
+        new_state = latest_data[apartment]["wallsocket"].copy()
+    return control_plan("wallsocket", topic, [downlink.payload], publish_device, ("wallsocket", apartment), {
+        'status': f"Socket updated, command {downlink.data} queued for {topic}",
+        'new_state': new_state
+    })
+
+def control_curtain(apartment, args):
+    _require_apartment(apartment)
+
+    if 'curtainstate' not in args:
+        raise ControlError('curtainstate parameter is required (0-100)')
+    try:
+        pos = int(args.get('curtainstate'))
+    except Exception:
+        raise ControlError('curtainstate must be integer 0-100')
+    if pos < 0 or pos > 100:
+        raise ControlError('curtainstate must be in range 0-100')
+
+    with state_lock(apartment), track_changes(apartment, "curtain"):
+        latest_data[apartment]["curtain"]["curtainstate"] = pos
+
+    # downlink command: [9, position, 255]
+    downlink = CURTAIN_DOWNLINKS[pos]
+
+    device_id = f"{APARTMENTS[apartment]['curtain_device_id']}"
+    topic = f'milesight/downlink/{device_id}'
+
+    # the updated curtain packet for this apartment follows the downlink
+    with state_lock(apartment):
+        new_state = latest_data[apartment]["curtain"].copy()
+    return control_plan("curtain", topic, [downlink.payload], publish_device, ("curtain", apartment), {
+        'status': f"Curtain updated to {pos}, command {downlink.data} queued for {topic}",
+        'new_state': new_state
+    })
+
+def control_doorlock(apartment, args):
+    """Doorlock control/update; see change_doorlock for the supported actions."""
+    _require_apartment(apartment)
+
+    action = args.get('action')
+    if not action:
+        raise ControlError('action parameter is required')
+    action = action.lower()
+
+    device_id = APARTMENTS[apartment].get('doorlock_device_id')
+    if not device_id:
+        raise ControlError('doorlock not configured for apartment', 404)
+
+    with state_lock(apartment):
+        dl = latest_data[apartment]['doorlock']
+
+    if action == 'remote_control':
+        state = args.get('state')
+        if not state or state.lower() not in ('unlock', 'lock', "0", "1"):
+            raise ControlError('state must be "unlock" or "lock"')
+        state = state.lower()
+        downlink = DOORLOCK_REMOTE_DOWNLINKS['unlock' if state == 'unlock' or state == "0" else 'lock']
+        # Update internal state to reflect lock/unlock
+        with state_lock(apartment), track_changes(apartment, "doorlock"):
+                dl['remote_lock'] = 1 if state == 'unlock' or state == "0" else 0
+                # reflect immediate current status for API GETs
+                dl['current_status'] = 0 if state == 'unlock' or state == "0" else 1
+                if state == 'unlock':
+                    dl['unlock_record'] = dl.get('unlock_record', 0) + 1
+                dl['t'] = sim_clock.isoformat()
+                dl['last_access_method'] = 'remote'
+                dl['last_access_user_id'] = 0
+                dl['last_access_timestamp'] = dl['t']
+
+    elif action == 'manage_password':
+        # require user_id and password
+        user_id = args.get('user_id')
+        password = args.get('password')
+        if not user_id or not password:
+            raise ControlError('user_id and password are required')
+        try:
+            uid = int(user_id)
+        except Exception:
+            raise ControlError('invalid user_id')
+        if not (isinstance(password, str) and len(password) == 6 and password.isdigit()):
+            raise ControlError('password must be 6 digits')
+        header = bytes.fromhex('4E0900')
+        uid_b = uid.to_bytes(1, 'big')
+        len_b = bytes([6])
+        pwd_b = bytes([int(d) for d in password])
+        downlink = encode_downlink(header + uid_b + len_b + pwd_b)
+        # record management action so it appears in next uplink
+        with state_lock(apartment), track_changes(apartment, "doorlock"):
+            dl['t'] = sim_clock.isoformat()
+            dl['last_manage_action'] = 'manage_password'
+            dl['last_manage_user_id'] = uid
+
+    elif action == 'manage_card':
+        user_id = args.get('user_id')
+        card_key_hex = args.get('card_key_hex')
+        if not user_id or not card_key_hex:
+            raise ControlError('user_id and card_key_hex are required')
+        try:
+            uid = int(user_id)
+        except Exception:
+            raise ControlError('invalid user_id')
+        if not (isinstance(card_key_hex, str) and len(card_key_hex) == 10):
+            raise ControlError('card_key_hex must be 10 hex chars')
+        try:
+            card_b = bytes.fromhex(card_key_hex)
+        except Exception:
+            raise ControlError('card_key_hex invalid hex')
+        header = bytes.fromhex('4D0700')
+        uid_b = uid.to_bytes(1, 'big')
+        downlink = encode_downlink(header + uid_b + card_b)
+        # record management action so it appears in next uplink
+        with state_lock(apartment), track_changes(apartment, "doorlock"):
+            dl['t'] = sim_clock.isoformat()
+            dl['last_manage_action'] = 'manage_card'
+            dl['last_manage_user_id'] = uid
+
+    elif action == 'access_event':
+        # Simulates device reporting a user access (unlock via password/card/remote)
+        method = args.get('access_method') or args.get('method')
+        user_id = args.get('user_id')
+        ts = args.get('timestamp') or sim_clock.isoformat()
+        if not method or not user_id:
+            raise ControlError('access_method and user_id are required')
+        method = method.lower()
+        try:
+            uid = int(user_id)
+        except Exception:
+            raise ControlError('invalid user_id')
+        with state_lock(apartment), track_changes(apartment, "doorlock"):
+            dl['last_access_method'] = method
+            dl['last_access_user_id'] = uid
+            dl['last_access_timestamp'] = ts
+            dl['t'] = sim_clock.isoformat()
+            # Increment unlock counter on any access event (successful unlock)
+            dl['unlock_record'] = dl.get('unlock_record', 0) + 1
+            new_state = dl.copy()
+        # no downlink for access_event; we just simulate device reporting
+        return control_plan("doorlock", None, [], publish_device, ("doorlock", apartment),
+                            {'status': 'access_event recorded', 'new_state': new_state})
+
+    elif action == 'set_auto_relock':
+        # set_auto_relock?enabled=true|false&timeout=<seconds>
+        enabled = args.get('enabled')
+        timeout = args.get('timeout')
+        with state_lock(apartment), track_changes(apartment, "doorlock"):
+            if enabled is not None:
+                en = enabled.lower() in ('1', 'true', 'yes', 'on')
+                dl['auto_relock_enabled'] = en
+            if timeout is not None:
+                try:
+                    to = int(timeout)
+                    dl['auto_relock'] = to
+                except Exception:
+                    raise ControlError('invalid timeout')
+            dl['t'] = sim_clock.isoformat()
+            new_state = dl.copy()
+        return control_plan("doorlock", None, [], publish_device, ("doorlock", apartment),
+                            {'status': 'auto_relock updated', 'new_state': new_state})
+
+    else:
+        raise ControlError('unsupported action')
+
+    # If we reach here we have a downlink to send
+    topic = f'milesight/downlink/{device_id}'
+    with state_lock(apartment):
+        new_state = latest_data[apartment]['doorlock'].copy()
+    return control_plan("doorlock", topic, [downlink.payload], publish_device, ("doorlock", apartment),
+                        {'status': 'command queued', 'downlink': downlink.data, 'new_state': new_state})
+
+def control_scb(apartment, args):
+    _require_apartment(apartment)
+
+    if 'action' not in args:
+        raise ControlError('action parameter is required (on|off or 1|0)')
+    action = args.get('action').lower()
+    # normalize numeric values to on/off
+    if action in ('1', 'true'):
+        action = 'on'
+    elif action in ('0', 'false'):
+        action = 'off'
+    if action not in ('on', 'off'):
+        raise ControlError('action must be "on" or "off" (or 1/0)')
+
+    with state_lock(apartment), track_changes(apartment, "scb"):
+        scb = latest_data[apartment]['scb']
+        # store as integer: 1 = connection made (CLOSED/on), 0 = connection broken (OPEN/off)
+        scb['switch_state'] = 1 if action == 'on' else 0
+        new_state = scb.copy()
+
+    device_id = f"{APARTMENTS[apartment]['scb_device_id']}"
+    topic = f'milesight/downlink/{device_id}'
+    return control_plan("scb", topic, [SCB_DOWNLINKS[action].payload], publish_device, ("scb", apartment),
+                        {'status': f'scb {action} command queued', 'new_state': new_state})
+
+def _valve_state(args):
+    """Parse the water/gas valve `action` (or `valve`) param into ('OPEN'|'CLOSED', state int)."""
+    # Accept 'action' (open/close) or 'valve' (on/off/1/0)
+    action = args.get('action') or args.get('valve')
+    if not action:
+        raise ControlError('action or valve parameter required (open/close or on/off)')
+    action = action.lower()
+    # Interpret 'open', 'off', '0', 'false' as valve OPEN (cut off)
+    if action in ('open', 'off', '0', 'false'):
+        return 'OPEN', 0
+    # Interpret 'close', 'on', '1', 'true' as valve CLOSED (connection made)
+    if action in ('close', 'on', '1', 'true'):
+        return 'CLOSED', 1
+    raise ControlError('invalid action')
+
+def _control_valve(apartment, args, device, downlinks):
+    _require_apartment(apartment)
+    state_str, state_int = _valve_state(args)
+
+    with state_lock(apartment), track_changes(apartment, device):
+        latest_data[apartment][device]['valve_state'] = state_int
+        new_state = latest_data[apartment][device].copy()
+
+    device_id = f"{APARTMENTS[apartment][f'{device}_device_id']}"
+    topic = f'milesight/downlink/{device_id}'
+    return control_plan(device, topic, [downlinks[state_str].payload], publish_device, (device, apartment),
+                        {'status': f'{device} valve {state_str}', 'new_state': new_state})
+
+def control_watermeter(apartment, args):
+    return _control_valve(apartment, args, "watermeter", WATERMETER_DOWNLINKS)
+
+def control_gasmeter(apartment, args):
+    return _control_valve(apartment, args, "gasmeter", GASMETER_DOWNLINKS)
+
+def control_thermostat(apartment, args):
+    """Thermostat control; see change_thermostat for the supported params."""
+    _require_apartment(apartment)
+
+    updates = {}
+    # power
+    if 'power' in args:
+        p = args.get('power').lower()
+        if p in ('on', '1', 'true'):
+            updates['power'] = 'on'
+        elif p in ('off', '0', 'false'):
+            updates['power'] = 'off'
+        else:
+            raise ControlError('invalid power value')
+
+    # fan
+    if 'fan' in args:
+        f = args.get('fan').lower()
+        if f in ('high', 'medium', 'low', 'auto'):
+            updates['fan_setting'] = f
+        else:
+            raise ControlError('invalid fan value')
+
+    # mode
+    if 'mode' in args:
+        m = args.get('mode').lower()
+        if m in ('cool', 'heat', 'auto', 'vent', 'dehumidify', 'off'):
+            updates['mode'] = m
+        else:
+            raise ControlError('invalid mode value')
+
+    # setpoint
+    if 'setpoint' in args:
+        try:
+            sp = float(args.get('setpoint'))
+        except Exception:
+            raise ControlError('invalid setpoint value')
+        updates['setpoint_temperature'] = round(sp, 1)
+
+    if not updates:
+        raise ControlError('no valid control parameters provided')
+
+    device_id = APARTMENTS[apartment].get('thermostat_device_id')
+    if not device_id:
+        raise ControlError('thermostat not configured for apartment', 404)
+
+    # Apply updates locally and pick a downlink per change
+    downlinks = []
+    with state_lock(apartment), track_changes(apartment, "thermostat"):
+        th = latest_data[apartment]['thermostat']
+        # power command
+        if 'power' in updates:
+            th['power'] = updates['power']
+            downlinks.append(THERMOSTAT_POWER_DOWNLINKS[th['power']])
+        # fan command
+        if 'fan_setting' in updates:
+            th['fan_setting'] = updates['fan_setting']
+            downlinks.append(THERMOSTAT_FAN_DOWNLINKS[th['fan_setting']])
+        # mode command
+        if 'mode' in updates:
+            th['mode'] = updates['mode']
+            downlinks.append(THERMOSTAT_MODE_DOWNLINKS[th['mode']])
+        # setpoint command
+        if 'setpoint_temperature' in updates:
+            th['setpoint_temperature'] = updates['setpoint_temperature']
+            # record timestamp so publishes/GETs can verify latest setpoint
+            th['last_setpoint_timestamp'] = sim_clock.isoformat()
+            val = int(round(th['setpoint_temperature'] * 10))
+            high = (val >> 8) & 0xFF
+            low = val & 0xFF
+            downlinks.append(encode_downlink(bytes([0x03, 0x02, high, low])))
+
+    # Small verification: ensure setpoint persisted in latest_data after applying updates
+    if 'setpoint_temperature' in updates:
+        expected = updates['setpoint_temperature']
+        # quick retry loop (very short) to guard against a race
+        retried = 0
+        while retried < 3:
+            with state_lock(apartment):
+                current = latest_data[apartment]['thermostat']['setpoint_temperature']
+            if current == expected:
+                break
+            # re-write under lock as a defensive attempt
+            with state_lock(apartment), track_changes(apartment, "thermostat"):
+                latest_data[apartment]['thermostat']['setpoint_temperature'] = expected
+                latest_data[apartment]['thermostat']['last_setpoint_timestamp'] = sim_clock.isoformat()
+            retried += 1
+
+    # one downlink per command, followed by an updated thermostat publish
+    topic = f'milesight/downlink/{device_id}'
+    sent = [downlink.raw.hex().upper() for downlink in downlinks]
+    with state_lock(apartment):
+        new_state = latest_data[apartment]['thermostat'].copy()
+    return control_plan("thermostat", topic, [downlink.payload for downlink in downlinks], publish_device, ("thermostat", apartment),
+                        {'status': 'commands queued', 'commands': sent, 'new_state': new_state})
+
+# device name in a batch operation -> control function
+DEVICE_CONTROLS = {
+    "wallswitch": control_wallswitch,
+    "wallsocket": control_wallsocket,
+    "curtain": control_curtain,
+    "doorlock": control_doorlock,
+    "scb": control_scb,
+    "watermeter": control_watermeter,
+    "gasmeter": control_gasmeter,
+    "thermostat": control_thermostat,
+}
+
+@app.route('/<apartment>/items/Update_Apartment_smart_Switch/<room>/state', methods=['PUT'])
+def change_wallswitch(apartment, room):
+    return control_response(control_wallswitch, apartment, request.args, room)
+
+@app.route('/<apartment>/items/Update_Apartment_smart_Socket/state', methods=['PUT'])
+def change_wallsocket(apartment):
+    return control_response(control_wallsocket, apartment, request.args)
+
+@app.route('/<apartment>/items/Update_Apartment_smart_Curtain/state', methods=['PUT'])
+def change_curtain(apartment):
+    return control_response(control_curtain, apartment, request.args)
+
+@app.route('/<apartment>/items/Update_Apartment_smart_DoorLock/state', methods=['PUT'])
+def change_doorlock(apartment):
+    """Unified doorlock control/update endpoint (PUT).
+    Supported query params (action):
+    - action=remote_control&state=unlock|lock
+    - action=manage_password&user_id=<int>&password=<6-digit>
+    - action=manage_card&user_id=<int>&card_key_hex=<10 hex chars>
+    - action=access_event&access_method=<password|card|remote>&user_id=<int>&timestamp=<iso>
+    - action=set_auto_relock&enabled=true|false&timeout=<seconds>
+    Note: This keeps a single consistent URL for control and simulation updates.
+    """
+    return control_response(control_doorlock, apartment, request.args)
+
+@app.route('/<apartment>/items/Update_Apartment_smart_CircuitBreaker/state', methods=['PUT'])
+def change_scb(apartment):
+    """Control Circuit Breaker: use param `action=on|off` to change switch_state."""
+    return control_response(control_scb, apartment, request.args)
+
+@app.route('/<apartment>/items/Update_Apartment_smart_WaterMeter/state', methods=['PUT'])
+def change_watermeter(apartment):
+    return control_response(control_watermeter, apartment, request.args)
+
+@app.route('/<apartment>/items/Update_Apartment_smart_GasMeter/state', methods=['PUT'])
+def change_gasmeter(apartment):
+    return control_response(control_gasmeter, apartment, request.args)
 
 @app.route('/<apartment>/items/Update_Apartment_smart_Thermostat/state', methods=['PUT'])
 def change_thermostat(apartment):
@@ -1218,116 +2787,1801 @@ def change_thermostat(apartment):
     - setpoint=<float>
     Multiple params can be provided together; each will publish corresponding downlink.
     """
-    if apartment not in latest_data:
-        return jsonify({'error': 'Apartment not found'}), 404
+    return control_response(control_thermostat, apartment, request.args)
 
-    updates = {}
-    # power
-    if 'power' in request.args:
-        p = request.args.get('power').lower()
-        if p in ('on', '1', 'true'):
-            updates['power'] = 'on'
-        elif p in ('off', '0', 'false'):
-            updates['power'] = 'off'
+BATCH_MAX_OPERATIONS = 10000
+
+def _batch_params(params):
+    # JSON values may be booleans/numbers; the control functions expect query-string text
+    return {k: v if isinstance(v, str) else json.dumps(v) for k, v in params.items()}
+
+@app.route('/items/Update_Apartments_batch/state', methods=['PUT'])
+def change_batch():
+    """Apply many control operations in one request.
+
+    Body: {"operations": [{"apartment": ..., "device": ..., "room": ..., "command": {...}}, ...]}
+    `command` holds the same params as the device's single PUT endpoint and
+    `room` is only used for wallswitch. All state changes are applied while
+    holding the lock stripes of every apartment involved, then all downlinks
+    are queued as one MQTT batch, with a command record per operation.
+    Operations are independent: one failing does not undo the others. Each
+    gets a result with its own `code` (and `command_id` when a downlink was
+    queued).
+    """
+    body = request.get_json(silent=True)
+    operations = body.get("operations") if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'JSON body with a non-empty "operations" list is required'}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'at most {BATCH_MAX_OPERATIONS} operations per batch'}), 400
+
+    results = [None] * len(operations)
+    plans = []
+    apartments = {op.get("apartment") for op in operations if isinstance(op, dict) and isinstance(op.get("apartment"), str)}
+    with state_locks_for(apt for apt in apartments if apt in latest_data):
+        for i, op in enumerate(operations):
+            try:
+                if not isinstance(op, dict):
+                    raise ControlError('operation must be an object')
+                if not isinstance(op.get("apartment"), str):
+                    raise ControlError('apartment is required')
+                control = DEVICE_CONTROLS.get(op.get("device"))
+                if control is None:
+                    raise ControlError(f"unknown device {op.get('device')!r}")
+                params = op.get("command") or {}
+                if not isinstance(params, dict):
+                    raise ControlError('command must be an object')
+                extra = (op.get("room"),) if control is control_wallswitch else ()
+                plans.append((i, op.get("apartment"), control(op.get("apartment"), _batch_params(params), *extra)))
+            except ControlError as e:
+                results[i] = {'code': e.status, 'error': str(e)}
+            except Exception as e:
+                results[i] = {'code': 500, 'error': str(e)}
+
+    try:
+        outcomes = run_controls([(apartment, plan) for _, apartment, plan in plans])
+    except Exception as e:
+        outcomes = [({'error': str(e)}, 500)] * len(plans)
+    for (i, _, _), (result, status) in zip(plans, outcomes):
+        results[i] = dict(result, code=status)
+
+    failed = sum(1 for r in results if r['code'] >= 400)
+    return jsonify({'results': results, 'applied': len(results) - failed, 'failed': failed}), 200
+
+# ---------------------------------------------------------------------------
+# asyncio runtime (--runtime asyncio, needs uvicorn)
+# Everything runs on one event loop thread instead of threads:
+# - one device_updater() coroutine per device type walks its apartments on
+#   the same evenly spread, absolute-deadline slots as start_scheduler();
+# - schedule() becomes loop.call_at(), so delayed re-publishes and command
+#   follow-ups are loop callbacks rather than scheduler-thread work;
+# - one paho client is driven by the loop's socket callbacks (no network
+#   thread) and drains mqtt_queue whenever mqtt_publish_batch() signals it;
+# - HTTP is served by uvicorn through asgi_app(). The Flask views run inline
+#   on the loop (none of them block); /changes and /changes/stream are
+#   answered by coroutines that await new deltas instead of a thread.
+# ---------------------------------------------------------------------------
+RUNTIME = "threads"  # "threads" or "asyncio"
+
+event_loop = None
+mqtt_wakeup = None  # asyncio.Event set by mqtt_publish_batch() on the asyncio runtime
+_changes_future = None  # resolved at the next recorded change while a coroutine waits
+loop_callbacks = 0  # _loop_call() callbacks waiting on the event loop
+updater_slots = {}  # device -> slots per pass of its device_updater(); each one is always waiting to run again
+
+def _notify_async_changes():
+    global _changes_future
+    if _changes_future is not None:
+        if not _changes_future.done():
+            _changes_future.set_result(None)
+        _changes_future = None
+
+async def wait_for_changes(timeout):
+    """Wait up to `timeout` seconds for the next recorded change; False on timeout."""
+    global _changes_future
+    if _changes_future is None:
+        _changes_future = asyncio.get_running_loop().create_future()
+    try:
+        await asyncio.wait_for(asyncio.shield(_changes_future), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+def _loop_deadline(deadline):
+    """Event loop time at which simulated time `deadline` is reached."""
+    return event_loop.time() + sim_clock.real_seconds(deadline - sim_clock.time())
+
+def _loop_call(deadline, fn, args, interval):
+    global loop_callbacks
+    if interval:
+        loop_callbacks += 1
+        event_loop.call_at(_loop_deadline(deadline + interval), _loop_call, deadline + interval, fn, args, interval)
+    loop_callbacks -= 1
+    try:
+        with sim_clock.ticking(deadline):
+            fn(*args)
+    except Exception as e:
+        print(f"[scheduler error] {getattr(fn, '__name__', fn)}{args}: {e}")
+
+async def device_updater(device, k):
+    """Tick `device` for every apartment once per interval, like start_scheduler()'s entries."""
+    interval = DEVICE_INTERVALS.get(device, DATA_SENDING_INTERVAL)
+    n_types = len(DEVICE_UPDATERS)
+    cycle = 0
+    while True:
+        if VECTORIZED and device in VECTOR_UPDATERS:
+            slots = [(interval * k / n_types, tick_vectorized, (device,))]
         else:
-            return jsonify({'error': 'invalid power value'}), 400
+            apartments = list(APARTMENTS)
+            n_apts = len(apartments)
+            slots = [(interval * (i * n_types + k) / (n_apts * n_types), tick_device, (device, apt))
+                     for i, apt in enumerate(apartments)]
+        updater_slots[device] = len(slots)
+        not_before = 0.0  # simulated time the next slot may start at the earliest (spread policy)
+        for offset, fn, args in slots:
+            deadline = cycle * interval + offset
+            # always yield, so a pass that has fallen behind still lets HTTP and MQTT run
+            await asyncio.sleep(max(0.0, sim_clock.real_seconds(max(deadline, not_before) - sim_clock.time())))
+            now = sim_clock.time()
+            missed = tick_overrun(device, deadline, interval, now)
+            if missed and TICK_OVERRUN_POLICY == "skip":
+                # the pass continues in the current cycle: every entry drops the same slots
+                cycle += missed
+                deadline += missed * interval
+            elif missed and TICK_OVERRUN_POLICY == "spread":
+                not_before = now + interval / len(slots) / 2
+            try:
+                with sim_clock.ticking(deadline):
+                    fn(*args)
+            except Exception as e:
+                print(f"[scheduler error] {fn.__name__}{args}: {e}")
+        cycle += 1
 
-    # fan
-    if 'fan' in request.args:
-        f = request.args.get('fan').lower()
-        if f in ('high', 'medium', 'low', 'auto'):
-            updates['fan_setting'] = f
+def _attach_mqtt_to_loop(client, loop):
+    """Drive paho's socket I/O from loop reader/writer callbacks instead of loop_start()'s thread."""
+    client.on_socket_open = lambda client, userdata, sock: loop.add_reader(sock, client.loop_read)
+    client.on_socket_close = lambda client, userdata, sock: loop.remove_reader(sock)
+    client.on_socket_register_write = lambda client, userdata, sock: loop.add_writer(sock, client.loop_write)
+    client.on_socket_unregister_write = lambda client, userdata, sock: loop.remove_writer(sock)
+
+async def mqtt_async_client():
+    """Keep one loop-driven MQTT connection up and drain mqtt_queue through it."""
+    loop = asyncio.get_running_loop()
+    client, connected, window = _new_mqtt_client()
+    window.room = asyncio.Event()
+    _attach_mqtt_to_loop(client, loop)
+    loop.create_task(mqtt_async_sender(client, connected, window))
+    delay = 1
+    while True:
+        if client.socket() is None:
+            try:
+                client.connect(MQTT_SERVER, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+                delay = 1
+            except OSError as e:
+                print(f"[MQTT connect error] {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+        # keep-alive pings and timeouts
+        client.loop_misc()
+        await asyncio.sleep(1)
+
+async def mqtt_async_sender(client, connected, window):
+    pending = None  # (messages, commands) being published, resumed at messages[index]
+    index = 0
+    sent = 0
+    start = None  # when messages[index] was first attempted
+    while True:
+        if pending is None:
+            try:
+                pending = mqtt_queue.get_nowait()
+                index = 0
+            except queue.Empty:
+                # producers all run on this loop, so nothing can be queued between get and clear
+                mqtt_wakeup.clear()
+                await mqtt_wakeup.wait()
+                continue
+        if not connected.is_set():
+            await asyncio.sleep(0.1)
+            continue
+        messages, commands = pending
+        topic, payload, qos, retain = messages[index]
+        if start is None:
+            start = time.perf_counter()
+        if qos and window.full():
+            window.room.clear()
+            await window.room.wait()
+            continue
+        published_at = time.perf_counter()
+        info = client.publish(topic, payload, qos, retain)
+        if not _publish_accepted(info, qos):
+            publish_errors.inc()
+            connected.clear()
+            continue
+        window.published(info.mid, qos, published_at)
+        publish_seconds.observe(time.perf_counter() - start, qos)
+        start = None
+        index += 1
+        if index == len(messages):
+            pending = None
+            if commands:
+                for command_id, count in commands.items():
+                    downlink_sent(command_id, count)
+        sent += 1
+        if sent % 256 == 0:
+            # let paho's writer and everything else on the loop run during long drains
+            await asyncio.sleep(0)
+
+def _wsgi_environ(scope, body):
+    host, port = scope.get("server") or ("localhost", HTTP_SERVER_PORT)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": host,
+        "SERVER_PORT": str(port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def call_wsgi(wsgi_app, environ):
+    """Run a WSGI app to completion; returns (status code, [(name, value)], body bytes)."""
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    status, headers = started
+    return status, headers, body
+
+async def _send_response(send, status, headers, body):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _send_json(send, status, data):
+    await _send_response(send, status, [("Content-Type", "application/json")], json.dumps(data).encode())
+
+def _query_arg(query, name, default=None):
+    values = query.get(name)
+    return values[0] if values else default
+
+async def _async_changes(scope, send, query):
+    """Coroutine version of get_changes() for the asyncio runtime."""
+    try:
+        since = int(_query_arg(query, "since", change_version))
+        timeout = min(float(_query_arg(query, "timeout", 30)), CHANGES_MAX_WAIT)
+    except ValueError:
+        return await _send_json(send, 400, {'error': 'since and timeout must be numeric'})
+    apartment = _query_arg(query, "apartment")
+    device = _query_arg(query, "device")
+    if apartment is not None and apartment not in latest_data:
+        return await _send_json(send, 404, {'error': 'Apartment not found'})
+
+    deadline = time.monotonic() + timeout
+    while True:
+        deltas, gap, head = changes_since(since, apartment, device)
+        remaining = deadline - time.monotonic()
+        if deltas or gap or remaining <= 0:
+            break
+        since = head
+        await wait_for_changes(remaining)
+    await _send_json(send, 200, {"version": head, "gap": gap, "changes": [_delta_json(e) for e in deltas]})
+
+async def _async_change_stream(scope, receive, send, query, last_event_id):
+    """Coroutine version of stream_changes() for the asyncio runtime."""
+    try:
+        cursor = int(_query_arg(query, "since", last_event_id if last_event_id is not None else change_version))
+    except ValueError:
+        return await _send_json(send, 400, {'error': 'since must be numeric'})
+    apartment = _query_arg(query, "apartment")
+    device = _query_arg(query, "device")
+    if apartment is not None and apartment not in latest_data:
+        return await _send_json(send, 404, {'error': 'Apartment not found'})
+
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                            (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+    # consume the (empty) request body; the next receive() resolves when the client goes away
+    while (await receive()).get("more_body"):
+        pass
+    disconnected = asyncio.ensure_future(receive())
+    try:
+        while not disconnected.done():
+            deltas, gap, head = changes_since(cursor, apartment, device)
+            chunks = []
+            if gap:
+                chunks.append(f"event: gap\ndata: {json.dumps({'version': head})}\n\n")
+            for entry in deltas:
+                chunks.append(f"id: {entry[0]}\ndata: {json.dumps(_delta_json(entry))}\n\n")
+            cursor = head
+            if chunks:
+                await send({"type": "http.response.body", "body": "".join(chunks).encode(), "more_body": True})
+            if not await wait_for_changes(CHANGES_KEEPALIVE):
+                await send({"type": "http.response.body", "body": b": keep-alive\n\n", "more_body": True})
+    finally:
+        disconnected.cancel()
+
+def _timed_send(send, method, route):
+    """Wrap an ASGI send() to record http_seconds when the response starts, like the Flask after_request hook."""
+    start = time.perf_counter()
+
+    async def timed_send(message):
+        if message["type"] == "http.response.start":
+            http_seconds.observe(time.perf_counter() - start, method, route)
+        await send(message)
+    return timed_send
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point serving the Flask routes on the asyncio runtime."""
+    if scope["type"] != "http":
+        return
+    path = scope["path"]
+    if scope["method"] == "GET" and path in ("/changes", "/changes/stream"):
+        send = _timed_send(send, "GET", path)
+        query = urllib.parse.parse_qs(scope["query_string"].decode("latin-1"))
+        if path == "/changes":
+            return await _async_changes(scope, send, query)
+        last_event_id = dict(scope["headers"]).get(b"last-event-id")
+        return await _async_change_stream(scope, receive, send, query,
+                                          last_event_id.decode("latin-1") if last_event_id else None)
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    status, headers, data = call_wsgi(app.wsgi_app, _wsgi_environ(scope, body))
+    await _send_response(send, status, headers, data)
+
+async def run_asyncio(host, port):
+    global event_loop, mqtt_wakeup
+    event_loop = asyncio.get_running_loop()
+    mqtt_wakeup = asyncio.Event()
+    tasks = [event_loop.create_task(mqtt_async_client())]
+    tasks += [event_loop.create_task(device_updater(device, k)) for k, device in enumerate(DEVICE_UPDATERS)]
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host=host, port=port, log_level="warning",
+                                           lifespan="off", backlog=4096))
+    try:
+        await server.serve()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# ---------------------------------------------------------------------------
+# Production serving (--server waitress|gunicorn)
+# waitress is multi-threaded and runs in this process next to the
+# simulation, so its threads read latest_data directly. gunicorn forks
+# worker processes, and each of them must not simulate its own copy of the
+# building: the simulation runs in one state service process instead, and
+# every worker hands its requests to it over a local socket
+# (multiprocessing.connection). The service answers with the same Flask
+# views, so all workers see one consistent latest_data.
+# ---------------------------------------------------------------------------
+SERVER_THREADS = 8  # request threads of the waitress server / of each gunicorn worker
+STATE_SERVICE_PORT_OFFSET = 50  # state service listens on 127.0.0.1:HTTP_SERVER_PORT + offset
+
+state_service_authkey = None
+_service_conns = threading.local()
+
+def state_service_address():
+    return ("127.0.0.1", HTTP_SERVER_PORT + STATE_SERVICE_PORT_OFFSET)
+
+def run_state_service(authkey, apartments, settings):
+    """State service process: simulate `apartments` and answer forwarded requests."""
+    globals().update(settings)
+    configure_simulation()
+    load_apartments(apartments)
+    start_mqtt_pool()
+    start_scheduler()
+    listener = multiprocessing.connection.Listener(state_service_address(), authkey=authkey, backlog=256)
+    print(f"[state service] {len(apartments)} apartments on {state_service_address()[0]}:{state_service_address()[1]}")
+    while True:
+        try:
+            conn = listener.accept()
+        except (OSError, multiprocessing.AuthenticationError) as e:
+            print(f"[state service error] {e}")
+            continue
+        threading.Thread(target=_serve_state_connection, args=(conn,), daemon=True).start()
+
+def _serve_state_connection(conn):
+    # one worker thread's connection: requests arrive one at a time
+    with conn:
+        while True:
+            try:
+                environ, body = conn.recv()
+            except (EOFError, OSError):
+                return
+            environ.update({"wsgi.version": (1, 0), "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(body),
+                            "wsgi.errors": sys.stderr, "wsgi.multithread": True, "wsgi.multiprocess": True,
+                            "wsgi.run_once": False})
+            started = []
+            result = app.wsgi_app(environ, lambda status, headers, exc_info=None: started.extend((status, headers)))
+            try:
+                status, headers = started
+                if any(name.lower() == "content-length" for name, _ in headers):
+                    conn.send((status, headers, b"".join(result), True))
+                    continue
+                # streamed response (SSE): headers first, then chunks until None
+                conn.send((status, headers, b"", False))
+                for chunk in result:
+                    conn.send(chunk)
+                conn.send(None)
+            except (EOFError, OSError):
+                # the worker dropped the connection (its client went away mid-stream)
+                return
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+
+def _drop_service_connection():
+    conn = getattr(_service_conns, "conn", None)
+    _service_conns.conn = None
+    if conn is not None:
+        conn.close()
+
+def state_service_app(environ, start_response):
+    """WSGI app of the gunicorn workers: forward the request to the state service, relay the answer."""
+    forwarded = {key: value for key, value in environ.items()
+                 if isinstance(value, str) and not key.startswith(("wsgi.", "gunicorn."))}
+    body = environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0))
+    try:
+        conn = getattr(_service_conns, "conn", None)
+        if conn is None:
+            conn = _service_conns.conn = multiprocessing.connection.Client(state_service_address(),
+                                                                           authkey=state_service_authkey)
+        conn.send((forwarded, body))
+        status, headers, data, complete = conn.recv()
+    except (EOFError, OSError) as e:
+        _drop_service_connection()
+        start_response("502 Bad Gateway", [("Content-Type", "application/json")])
+        return [json.dumps({'error': f'state service unavailable: {e}'}).encode()]
+    start_response(status, headers)
+    if complete:
+        return [data]
+    return _relay_stream(conn)
+
+def _relay_stream(conn):
+    finished = False
+    try:
+        while True:
+            chunk = conn.recv()
+            if chunk is None:
+                finished = True
+                return
+            yield chunk
+    finally:
+        if not finished:
+            # client went away mid-stream; the service notices when its next send fails
+            _drop_service_connection()
+
+def start_state_service(settings):
+    """Start the state service and wait until it accepts connections.
+
+    The service is a fresh interpreter running this script with
+    --state-service, not a multiprocessing.Process, so the gunicorn workers
+    forked afterwards inherit no process object for it. Its authkey,
+    apartments and settings are handed over on stdin.
+    """
+    global state_service_authkey
+    state_service_authkey = os.urandom(16)
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--state-service"],
+                               stdin=subprocess.PIPE)
+    with process.stdin:
+        pickle.dump((state_service_authkey, dict(APARTMENTS), settings), process.stdin)
+    for _ in range(100):
+        if process.poll() is not None:
+            break
+        try:
+            multiprocessing.connection.Client(state_service_address(), authkey=state_service_authkey).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("state service did not start")
+
+def run_gunicorn(host, port, workers, threads, settings):
+    service = []
+
+    def on_starting(server):
+        # the master starts the service before it forks any worker
+        service.append(start_state_service(settings))
+
+    def on_exit(server):
+        for process in service:
+            process.terminate()
+            process.wait()
+
+    class StateServiceWorkers(gunicorn_app.BaseApplication):
+        def load_config(self):
+            for key, value in {"bind": f"{host}:{port}", "workers": workers, "threads": threads,
+                               "worker_class": "gthread", "timeout": CHANGES_MAX_WAIT + 30,
+                               "on_starting": on_starting, "on_exit": on_exit}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return state_service_app
+
+    StateServiceWorkers().run()
+
+# ---------------------------------------------------------------------------
+# Sharded mode (--shards N)
+# APARTMENTS are partitioned over N worker processes by a stable hash of the
+# apartment name, so the simulation is no longer bound to one GIL. Each worker
+# is a complete simulator for its shard (own latest_data, MQTT connections,
+# scheduler and HTTP server on shard_port(index)). The parent process only
+# runs a thin HTTP front on HTTP_SERVER_PORT: /<apartment>/... is forwarded
+# to the owning shard, /state and batch control are fanned out and merged.
+# ---------------------------------------------------------------------------
+SHARD_TIMEOUT = CHANGES_MAX_WAIT + 10  # seconds; long-polls are forwarded too
+# response headers the front must not copy from a shard's response
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "server", "date"}
+
+shard_count = 1
+front = Flask("shard_front")
+_shard_conns = threading.local()
+
+def shard_of(apartment, shards):
+    # crc32 rather than hash(): str hashes differ between processes
+    return zlib.crc32(apartment.encode()) % shards
+
+def shard_port(index):
+    return HTTP_SERVER_PORT + 1 + index
+
+def partition_apartments(apartments, shards):
+    parts = [{} for _ in range(shards)]
+    for apt, cfg in apartments.items():
+        parts[shard_of(apt, shards)][apt] = cfg
+    return parts
+
+def run_shard(index, shards, apartments, settings):
+    """Worker process entry point: simulate `apartments` and serve them on shard_port(index)."""
+    global _command_ids
+    globals().update(settings)
+    configure_simulation()
+    # command ids stay unique across shards, and the front finds the shard from the id
+    _command_ids = itertools.count(index + 1, shards)
+    load_apartments(apartments)
+    print(f"[shard {index}] {len(apartments)} apartments on port {shard_port(index)}")
+    if RUNTIME == "asyncio":
+        asyncio.run(run_asyncio("127.0.0.1", shard_port(index)))
+        return
+    start_mqtt_pool()
+    start_scheduler()
+    app.run(host="127.0.0.1", port=shard_port(index), debug=False, use_reloader=False)
+
+def start_shards(shards, settings):
+    """Start one worker process per shard; returns the processes."""
+    processes = []
+    for index, apartments in enumerate(partition_apartments(APARTMENTS, shards)):
+        process = multiprocessing.Process(target=run_shard, args=(index, shards, apartments, settings),
+                                          name=f"shard-{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+def shard_request(index, method, path, body=None, headers=None):
+    """Forward one request to a shard over a kept-alive connection; returns (status, headers, body)."""
+    conns = getattr(_shard_conns, "conns", None)
+    if conns is None:
+        conns = _shard_conns.conns = {}
+    for attempt in range(2):
+        conn = conns.get(index)
+        reused = conn is not None
+        if conn is None:
+            conn = conns[index] = http.client.HTTPConnection("127.0.0.1", shard_port(index), timeout=SHARD_TIMEOUT)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.status, response.getheaders(), response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            del conns[index]
+            # a kept-alive connection may have been closed by the shard; retry once on a fresh one
+            if attempt or not reused:
+                raise
+
+def _forwarded(index, path=None):
+    """Pass the current front request to shard `index` and relay its response."""
+    if path is None:
+        path = request.full_path if request.query_string else request.path
+    headers = {name: value for name, value in request.headers.items()
+               if name.lower() in ("content-type", "accept", "last-event-id")}
+    try:
+        status, response_headers, body = shard_request(index, request.method, path, request.get_data() or None, headers)
+    except (http.client.HTTPException, OSError) as e:
+        return jsonify({'error': f'shard {index} unavailable: {e}'}), 502
+    response = Response(body, status=status)
+    for name, value in response_headers:
+        if name.lower() not in HOP_BY_HOP_HEADERS:
+            response.headers[name] = value
+    return response
+
+def _fan_out(method, paths, body=None):
+    """Send one request per shard in parallel ({index: path}); returns {index: (status, json)}."""
+    def call(index):
+        status, _, data = shard_request(index, method, paths[index], body[index] if body else None,
+                                        {"Content-Type": "application/json"} if body else None)
+        return index, status, json.loads(data)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(paths)) as pool:
+        return {index: (status, data) for index, status, data in pool.map(call, paths)}
+
+@front.route("/<apartment>/<path:rest>", methods=["GET", "PUT"])
+def front_apartment(apartment, rest):
+    return _forwarded(shard_of(apartment, shard_count))
+
+@front.route("/commands/<int:command_id>", methods=["GET"])
+def front_command(command_id):
+    return _forwarded((command_id - 1) % shard_count)
+
+@front.route("/state", methods=["GET"])
+def front_state():
+    path = request.full_path if request.query_string else request.path
+    try:
+        results = _fan_out("GET", {index: path for index in range(shard_count)})
+    except (http.client.HTTPException, OSError, ValueError) as e:
+        return jsonify({'error': f'shard unavailable: {e}'}), 502
+    merged = {}
+    for index in range(shard_count):
+        status, data = results[index]
+        if status != 200:
+            return jsonify(data), status
+        merged.update(data)
+    return jsonify(merged)
+
+@front.route("/mqtt/stats", methods=["GET"])
+def front_mqtt_stats():
+    # every shard has its own MQTT connections; report them side by side
+    try:
+        results = _fan_out("GET", {index: "/mqtt/stats" for index in range(shard_count)})
+    except (http.client.HTTPException, OSError, ValueError) as e:
+        return jsonify({'error': f'shard unavailable: {e}'}), 502
+    return jsonify({str(index): data for index, (_, data) in sorted(results.items())})
+
+@front.route("/metrics", methods=["GET"])
+def front_metrics():
+    # every shard's series, told apart by a shard label; each family keeps its HELP/TYPE once
+    families = {}  # name -> [HELP/TYPE lines, samples of all shards]
+    for index in range(shard_count):
+        try:
+            status, _, body = shard_request(index, "GET", "/metrics")
+        except (http.client.HTTPException, OSError) as e:
+            return jsonify({'error': f'shard {index} unavailable: {e}'}), 502
+        family = None
+        for line in body.decode().splitlines():
+            if line.startswith("#"):
+                if line.startswith("# HELP "):
+                    family = families.setdefault(line.split()[2], [[], []])
+                if family is not None and line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                series, _, value = line.rpartition(" ")
+                shard = f'shard="{index}"'
+                series = f"{series[:-1]},{shard}}}" if series.endswith("}") else f"{series}{{{shard}}}"
+                family[1].append(f"{series} {value}")
+    return Response("\n".join(line for headers, samples in families.values() for line in headers + samples) + "\n",
+                    mimetype="text/plain; version=0.0.4")
+
+@front.route("/changes", methods=["GET"])
+@front.route("/changes/stream", methods=["GET"])
+def front_changes():
+    # change versions are per shard, so a change feed is always for one apartment
+    apartment = request.args.get("apartment")
+    if not apartment:
+        return jsonify({'error': 'apartment parameter is required in sharded mode'}), 400
+    index = shard_of(apartment, shard_count)
+    if request.path.endswith("/stream"):
+        return _forwarded_stream(index)
+    return _forwarded(index)
+
+def _forwarded_stream(index):
+    conn = http.client.HTTPConnection("127.0.0.1", shard_port(index), timeout=SHARD_TIMEOUT)
+    headers = {name: value for name, value in request.headers.items() if name.lower() == "last-event-id"}
+    try:
+        conn.request("GET", request.full_path, headers=headers)
+        upstream = conn.getresponse()
+    except (http.client.HTTPException, OSError) as e:
+        conn.close()
+        return jsonify({'error': f'shard {index} unavailable: {e}'}), 502
+
+    def relay():
+        try:
+            while True:
+                chunk = upstream.read1(65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            conn.close()
+
+    return Response(relay(), status=upstream.status, mimetype=upstream.getheader("Content-Type"),
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@front.route("/items/Update_Apartments_batch/state", methods=["PUT"])
+def front_batch():
+    body = request.get_json(silent=True)
+    operations = body.get("operations") if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'JSON body with a non-empty "operations" list is required'}), 400
+    # split by owning shard, remembering each operation's position; malformed ones go to
+    # shard 0, which reports them exactly like the unsharded server would
+    positions = collections.defaultdict(list)
+    for i, op in enumerate(operations):
+        apartment = op.get("apartment") if isinstance(op, dict) else None
+        positions[shard_of(apartment, shard_count) if isinstance(apartment, str) else 0].append(i)
+    shards = {index: "/items/Update_Apartments_batch/state" for index in positions}
+    bodies = {index: json.dumps({"operations": [operations[i] for i in idx]}) for index, idx in positions.items()}
+    try:
+        results = _fan_out("PUT", shards, bodies)
+    except (http.client.HTTPException, OSError, ValueError) as e:
+        return jsonify({'error': f'shard unavailable: {e}'}), 502
+    merged = [None] * len(operations)
+    for index, (status, data) in results.items():
+        if status != 200:
+            return jsonify(data), status
+        for i, result in zip(positions[index], data["results"]):
+            merged[i] = result
+    failed = sum(1 for r in merged if r['code'] >= 400)
+    return jsonify({'results': merged, 'applied': len(merged) - failed, 'failed': failed}), 200
+
+# ---------------------------------------------------------------------------
+# Offline export (--export FILE --duration 24h)
+# Runs the device models headless, with no broker, HTTP server or threads.
+# The same tick slots as start_scheduler() are walked in simulated-time
+# order as fast as the CPU allows. Every uplink is written with its topic and
+# tick timestamp, exactly as it would have been published:
+#   *.jsonl / *.jsonl.gz  one {"ts": ..., "topic": ..., "payload": {...}}
+#                         object per line, payload spliced in verbatim
+#   *.parquet             columns ts (timestamp, UTC), topic, payload
+#                         (needs pyarrow)
+# With --seed and --sim-start the file is the same on every run.
+# ---------------------------------------------------------------------------
+EXPORT_COMPRESSLEVEL = 1  # gzip level for *.jsonl.gz; higher is smaller but slower
+EXPORT_BATCH_ROWS = 100000  # rows buffered per write / Parquet row group
+
+def parse_duration(text):
+    """"24h" / "90m" / "45s" / "3600" -> seconds."""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    text = str(text).strip().lower()
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+class JsonlExport:
+    def __init__(self, path):
+        if path.endswith(".gz"):
+            self.fh = gzip.open(path, "wt", encoding="utf-8", compresslevel=EXPORT_COMPRESSLEVEL)
         else:
-            return jsonify({'error': 'invalid fan value'}), 400
+            self.fh = open(path, "w", encoding="utf-8")
+        self.lines = []
 
-    # mode
-    if 'mode' in request.args:
-        m = request.args.get('mode').lower()
-        if m in ('cool', 'heat', 'auto', 'vent', 'dehumidify', 'off'):
-            updates['mode'] = m
+    def write(self, at, timestamp, messages):
+        prefix = f'{{"ts": "{timestamp}", "topic": '
+        for topic, payload, _, _ in messages:
+            self.lines.append(f'{prefix}{json.dumps(topic)}, "payload": {payload}}}\n')
+        if len(self.lines) >= EXPORT_BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        self.fh.write("".join(self.lines))
+        self.lines = []
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+class ParquetExport:
+    def __init__(self, path):
+        self.schema = pa.schema([("ts", pa.timestamp("us", tz="UTC")), ("topic", pa.string()),
+                                 ("payload", pa.string())])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self.start_us = int(sim_clock.start.timestamp() * 1_000_000)
+        self.columns = ([], [], [])
+
+    def write(self, at, timestamp, messages):
+        ts, topics, payloads = self.columns
+        micros = self.start_us + round(at * 1_000_000)
+        for topic, payload, _, _ in messages:
+            ts.append(micros)
+            topics.append(topic)
+            payloads.append(payload)
+        if len(ts) >= EXPORT_BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.columns[0]:
+            self.writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(self.columns, self.schema)],
+                schema=self.schema))
+            self.columns = ([], [], [])
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def export_slots(duration):
+    """(deadline, seq, device, apartment or None, interval) heap of every tick slot up to `duration`."""
+    apartments = list(APARTMENTS)
+    n_apts = len(apartments)
+    n_types = len(DEVICE_UPDATERS)
+    slots = []
+    for k, device in enumerate(DEVICE_UPDATERS):
+        interval = DEVICE_INTERVALS.get(device, DATA_SENDING_INTERVAL)
+        if VECTORIZED and device in VECTOR_UPDATERS:
+            slots.append((interval * k / n_types, len(slots), device, None, interval))
+            continue
+        for i, apt in enumerate(apartments):
+            slots.append((interval * (i * n_types + k) / (n_apts * n_types), len(slots), device, apt, interval))
+    heapq.heapify(slots)
+    return slots
+
+def export_uplinks(duration):
+    """Run `duration` simulated seconds of ticks; yields (simulated time, device, uplink messages) per tick."""
+    slots = export_slots(duration)
+    while slots and slots[0][0] < duration:
+        at, seq, device, apt, interval = slots[0]
+        with sim_clock.ticking(at):
+            if apt is None:
+                with all_state_locks():
+                    advance_vectorized(device)
+                    messages = [message for name in APARTMENTS for message in device_uplinks(device, name)]
+            else:
+                messages = tick_uplinks(device, apt)
+            yield at, device, messages
+        heapq.heapreplace(slots, (at + interval, seq, device, apt, interval))
+
+def run_export(path, duration):
+    """Write every uplink of `duration` simulated seconds to `path`; returns the message count."""
+    export = ParquetExport(path) if path.endswith(".parquet") else JsonlExport(path)
+    count = 0
+    try:
+        for at, _, messages in export_uplinks(duration):
+            # still inside the tick: sim_clock reads `at`
+            if messages:
+                export.write(at, sim_clock.isoformat(), messages)
+            count += len(messages)
+    finally:
+        export.close()
+    return count
+
+# ---------------------------------------------------------------------------
+# Benchmarks (python Open_HAB_Data_Rev_7.0.py --bench <name>)
+# These run in-process against the Flask test client and do not need a broker.
+# ---------------------------------------------------------------------------
+POSTMAN_COLLECTION = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "OpenHAB Simulator - Full API Collection.postman_collection.json")
+
+def load_postman_requests(path=POSTMAN_COLLECTION):
+    """Flatten the Postman collection into a list of (method, raw_url) tuples."""
+    with open(path) as fh:
+        collection = json.load(fh)
+    requests_ = []
+    stack = list(reversed(collection.get("item", [])))
+    while stack:
+        entry = stack.pop()
+        if "item" in entry:
+            stack.extend(reversed(entry["item"]))
+            continue
+        url = entry["request"]["url"]
+        requests_.append((entry["request"]["method"], url["raw"] if isinstance(url, dict) else url))
+    return requests_
+
+def _per_call_us(fn, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+# The GET chain this replaced, in its original order: the first
+# (marker, suffix) whose marker is in the name (None = any) and whose suffix
+# ends it wins. Kept so bench_items has a baseline to compare against.
+LEGACY_ITEM_CHAIN = [(None, f"_{field}", "aqi", field) for field in ["temp", "humd", "co2", "battery"]] + [
+    (None, f"_socket_{field}", "wallsocket", field)
+    for field in ["current", "voltage", "active_power", "power_consumption", "power_factor"]
+] + [
+    (None, "_socket_status", "wallsocket", "socket_status"),
+    (None, "_curtainstate", "curtain", "curtainstate"),
+    (None, "_curtain_battery", "curtain", "battery"),
+] + [
+    (marker, f"_{field}", device, field)
+    for marker, device, fields in [
+        ("PeopleCounter", "peoplecounter", ["total_in", "total_out", "period_in", "period_out", "battery", "temperature",
+                                            "count"]),
+        ("CircuitBreaker", "scb", ["device_type", "breaker_address", "breaker_type", "switch_state",
+                                   "remote_control_enabled", "voltage_A", "voltage_B", "voltage_C", "current_A",
+                                   "current_B", "current_C", "power_total", "leakage_current", "temperature_device",
+                                   "alarm_overload"]),
+        ("Thermostat", "thermostat", ["setpoint_temperature", "temperature", "humidity", "mode", "status",
+                                      "fan_setting", "valve_status", "fan_status", "co2", "power"]),
+        ("WaterMeter", "watermeter", ["volume", "valve_state", "battery", "low_power", "alarm", "communication_error"]),
+        ("GasMeter", "gasmeter", ["volume", "valve_state", "battery", "low_power", "alarm"]),
+    ]
+    for field in fields
+]
+
+def legacy_resolve_item(item_name):
+    for marker, suffix, device, field in LEGACY_ITEM_CHAIN:
+        if (marker is None or marker in item_name) and item_name.endswith(suffix):
+            return device, field
+    if "Switch" in item_name:
+        return "wallswitch", None
+    if "DoorLock" in item_name and "_door_" in item_name:
+        field = item_name.split('DoorLock_', 1)[-1]
+        if field.startswith('door_'):
+            field = field[len('door_'):]
+        return "doorlock", field
+    return None
+
+def legacy_resolve_switch_item(item_name):
+    for field in SWITCH_ITEM_FIELDS:
+        if item_name.endswith(f"_{field}"):
+            return "wallswitch", field
+    return None
+
+def bench_items(iterations=20000):
+    """Resolution cost of every GET item in the Postman collection: old endswith() chain vs name lookup."""
+    apt = next(iter(APARTMENTS))
+    room = APARTMENTS[apt]["rooms"][0]
+    client = app.test_client()
+    print(f"{'item':42} {'chain us':>9} {'lookup us':>10} {'GET us':>9}")
+    totals = [0.0, 0.0, 0.0]
+    for method, url in load_postman_requests():
+        if method != "GET":
+            continue
+        path = url.split("}}", 1)[-1].replace("{{apartment}}", apt).replace("{{room}}", room)
+        parts = path.strip("/").split("/")
+        item = parts[2]
+        if len(parts) == 5:
+            legacy, resolver = legacy_resolve_switch_item, resolve_switch_item
         else:
-            return jsonify({'error': 'invalid mode value'}), 400
+            legacy, resolver = legacy_resolve_item, resolve_item
+        chain = _per_call_us(legacy, item, iterations)
+        lookup = _per_call_us(resolver, item, iterations)
+        get = _per_call_us(client.get, path, iterations // 20)
+        totals = [totals[0] + chain, totals[1] + lookup, totals[2] + get]
+        print(f"{item:42} {chain:9.3f} {lookup:10.3f} {get:9.1f}")
+    print(f"{'TOTAL':42} {totals[0]:9.3f} {totals[1]:10.3f} {totals[2]:9.1f}")
 
-    # setpoint
-    if 'setpoint' in request.args:
-        try:
-            sp = float(request.args.get('setpoint'))
-        except Exception:
-            return jsonify({'error': 'invalid setpoint value'}), 400
-        updates['setpoint_temperature'] = round(sp, 1)
+def bench_memory(apartments=5000):
+    """Bytes of device state per apartment for the dict and columnar backends."""
+    global STATE_BACKEND
+    generated = generate_apartments({"floors": "1-30", "units": f"{apartments}x1_bedroom"})
+    backend = STATE_BACKEND
+    try:
+        for STATE_BACKEND in ("dict", "columnar"):
+            tracemalloc.start()
+            start = time.perf_counter()
+            state = build_state(generated)
+            elapsed = time.perf_counter() - start
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"{STATE_BACKEND:9} {size / apartments:8.0f} bytes/apartment  build {elapsed:.2f}s ({apartments} apartments)")
+            del state
+    finally:
+        STATE_BACKEND = backend
 
-    if not updates:
-        return jsonify({'error': 'no valid control parameters provided'}), 400
+def bench_vectorized(apartments=10000):
+    """One update pass over every apartment: per-apartment dict updates vs NumPy columns."""
+    global STATE_BACKEND
+    if np is None:
+        print("numpy is not installed")
+        return
+    generated = generate_apartments({"floors": "1-30", "units": f"{apartments}x1_bedroom"})
+    backend = STATE_BACKEND
+    timings = {}
+    try:
+        for STATE_BACKEND in ("dict", "columnar"):
+            load_apartments(generated)
+            gc.collect()
+            gc.disable()  # like timeit: keep collector pauses out of the comparison
+            for device in VECTOR_UPDATERS:
+                start = time.perf_counter()
+                if STATE_BACKEND == "dict":
+                    for apt in APARTMENTS:
+                        DEVICE_UPDATERS[device](apt)
+                else:
+                    advance_vectorized(device)
+                timings.setdefault(device, []).append((time.perf_counter() - start) * 1000)
+            gc.enable()
+    finally:
+        gc.enable()
+        STATE_BACKEND = backend
+    print(f"{'device':14} {'per-apt ms':>11} {'numpy ms':>9} {'speedup':>8}   ({apartments} apartments)")
+    for device, (loop_ms, numpy_ms) in timings.items():
+        print(f"{device:14} {loop_ms:11.1f} {numpy_ms:9.1f} {loop_ms / numpy_ms:7.1f}x")
 
-    device_id = APARTMENTS[apartment].get('thermostat_device_id')
-    if not device_id:
-        return jsonify({'error': 'thermostat not configured for apartment'}), 404
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else float("nan")
 
-    # Apply updates locally and build downlink commands per change
-    commands = []
-    with latest_data_lock:
-        th = latest_data[apartment]['thermostat']
-        # power command
-        if 'power' in updates:
-            th['power'] = updates['power']
-            cmd = bytes([0x00, 0x01, 0x01]) if th['power'] == 'on' else bytes([0x00, 0x01, 0x00])
-            commands.append(cmd)
-        # fan command
-        if 'fan_setting' in updates:
-            th['fan_setting'] = updates['fan_setting']
-            mapping = {'high': 0x00, 'medium': 0x01, 'low': 0x02, 'auto': 0x03}
-            cmd = bytes([0x01, 0x01, mapping[th['fan_setting']]])
-            commands.append(cmd)
-        # mode command
-        if 'mode' in updates:
-            th['mode'] = updates['mode']
-            mapping = {'off':0x00,'cool':0x01,'heat':0x02,'vent':0x03,'dehumidify':0x04,'auto':0x05}
-            cmd = bytes([0x02, 0x01, mapping[th['mode']]])
-            commands.append(cmd)
-        # setpoint command
-        if 'setpoint_temperature' in updates:
-            th['setpoint_temperature'] = updates['setpoint_temperature']
-            # record timestamp so publishes/GETs can verify latest setpoint
-            th['last_setpoint_timestamp'] = datetime.now(timezone.utc).isoformat()
-            val = int(round(th['setpoint_temperature'] * 10))
-            high = (val >> 8) & 0xFF
-            low = val & 0xFF
-            cmd = bytes([0x03, 0x02, high, low])
-            commands.append(cmd)
+def bench_contention(apartments=2000, duration=5.0, readers=4):
+    """GET latency while the ten device updaters run flat out: one global lock vs striped locks."""
+    load_apartments(generate_apartments({"floors": "1-30", "units": f"{apartments}x1_bedroom"}))
+    names = list(APARTMENTS)
+    items = [path for method, path in load_postman_requests() if method == "GET" and "{{room}}" not in path]
+    stripes_default = len(state_locks)
+    print(f"{'locks':>6} {'GETs':>8} {'p50 us':>9} {'p99 us':>9} {'updates/s':>10}   "
+          f"({apartments} apartments, {readers} readers, {duration:.0f}s)")
+    try:
+        for stripes in (1, stripes_default):
+            configure_state_locks(stripes)
+            latencies = []
+            updates = []
+            # every thread checks the deadline itself: with one lock the busy updaters can
+            # starve a sleeping main thread of the GIL for far longer than `duration`
+            deadline = time.perf_counter() + duration
 
-    # Small verification: ensure setpoint persisted in latest_data after applying updates
-    if 'setpoint_temperature' in updates:
-        expected = updates['setpoint_temperature']
-        # quick retry loop (very short) to guard against a race
-        retried = 0
-        while retried < 3:
-            with latest_data_lock:
-                current = latest_data[apartment]['thermostat']['setpoint_temperature']
-            if current == expected:
+            def updater(update):
+                done = 0
+                while time.perf_counter() < deadline:
+                    for apt in names:
+                        update(apt)
+                        done += 1
+                        if time.perf_counter() >= deadline:
+                            break
+                updates.append(done)
+
+            def reader(client):
+                rnd = random.Random()
+                local = []
+                while time.perf_counter() < deadline:
+                    path = rnd.choice(items).split("}}", 1)[-1].replace("{{apartment}}", rnd.choice(names))
+                    start = time.perf_counter()
+                    client.get(path)
+                    local.append((time.perf_counter() - start) * 1e6)
+                latencies.extend(local)
+
+            threads = [threading.Thread(target=updater, args=(u,)) for u in DEVICE_UPDATERS.values()]
+            # clients are created up front: the first test_client() call imports modules,
+            # which would otherwise queue behind the busy updater threads
+            threads += [threading.Thread(target=reader, args=(app.test_client(),)) for _ in range(readers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            print(f"{stripes:6d} {len(latencies):8d} {_percentile(latencies, 50):9.0f} {_percentile(latencies, 99):9.0f} {sum(updates) / duration:10.0f}")
+    finally:
+        configure_state_locks(stripes_default)
+
+def bench_downlinks(iterations=200000):
+    """Command-encoding throughput: building each downlink per request vs the precomputed tables."""
+    tables = {"wallswitch": WALLSWITCH_DOWNLINKS, "wallsocket": WALLSOCKET_DOWNLINKS, "curtain": CURTAIN_DOWNLINKS,
+              "scb": SCB_DOWNLINKS, "watermeter": WATERMETER_DOWNLINKS, "gasmeter": GASMETER_DOWNLINKS,
+              "thermostat fan": THERMOSTAT_FAN_DOWNLINKS, "thermostat mode": THERMOSTAT_MODE_DOWNLINKS}
+    print(f"{'command space':16} {'size':>5} {'encode/s':>12} {'cached/s':>12} {'speedup':>8}")
+    for name, table in tables.items():
+        keys = list(itertools.islice(itertools.cycle(table), iterations))
+        raws = [table[key].raw for key in keys]
+        start = time.perf_counter()
+        for raw in raws:
+            json.dumps({"confirmed": True, "fport": LORAWAN_FPORT,
+                        "data": base64.b64encode(raw).decode()}).encode()
+        encode = iterations / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for key in keys:
+            table[key].payload
+        cached = iterations / (time.perf_counter() - start)
+        print(f"{name:16} {len(table):5} {encode:12,.0f} {cached:12,.0f} {cached / encode:7.1f}x")
+
+def bench_uplinks(apartments=2000):
+    """Uplink serialization throughput per core (single thread), per device type and encoder."""
+    apts = generate_apartments({"units": [{"template": next(iter(APARTMENTS)), "count": apartments}]})
+    state = build_state(apts)
+    encoders = ["json", "template"] + (["orjson"] if orjson is not None else [])
+    print(f"{'device':14} " + " ".join(f"{name + ' /s':>14}" for name in encoders))
+    totals = dict.fromkeys(encoders, 0.0)
+    for device, serializer in UPLINK_SERIALIZERS.items():
+        if device == "wallswitch":
+            uplinks = [(f"{cfg['switch_device_id']}_{room}", state[apt][device][room])
+                       for apt, cfg in apts.items() for room in cfg["rooms"]]
+        else:
+            uplinks = [(cfg.get(f"{device}_device_id"), state[apt][device]) for apt, cfg in apts.items()]
+        rates = []
+        for name in encoders:
+            if name == "template":
+                encode = serializer
+            elif name == "orjson":
+                encode = lambda data, device_id: orjson.dumps(serializer.payload(data, device_id)).decode()
+            else:
+                encode = lambda data, device_id: json.dumps(serializer.payload(data, device_id))
+            start = time.perf_counter()
+            for device_id, data in uplinks:
+                encode(data, device_id)
+            elapsed = time.perf_counter() - start
+            totals[name] += elapsed / len(uplinks)
+            rates.append(len(uplinks) / elapsed)
+        print(f"{device:14} " + " ".join(f"{rate:14,.0f}" for rate in rates))
+    # one uplink of every device type, back to back
+    print(f"{'mix':14} " + " ".join(f"{len(UPLINK_SERIALIZERS) / totals[name]:14,.0f}" for name in encoders))
+
+def bench_publish(apartments=500, passes=3):
+    """Ticks of every device, queued one uplink at a time vs one batch per tick, and coalescing of repeats."""
+    global UPLINK_COALESCE_WINDOW
+    apts = generate_apartments({"units": [{"template": next(iter(APARTMENTS)), "count": apartments}]})
+    load_apartments(apts)
+    drained = [0, 0]  # messages, batches taken off the queue
+    idle = threading.Event()
+    def drain():  # stands in for the MQTT senders; an empty batch marks the end of a run
+        while True:
+            messages, _ = mqtt_queue.get()
+            if not messages:
+                idle.set()
+                continue
+            drained[0] += len(messages)
+            drained[1] += 1
+    def wait_drained():
+        idle.clear()
+        mqtt_queue.put(([], None))
+        idle.wait()
+    threading.Thread(target=drain, daemon=True).start()
+
+    def per_uplink(device):
+        # the unbatched path: re-take the lock and queue once per uplink
+        for apt in apts:
+            DEVICE_UPDATERS[device](apt)
+            rooms = APARTMENTS[apt]["rooms"] if device == "wallswitch" else [None]
+            for room in rooms:
+                with state_lock(apt):
+                    messages = device_uplinks(device, apt, [room] if room else None)
+                for message in messages:
+                    mqtt_publish_batch([message])
+
+    def per_tick(device):
+        for apt in apts:
+            tick_device(device, apt)
+
+    def per_pass(device):
+        # what tick_vectorized() does: the whole building's uplinks as one batch
+        with all_state_locks():
+            for apt in apts:
+                DEVICE_UPDATERS[device](apt)
+            messages = [message for apt in apts for message in device_uplinks(device, apt)]
+        publish_uplinks(messages)
+
+    UPLINK_COALESCE_WINDOW = 0
+    print(f"{apartments} apartments, {passes} ticks of every device")
+    print(f"{'mode':10} {'uplinks/s':>10} {'queue puts':>11}")
+    for mode, tick in (("per uplink", per_uplink), ("per tick", per_tick), ("per pass", per_pass)):
+        drained[:] = [0, 0]
+        start = time.perf_counter()
+        for _ in range(passes):
+            for device in DEVICE_UPDATERS:
+                tick(device)
+        wait_drained()
+        elapsed = time.perf_counter() - start
+        print(f"{mode:10} {drained[0] / elapsed:10,.0f} {drained[1]:11,}")
+
+    # a scheduled tick and a control command's follow-up uplink for every device in one window
+    UPLINK_COALESCE_WINDOW = 60
+    drained[:] = [0, 0]
+    for apt in apts:
+        for device in DEVICE_UPDATERS:
+            tick_device(device, apt)
+            publish_device(device, apt)
+    flush_uplinks()
+    wait_drained()
+    print(f"coalescing: {drained[0] + uplinks_coalesced:,} uplinks produced, {drained[0]:,} sent "
+          f"in {drained[1]} batch(es), {uplinks_coalesced:,} replaced by a newer payload")
+
+def bench_report(apartments=100, duration=6 * 3600):
+    """Uplinks and bytes sent per device type: every tick vs report-on-change vs report-on-change with deltas."""
+    global REPORT_ON_CHANGE, REPORT_DELTAS, SIM_SEED
+    apts = generate_apartments({"units": [{"template": next(iter(APARTMENTS)), "count": apartments}]})
+    modes = {"every tick": (False, False), "on change": (True, False), "deltas": (True, True)}
+    sent = {}
+    SIM_SEED = SIM_SEED or 0  # the same readings in every mode
+    for mode, (REPORT_ON_CHANGE, REPORT_DELTAS) in modes.items():
+        configure_simulation()
+        load_apartments(apts)
+        counts = collections.Counter()
+        start = time.perf_counter()
+        for _, device, messages in export_uplinks(duration):
+            counts[device] += len(messages)
+            counts["bytes"] += sum(len(payload) for _, payload, _, _ in messages)
+        sent[mode] = (counts, time.perf_counter() - start)
+    REPORT_ON_CHANGE = REPORT_DELTAS = False
+    print(f"{apartments} apartments, {duration / 3600:g}h simulated, heartbeat every {REPORT_MAX_INTERVAL}s")
+    print(f"{'uplinks':12} " + " ".join(f"{mode:>12}" for mode in modes))
+    for kind in sorted({kind for counts, _ in sent.values() for kind in counts} - {"bytes"}):
+        print(f"{kind:12} " + " ".join(f"{sent[mode][0][kind]:12,}" for mode in modes))
+    print(f"{'total':12} " + " ".join(f"{sum(sent[mode][0].values()) - sent[mode][0]['bytes']:12,}"
+                                      for mode in modes))
+    print(f"{'MB':12} " + " ".join(f"{sent[mode][0]['bytes'] / 1e6:12.1f}" for mode in modes))
+    print(f"{'seconds':12} " + " ".join(f"{sent[mode][1]:12.1f}" for mode in modes))
+
+def bench_qos(duration=3.0, windows=(1, 10, 100, 1000)):
+    """Acknowledged uplinks/s and ack latency per QoS level and in-flight window (needs the broker)."""
+    sample = new_apartment_state("", {"rooms": []})["scb"]
+    message = ["sim/bench/uplink", serialize_uplink("scb", "scb_bench", sample), 0, False]
+    print(f"broker {MQTT_SERVER}:{MQTT_PORT}, {len(message[1])}-byte SCB uplinks, {duration:.0f}s per run")
+    print(f"{'qos':>3} {'window':>6} {'acked/s':>9} {'ack p50 ms':>11} {'ack p99 ms':>11}")
+    for qos in (0, 1, 2):
+        # QoS 0 is never acknowledged, so the window does not apply
+        for size in windows if qos else windows[-1:]:
+            client, connected, window = _new_mqtt_client(size)
+            client.connect_async(MQTT_SERVER, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+            client.loop_start()
+            if not connected.wait(5):
+                print(f"[bench error] no broker at {MQTT_SERVER}:{MQTT_PORT}")
+                return
+            with qos_stats_lock:
+                acked = qos_stats[qos]["acked"]
+                qos_stats[qos]["acks"].clear()
+            message[2] = qos
+            start = time.perf_counter()
+            deadline = start + duration
+            while time.perf_counter() < deadline:
+                publish_message(client, connected, window, tuple(message))
+            with window.cond:
+                window.cond.wait_for(lambda: not window.pending, timeout=10)
+            elapsed = time.perf_counter() - start
+            client.disconnect()
+            client.loop_stop()
+            with qos_stats_lock:
+                acked = qos_stats[qos]["acked"] - acked
+                latencies = sorted(latency for _, latency in qos_stats[qos]["acks"])
+            print(f"{qos:3} {size if qos else '-':>6} {acked / elapsed:9,.0f} "
+                  f"{_percentile(latencies, 50) * 1000:11.2f} {_percentile(latencies, 99) * 1000:11.2f}")
+
+def _shard_tick_worker(apartments, duration, results):
+    load_apartments(apartments)
+    ticks, elapsed = 0, 0.0
+    start = time.perf_counter()
+    for apt in itertools.cycle(apartments):
+        for device, update in DEVICE_UPDATERS.items():
+            with state_lock(apt):
+                update(apt)
+                device_uplinks(device, apt)
+            ticks += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+    # always report, so bench_shards() is not left waiting on an empty partition
+    results.put(ticks / elapsed if elapsed else 0.0)
+
+def bench_transport(apartments=500, passes=4):
+    """Publish throughput with no broker: ticks -> outbox -> queue -> MQTT senders -> in-memory sink."""
+    global MQTT_TRANSPORT, UPLINK_COALESCE_WINDOW
+    MQTT_TRANSPORT, UPLINK_COALESCE_WINDOW = "memory", 0
+    apts = generate_apartments({"units": [{"template": next(iter(APARTMENTS)), "count": apartments}]})
+    load_apartments(apts)
+    start_mqtt_pool()
+
+    def wait_sunk(direction, expected):
+        while memory_sink.count(direction) < expected:
+            time.sleep(0.001)
+
+    print(f"{apartments} apartments, {passes} ticks of every device, {MQTT_POOL_SIZE} MQTT sender(s)")
+    print(f"{'uplinks':14} {'messages':>9} {'msgs/s':>9} {'MB/s':>7}")
+    for qos in (0, 1, 2):
+        DEVICE_QOS.update(dict.fromkeys(DEVICE_QOS, qos))
+        memory_sink.reset()
+        expected = 0
+        start = time.perf_counter()
+        for _ in range(passes):
+            for device in DEVICE_UPDATERS:
+                for apt in apts:
+                    messages = tick_uplinks(device, apt)
+                    expected += len(messages)
+                    publish_uplinks(messages)
+                # stay clear of MQTT_QUEUE_SIZE; the senders share this core
+                while mqtt_queue.qsize() > MQTT_QUEUE_SIZE // 2:
+                    time.sleep(0.001)
+        wait_sunk("uplink", expected)
+        elapsed = time.perf_counter() - start
+        sink = memory_sink.snapshot()["uplink"]
+        print(f"{f'qos {qos}':14} {sink['messages']:9,} {sink['messages'] / elapsed:9,.0f} "
+              f"{sink['bytes'] / elapsed / 1e6:7.1f}")
+    DEVICE_QOS.update(dict.fromkeys(DEVICE_QOS, 0))
+
+    # control commands through the HTTP views, down to the sink
+    client = app.test_client()
+    memory_sink.reset()
+    start = time.perf_counter()
+    for apt in apts:
+        client.put(f"/{apt}/items/Update_Apartment_smart_Curtain/state?curtainstate=50")
+    wait_sunk("downlink", len(apts))
+    elapsed = time.perf_counter() - start
+    print(f"{'curtain PUTs':14} {memory_sink.count('downlink'):9,} {len(apts) / elapsed:9,.0f}")
+
+def bench_shards(apartments=2000, duration=3.0):
+    """Device ticks/s (update + uplink serialization) with the apartments split over 1..N processes."""
+    apts = generate_apartments({"units": [{"template": next(iter(APARTMENTS)), "count": apartments}]})
+    cores = os.cpu_count() or 1
+    counts = sorted({1, 2, cores} | {n for n in (4, 8, 16) if n < cores})
+    print(f"{cores} CPU core(s), {apartments} apartments, {duration:.0f}s per run")
+    print(f"{'processes':>9} {'ticks/s':>12} {'scaling':>8}")
+    base = None
+    for shards in counts:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_shard_tick_worker, args=(part, duration, results))
+                     for part in partition_apartments(apts, shards)]
+        for process in processes:
+            process.start()
+        try:
+            rate = sum(results.get(timeout=duration + 60) for _ in processes)
+        except queue.Empty:
+            print(f"[bench error] a shard worker did not report within {duration + 60:.0f}s")
+            for process in processes:
+                process.terminate()
+            return
+        for process in processes:
+            process.join()
+        base = base or rate
+        print(f"{shards:9} {rate:12,.0f} {rate / base:7.2f}x")
+
+async def _http_client(port, path, deadline, latencies, errors):
+    """One client issuing GET `path` back to back until `deadline`, on a kept-alive
+    connection where the server allows it (reconnecting when it closes)."""
+    request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+    writer = None
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if writer is None:
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), 10)
+                except (OSError, asyncio.TimeoutError):
+                    errors["connect"] += 1
+                    return
+            writer.write(request)
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            lines = head.lower().split(b"\r\n")
+            length = next(int(line.split(b":", 1)[1]) for line in lines if line.startswith(b"content-length:"))
+            await asyncio.wait_for(reader.readexactly(length), 10)
+            latencies.append(time.perf_counter() - start)
+            if lines[0].startswith(b"http/1.0") or b"connection: close" in lines:
+                writer.close()
+                writer = None
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, StopIteration):
+        errors["request"] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+async def _connection_load(port, path, connections, duration):
+    latencies, errors = [], collections.Counter()
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(_http_client(port, path, deadline, latencies, errors) for _ in range(connections)))
+    return latencies, errors
+
+@contextlib.contextmanager
+def _server_process(options, port, path):
+    """Run this script as an HTTP server subprocess with `options` until `path` answers."""
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), *options, "--port", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(150):
+            try:
+                http.client.HTTPConnection("127.0.0.1", port, timeout=1).request("GET", path)
                 break
-            # re-write under lock as a defensive attempt
-            with latest_data_lock:
-                latest_data[apartment]['thermostat']['setpoint_temperature'] = expected
-                latest_data[apartment]['thermostat']['last_setpoint_timestamp'] = datetime.now(timezone.utc).isoformat()
-            retried += 1
+            except OSError:
+                time.sleep(0.1)
+        yield server
+    finally:
+        server.terminate()
+        server.wait()
+
+def bench_connections(duration=5.0, levels=(50, 200, 500, 1000)):
+    """Concurrent keep-alive clients against each runtime's HTTP server (started as a subprocess)."""
+    runtimes = ["threads"] + (["asyncio"] if uvicorn is not None else [])
+    port = HTTP_SERVER_PORT + 100
+    path = "/studio_apartment/items/AQI_temp/state"
+    print(f"{'runtime':8} {'conns':>6} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'conn err':>9} {'req err':>8}")
+    for runtime in runtimes:
+        with _server_process(["--runtime", runtime], port, path):
+            for connections in levels:
+                latencies, errors = asyncio.run(_connection_load(port, path, connections, duration))
+                latencies.sort()
+                print(f"{runtime:8} {connections:6} {len(latencies) / duration:9,.0f} "
+                      f"{_percentile(latencies, 50) * 1000:8.1f} {_percentile(latencies, 99) * 1000:8.1f} "
+                      f"{errors['connect']:9} {errors['request']:8}")
+
+def bench_wsgi(duration=5.0, connections=64):
+    """GET item reads/s through each --server mode (started as a subprocess)."""
+    workers = max(2, os.cpu_count() or 1)
+    servers = {"dev": ["--server", "dev"]}
+    if waitress is not None:
+        servers["waitress"] = ["--server", "waitress"]
+    if gunicorn_app is not None:
+        servers[f"gunicorn x{workers}"] = ["--server", "gunicorn", "--workers", str(workers)]
+    port = HTTP_SERVER_PORT + 100
+    path = "/studio_apartment/items/AQI_temp/state"
+    print(f"{os.cpu_count() or 1} CPU core(s), {connections} keep-alive clients, {duration:.0f}s per server")
+    print(f"{'server':12} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, options in servers.items():
+        with _server_process(options, port, path):
+            latencies, errors = asyncio.run(_connection_load(port, path, connections, duration))
+        latencies.sort()
+        print(f"{name:12} {len(latencies) / duration:9,.0f} {_percentile(latencies, 50) * 1000:8.1f} "
+              f"{_percentile(latencies, 99) * 1000:8.1f} {sum(errors.values()):7}")
+
+BENCHMARKS = {
+    "items": bench_items,
+    "memory": bench_memory,
+    "vectorized": bench_vectorized,
+    "contention": bench_contention,
+    "downlinks": bench_downlinks,
+    "uplinks": bench_uplinks,
+    "publish": bench_publish,
+    "report": bench_report,
+    "qos": bench_qos,
+    "transport": bench_transport,
+    "shards": bench_shards,
+    "connections": bench_connections,
+    "wsgi": bench_wsgi,
+}
+
+# ---------------------------------------------------------------------------
+# Load generator (--loadgen [URL])
+# Drives a running simulator, or a sharded front, with the requests of the
+# Postman collection. The building is read from GET /state, and each request
+# fills {{apartment}} / {{room}} with a random apartment and one of its rooms.
+# --connections keep-alive clients start requests at a fixed --rate (open
+# loop): latency is measured from the scheduled start, so a server that falls
+# behind shows up in the percentiles instead of slowing the offered load.
+# --rate 0 sends back to back. --write-ratio is the share of PUTs.
+# ---------------------------------------------------------------------------
+LOADGEN_TIMEOUT = 10  # seconds before a request counts as an error
 
-    # publish each command as a downlink base64 payload
-    sent = []
+def discover_building(host, port):
+    """{apartment: [rooms]} of the simulator at host:port."""
+    conn = http.client.HTTPConnection(host, port, timeout=LOADGEN_TIMEOUT)
     try:
-        for cmd in commands:
-            command_b64 = base64.b64encode(cmd).decode()
-            message = json.dumps({"confirmed": True, "fport": 85, "data": command_b64})
-            topic = f'milesight/downlink/{device_id}'
-            publish.single(topic, message, hostname=MQTT_SERVER, port=MQTT_PORT)
-            sent.append(cmd.hex().upper())
-
-        # schedule an updated thermostat publish after 1s
-        threading.Timer(1.0, publish_thermostat, args=(apartment,)).start()
-        with latest_data_lock:
-            new_state = latest_data[apartment]['thermostat'].copy()
-        return jsonify({'status': 'commands sent', 'commands': sent, 'new_state': new_state}), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        conn.request("GET", "/state?fields=wallswitch")
+        response = conn.getresponse()
+        body = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise ValueError(f"GET /state answered {response.status}")
+    return {apt: list(state.get("wallswitch", {})) for apt, state in json.loads(body).items()}
+
+def loadgen_endpoints(path=POSTMAN_COLLECTION):
+    """(reads, writes): (method, path template) of every request in the collection."""
+    reads, writes = [], []
+    for method, url in load_postman_requests(path):
+        template = url.split("}}", 1)[-1] if url.startswith("{{base_url}}") else url
+        (reads if method == "GET" else writes).append((method, template))
+    return reads, writes
+
+async def _loadgen_client(host, port, next_request, stats):
+    """One keep-alive connection taking requests from next_request() until it returns None."""
+    writer = None
+    try:
+        while True:
+            job = await next_request()
+            if job is None:
+                return
+            scheduled, endpoint, method, path = job
+            status = None
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), LOADGEN_TIMEOUT)
+                writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: 0\r\n\r\n".encode())
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), LOADGEN_TIMEOUT)
+                lines = head.lower().split(b"\r\n")
+                length = next((int(line.split(b":", 1)[1]) for line in lines if line.startswith(b"content-length:")), 0)
+                await asyncio.wait_for(reader.readexactly(length), LOADGEN_TIMEOUT)
+                status = int(lines[0].split()[1])
+                if lines[0].startswith(b"http/1.0") or b"connection: close" in lines:
+                    writer.close()
+                    writer = None
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+                if writer is not None:
+                    writer.close()
+                    writer = None
+            entry = stats[endpoint]
+            if status is not None and status < 400:
+                entry[0].append(time.perf_counter() - scheduled)
+            else:
+                entry[1] += 1
+    finally:
+        if writer is not None:
+            writer.close()
+
+async def _loadgen(host, port, building, reads, writes, duration, rate, write_ratio, connections):
+    rng = random.Random(SIM_SEED)
+    apartments = list(building)
+    with_rooms = [apt for apt in apartments if building[apt]]
+    if not with_rooms:
+        # no wall switch rooms to fill {{room}} with
+        reads = [entry for entry in reads if "{{room}}" not in entry[1]]
+        writes = [entry for entry in writes if "{{room}}" not in entry[1]]
+    stats = collections.defaultdict(lambda: [[], 0])  # endpoint -> [latencies of successes, errors]
+    slots = itertools.count()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    async def next_request():
+        if rate:
+            scheduled = start + next(slots) / rate
+            if scheduled >= deadline:
+                return None
+            if scheduled > time.perf_counter():
+                await asyncio.sleep(scheduled - time.perf_counter())
+        else:
+            scheduled = time.perf_counter()
+            if scheduled >= deadline:
+                return None
+        method, template = rng.choice(writes if writes and rng.random() < write_ratio else reads)
+        if "{{room}}" in template:
+            apt = rng.choice(with_rooms)
+            path = template.replace("{{room}}", rng.choice(building[apt]))
+        else:
+            apt, path = rng.choice(apartments), template
+        return scheduled, f"{method} {template}", method, path.replace("{{apartment}}", apt)
+
+    await asyncio.gather(*(_loadgen_client(host, port, next_request, stats) for _ in range(connections)))
+    return stats, max(duration, time.perf_counter() - start)
+
+def run_loadgen(base_url, duration, rate, write_ratio, connections, collection=POSTMAN_COLLECTION):
+    """Fire the collection at `base_url` for `duration` seconds and print per-endpoint rates, latency and errors."""
+    url = urllib.parse.urlsplit(base_url)
+    host, port = url.hostname or "127.0.0.1", url.port or 80
+    try:
+        building = discover_building(host, port)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        print(f"[loadgen error] cannot read the building from {base_url}: {e}")
+        return
+    if not building:
+        print(f"[loadgen error] {base_url} simulates no apartments")
+        return
+    reads, writes = loadgen_endpoints(collection)
+    stats, elapsed = asyncio.run(_loadgen(host, port, building, reads, writes, duration, rate, write_ratio,
+                                          connections))
+    print(f"{base_url}: {len(building)} apartments, {connections} connections, "
+          f"{f'{rate:,.0f} req/s offered' if rate else 'back to back'}, {write_ratio:.0%} writes, {elapsed:.1f}s")
+    print(f"{'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}  endpoint")
+
+    def row(label, entries):
+        latencies = sorted(latency for entry in entries for latency in entry[0])
+        errors = sum(entry[1] for entry in entries)
+        total = len(latencies) + errors
+        print(f"{total / elapsed:9,.1f} " + " ".join(f"{_percentile(latencies, pct) * 1000:8.1f}" for pct in (50, 95, 99))
+              + f" {errors / total if total else 0:7.1%}  {label}")
+
+    for method, template in reads + writes:
+        endpoint = f"{method} {template}"
+        if endpoint in stats:
+            row(endpoint, [stats[endpoint]])
+    for label, method in (("all reads", "GET"), ("all writes", "PUT")):
+        row(label, [entry for endpoint, entry in stats.items() if endpoint.startswith(method + " ")])
+    row("total", list(stats.values()))
+
+def main():
+    global STATE_BACKEND, VECTORIZED, UPLINK_ENCODER, RUNTIME, HTTP_SERVER_PORT, MQTT_MAX_INFLIGHT, shard_count
+    global SIM_SEED, SIM_SPEED, SIM_START, REPORT_ON_CHANGE, REPORT_MAX_INTERVAL, REPORT_DELTAS, MQTT_TRANSPORT
+    global TICK_OVERRUN_POLICY
+    parser = argparse.ArgumentParser(description="OpenHAB smart building device simulator")
+    parser.add_argument("--bench", choices=sorted(BENCHMARKS), help="run a micro-benchmark and exit")
+    parser.add_argument("--building-spec", metavar="FILE", help="JSON/YAML building spec to generate apartments from")
+    parser.add_argument("--units", help='generate apartments from templates, e.g. "200x1_bedroom,50xstudio_apartment"')
+    parser.add_argument("--floors", help='floors to spread the units over, e.g. "1-30" (default: 1)')
+    parser.add_argument("--state-backend", choices=["dict", "columnar"], default=STATE_BACKEND,
+                        help="in-memory layout of latest_data (default: %(default)s)")
+    parser.add_argument("--numpy", action="store_true",
+                        help="advance each device type for all apartments in one NumPy pass (implies --state-backend columnar)")
+    parser.add_argument("--uplink-encoder", choices=["template", "json", "orjson"], default=UPLINK_ENCODER,
+                        help="how uplink payloads are serialized (default: %(default)s)")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default=RUNTIME,
+                        help="threads: Flask dev server + scheduler threads; asyncio: one event loop served by uvicorn "
+                             "(default: %(default)s)")
+    parser.add_argument("--port", type=int, default=HTTP_SERVER_PORT, help="HTTP port (default: %(default)s)")
+    parser.add_argument("--shards", type=int, default=1, metavar="N",
+                        help="split the apartments over N simulator processes behind one HTTP front (default: 1)")
+    parser.add_argument("--qos", metavar="SPEC",
+                        help='uplink QoS for all device types and/or per type, e.g. "1" or "0,scb=1,doorlock=2"')
+    parser.add_argument("--retain", metavar="SPEC",
+                        help='retain uplinks, for all device types and/or per type, e.g. "on" or "doorlock=on"')
+    parser.add_argument("--max-inflight", type=int, default=MQTT_MAX_INFLIGHT, metavar="N",
+                        help="QoS 1/2 messages per MQTT connection awaiting acknowledgment (default: %(default)s)")
+    parser.add_argument("--transport", choices=["mqtt", "memory"], default=MQTT_TRANSPORT,
+                        help="mqtt: publish to MQTT_SERVER; memory: no broker, count and timestamp messages "
+                             "in-process for /mqtt/stats (default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="reproducible readings: one seeded random stream per device")
+    parser.add_argument("--speed", type=float, default=SIM_SPEED, metavar="FACTOR",
+                        help="simulated seconds per real second, e.g. 1000 (default: %(default)s)")
+    parser.add_argument("--sim-start", metavar="ISO",
+                        help='simulated time at startup, e.g. "2026-01-01T00:00:00+00:00" (default: now)')
+    parser.add_argument("--overrun", choices=["compress", "skip", "spread"], default=TICK_OVERRUN_POLICY,
+                        help="when ticks fall a whole interval behind: compress runs every missed tick back to back, "
+                             "skip drops the missed ticks, spread works them off at up to twice the normal rate "
+                             "(default: %(default)s)")
+    parser.add_argument("--report-on-change", action="store_true",
+                        help="only send an uplink when one of its fields changed, plus a periodic full heartbeat")
+    parser.add_argument("--heartbeat", type=float, default=REPORT_MAX_INTERVAL, metavar="SECONDS",
+                        help="with --report-on-change: simulated seconds between full payloads, 0 for none "
+                             "(default: %(default)s)")
+    parser.add_argument("--deltas", action="store_true",
+                        help="with --report-on-change: send only the changed fields between heartbeats")
+    parser.add_argument("--export", metavar="FILE",
+                        help="headless: write --duration of uplinks to FILE (.jsonl, .jsonl.gz or .parquet) and exit")
+    parser.add_argument("--duration",
+                        help='simulated time covered by --export (default: 24h), or how long --loadgen runs '
+                             '(default: 30s), e.g. "24h", "90m"')
+    parser.add_argument("--loadgen", nargs="?", const="", metavar="URL",
+                        help="drive the simulator at URL (default: this host's --port) with the Postman collection "
+                             "and report req/s, latency and errors per endpoint")
+    parser.add_argument("--rate", type=float, default=0, metavar="RPS",
+                        help="--loadgen requests started per second, 0 for back to back (default: %(default)s)")
+    parser.add_argument("--write-ratio", type=float, default=0.1, metavar="FRACTION",
+                        help="share of --loadgen requests that are PUTs (default: %(default)s)")
+    parser.add_argument("--connections", type=int, default=64, metavar="N",
+                        help="--loadgen keep-alive connections (default: %(default)s)")
+    parser.add_argument("--collection", default=POSTMAN_COLLECTION, metavar="FILE",
+                        help="Postman collection --loadgen takes its requests from (default: the bundled one)")
+    parser.add_argument("--server", choices=["dev", "waitress", "gunicorn"], default="dev",
+                        help="HTTP server of the threads runtime: dev (Flask's), waitress (threaded), or gunicorn "
+                             "(worker processes sharing one state service) (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, metavar="N",
+                        help="gunicorn worker processes (default: CPU count)")
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS, metavar="N",
+                        help="request threads of waitress / of each gunicorn worker (default: %(default)s)")
+    parser.add_argument("--state-service", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.state_service:
+        # started by start_state_service(); everything else comes from the parent on stdin
+        run_state_service(*pickle.load(sys.stdin.buffer))
+        return
+
+    STATE_BACKEND = args.state_backend
+    if args.numpy:
+        if np is None:
+            parser.error("--numpy requires numpy (pip install numpy)")
+        VECTORIZED = True
+        STATE_BACKEND = "columnar"
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.uplink_encoder == "orjson" and orjson is None:
+        parser.error("--uplink-encoder orjson requires orjson (pip install orjson)")
+    UPLINK_ENCODER = args.uplink_encoder
+    if args.runtime == "asyncio" and uvicorn is None:
+        parser.error("--runtime asyncio requires uvicorn (pip install uvicorn)")
+    RUNTIME = args.runtime
+    HTTP_SERVER_PORT = args.port
+    if args.server != "dev" and (RUNTIME != "threads" or args.shards > 1):
+        parser.error("--server applies to the threads runtime without --shards")
+    if args.server == "waitress" and waitress is None:
+        parser.error("--server waitress requires waitress (pip install waitress)")
+    if args.server == "gunicorn" and gunicorn_app is None:
+        parser.error("--server gunicorn requires gunicorn (pip install gunicorn)")
+    if args.workers < 1 or args.threads < 1:
+        parser.error("--workers and --threads must be at least 1")
+    try:
+        if args.qos:
+            DEVICE_QOS.update(parse_device_values(args.qos, parse_qos))
+        if args.retain:
+            DEVICE_RETAIN.update(parse_device_values(args.retain, parse_flag))
+    except ValueError as e:
+        parser.error(str(e))
+    if args.max_inflight < 1:
+        parser.error("--max-inflight must be at least 1")
+    MQTT_MAX_INFLIGHT = args.max_inflight
+    MQTT_TRANSPORT = args.transport
+    TICK_OVERRUN_POLICY = args.overrun
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    SIM_SEED, SIM_SPEED = args.seed, args.speed
+    if args.sim_start:
+        try:
+            SIM_START = datetime.fromisoformat(args.sim_start)
+        except ValueError as e:
+            parser.error(f"invalid --sim-start: {e}")
+        if SIM_START.tzinfo is None:
+            SIM_START = SIM_START.replace(tzinfo=timezone.utc)
+    configure_simulation()
+    if args.heartbeat < 0:
+        parser.error("--heartbeat must not be negative")
+    if args.deltas and not args.report_on_change:
+        parser.error("--deltas requires --report-on-change")
+    REPORT_ON_CHANGE, REPORT_MAX_INTERVAL, REPORT_DELTAS = args.report_on_change, args.heartbeat, args.deltas
+    if args.export:
+        if args.export.endswith(".parquet") and pa is None:
+            parser.error("--export *.parquet requires pyarrow (pip install pyarrow)")
+        if not args.export.endswith((".jsonl", ".jsonl.gz", ".parquet")):
+            parser.error("--export FILE must end in .jsonl, .jsonl.gz or .parquet")
+        if args.shards > 1:
+            parser.error("--export runs in one process; drop --shards")
+    if args.loadgen is not None:
+        if args.rate < 0 or not 0 <= args.write_ratio <= 1 or args.connections < 1:
+            parser.error("--rate must not be negative, --write-ratio must be 0-1, --connections at least 1")
+        if not os.path.isfile(args.collection):
+            parser.error(f"--collection {args.collection} not found")
+    args.duration = args.duration or ("24h" if args.export else "30s")
+    try:
+        duration = parse_duration(args.duration)
+    except ValueError:
+        parser.error(f"invalid --duration {args.duration!r}")
+
+    if args.loadgen is not None:
+        run_loadgen(args.loadgen or f"http://127.0.0.1:{args.port}", duration, args.rate, args.write_ratio,
+                    args.connections, args.collection)
+        return
+
+    if args.building_spec or args.units:
+        spec = load_building_spec(args.building_spec) if args.building_spec else {}
+        if args.units:
+            spec["units"] = args.units
+        if args.floors:
+            spec["floors"] = args.floors
+        start = time.perf_counter()
+        try:
+            load_apartments(generate_apartments(spec))
+        except (KeyError, ValueError) as e:
+            parser.error(f"invalid building spec: {e}")
+        print(f"[startup] generated {len(APARTMENTS)} apartments in {time.perf_counter() - start:.2f}s")
+    elif STATE_BACKEND != "dict" or SIM_SEED is not None or SIM_START is not None:
+        # rebuild the initial state with the configured backend / seed / start time
+        load_apartments(APARTMENTS)
+
+    if args.bench:
+        BENCHMARKS[args.bench]()
+        return
+
+    if args.export:
+        start = time.perf_counter()
+        count = run_export(args.export, duration)
+        elapsed = time.perf_counter() - start
+        print(f"[export] {count:,} uplinks covering {args.duration} of simulated time to {args.export} "
+              f"in {elapsed:.1f}s ({count / elapsed * 60:,.0f}/min)")
+        if REPORT_ON_CHANGE:
+            print(f"[export] {uplinks_unchanged:,} ticks skipped with no changed fields")
+        return
+
+    if args.shards > 1:
+        shard_count = args.shards
+        start_shards(shard_count, {"STATE_BACKEND": STATE_BACKEND, "VECTORIZED": VECTORIZED,
+                                   "UPLINK_ENCODER": UPLINK_ENCODER, "RUNTIME": RUNTIME,
+                                   "HTTP_SERVER_PORT": HTTP_SERVER_PORT, "MQTT_MAX_INFLIGHT": MQTT_MAX_INFLIGHT,
+                                   "MQTT_TRANSPORT": MQTT_TRANSPORT, "TICK_OVERRUN_POLICY": TICK_OVERRUN_POLICY,
+                                   "DEVICE_QOS": DEVICE_QOS, "DEVICE_RETAIN": DEVICE_RETAIN, **report_settings(),
+                                   **simulation_settings()})
+        front.run(host="0.0.0.0", port=HTTP_SERVER_PORT, debug=False, use_reloader=False)
+        return
+
+    if RUNTIME == "asyncio":
+        asyncio.run(run_asyncio("0.0.0.0", HTTP_SERVER_PORT))
+        return
+
+    if args.server == "gunicorn":
+        # simulation and MQTT live in the state service; the gunicorn master forks thread-free
+        run_gunicorn("0.0.0.0", HTTP_SERVER_PORT, args.workers, args.threads,
+                     {"STATE_BACKEND": STATE_BACKEND, "VECTORIZED": VECTORIZED,
+                      "UPLINK_ENCODER": UPLINK_ENCODER, "HTTP_SERVER_PORT": HTTP_SERVER_PORT,
+                      "MQTT_MAX_INFLIGHT": MQTT_MAX_INFLIGHT, "MQTT_TRANSPORT": MQTT_TRANSPORT,
+                      "TICK_OVERRUN_POLICY": TICK_OVERRUN_POLICY, "DEVICE_QOS": DEVICE_QOS,
+                      "DEVICE_RETAIN": DEVICE_RETAIN, **report_settings(), **simulation_settings()})
+        return
+
+    start_mqtt_pool()
+    start_scheduler()
+    if args.server == "waitress":
+        waitress.serve(app, host="0.0.0.0", port=HTTP_SERVER_PORT, threads=args.threads)
+        return
+    app.run(host="0.0.0.0", port=HTTP_SERVER_PORT, debug=False, use_reloader=False)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=HTTP_SERVER_PORT, debug=False, use_reloader=False)
\ No newline at end of file
+    main()
\ No newline at end of file
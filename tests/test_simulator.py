@@ -0,0 +1,1003 @@
+"""Behaviour tests for the simulator, run against the Flask test client and
+the MQTT broker at MQTT_SERVER:MQTT_PORT:
+
+    python -m pytest -q
+"""
+import asyncio
+import base64
+import gzip
+import importlib.util
+import json
+import multiprocessing
+import pathlib
+import queue
+import socket
+import threading
+import time
+import types
+from datetime import datetime, timezone
+
+import paho.mqtt.client as mqtt
+import pytest
+from werkzeug.serving import make_server
+from werkzeug.test import EnvironBuilder
+
+SIMULATOR = pathlib.Path(__file__).resolve().parent.parent / "Open_HAB_Data_Rev_7.0.py"
+
+
+@pytest.fixture(scope="module")
+def sim():
+    spec = importlib.util.spec_from_file_location("open_hab_simulator", SIMULATOR)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    try:
+        socket.create_connection((module.MQTT_SERVER, module.MQTT_PORT), timeout=1).close()
+    except OSError:
+        pytest.skip(f"no MQTT broker at {module.MQTT_SERVER}:{module.MQTT_PORT}")
+    module.start_mqtt_pool()
+    # one worker for schedule()d jobs; no periodic device ticks
+    threading.Thread(target=module.scheduler_worker, daemon=True).start()
+    return module
+
+
+@pytest.fixture(scope="module")
+def building(sim):
+    return dict(sim.APARTMENTS)
+
+
+@pytest.fixture
+def client(sim, building):
+    sim.load_apartments(building)
+    yield sim.app.test_client()
+    # drop the follow-up uplinks and outbox flush a test left scheduled, so they do not land in the next one
+    with sim.scheduler_cond:
+        sim.scheduler_heap.clear()
+    with sim.outbox_lock:
+        sim.uplink_outbox.clear()
+
+
+@pytest.fixture
+def downlinks(sim):
+    """(topic, payload) of every downlink the broker routes while the test runs."""
+    received = []
+    subscribed = threading.Event()
+    subscriber = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    subscriber.on_connect = lambda c, *args: c.subscribe("milesight/downlink/#")
+    subscriber.on_subscribe = lambda *args: subscribed.set()
+    subscriber.on_message = lambda c, u, message: received.append((message.topic, message.payload.decode()))
+    subscriber.connect(sim.MQTT_SERVER, sim.MQTT_PORT)
+    subscriber.loop_start()
+    assert subscribed.wait(5)
+    # downlinks an earlier test left in flight are not this test's
+    assert wait_for(sim.mqtt_queue.empty)
+    time.sleep(0.1)
+    received.clear()
+    yield received
+    subscriber.loop_stop()
+    subscriber.disconnect()
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Building generation
+# ---------------------------------------------------------------------------
+def test_generate_apartments(sim, building):
+    apartments = sim.generate_apartments({"units": "3x1_bedroom,1xstudio_apartment", "floors": "2-3"})
+    assert list(apartments) == ["1_bedroom_f2_01", "1_bedroom_f3_01", "1_bedroom_f2_02", "studio_apartment_f3_02"]
+    unit = apartments["1_bedroom_f3_01"]
+    assert unit["rooms"] == building["1_bedroom"]["rooms"]
+    assert unit["floor"] == 3
+    assert unit["socket_device_id"] == "socket_1_bedroom_f3_01"
+    with pytest.raises(ValueError):
+        sim.generate_apartments({"units": "2xpenthouse"})
+    with pytest.raises(ValueError):
+        sim.parse_units("two studios")
+    assert sim.parse_floors("1,3,5-7") == [1, 3, 5, 6, 7]
+
+
+def test_load_apartments(sim, client):
+    sim.load_apartments(sim.generate_apartments({"units": "2xstudio_apartment"}))
+    assert set(sim.latest_data) == {"studio_apartment_f1_01", "studio_apartment_f1_02"}
+    assert client.get("/studio_apartment_f1_02/items/AQI_temp/state").status_code == 200
+    assert client.get("/studio_apartment/items/AQI_temp/state").status_code == 404
+
+
+# ---------------------------------------------------------------------------
+# State backends
+# ---------------------------------------------------------------------------
+def test_columnar_backend(sim, building, client, monkeypatch):
+    fields = {device: set(state) for device, state in client.get("/studio_apartment/state").get_json().items()}
+    monkeypatch.setattr(sim, "STATE_BACKEND", "columnar")
+    sim.load_apartments(building)
+    assert isinstance(sim.latest_data, sim.ColumnarState)
+    for update in sim.DEVICE_UPDATERS.values():
+        update("studio_apartment")
+
+    state = client.get("/studio_apartment/state").get_json()
+    assert {device: set(values) for device, values in state.items()} == fields
+    assert client.get("/studio_apartment/items/AQI_temp/state").get_data(as_text=True) == str(state["aqi"]["temp"])
+    room = building["studio_apartment"]["rooms"][0]
+    assert client.put(f"/studio_apartment/items/Update_Apartment_smart_Switch/{room}/state?switch_2=on").status_code == 202
+    assert sim.latest_data["studio_apartment"]["wallswitch"][room]["switch_2"] == 1
+
+
+def test_vectorized_pass_logs_every_change(sim, building, client, monkeypatch):
+    pytest.importorskip("numpy")
+    monkeypatch.setattr(sim, "STATE_BACKEND", "columnar")
+    sim.load_apartments(building)
+    before = client.get("/state").get_json()
+    version = client.get("/changes?timeout=0").get_json()["version"]
+    for device in sim.VECTOR_UPDATERS:
+        sim.advance_vectorized(device)
+    after = client.get("/state").get_json()
+
+    changed = {}
+    for apt, devices in after.items():
+        for device, state in devices.items():
+            for field, value in state.items():
+                if device == "wallswitch":
+                    for room_field, room_value in value.items():
+                        if room_value != before[apt][device][field][room_field]:
+                            changed[apt, device, f"{field}.{room_field}"] = room_value
+                elif value != before[apt][device][field]:
+                    changed[apt, device, field] = value
+    assert changed
+    changes = client.get(f"/changes?since={version}&timeout=0").get_json()["changes"]
+    assert {(c["apartment"], c["device"], c["field"]): c["value"] for c in changes} == changed
+
+
+def test_state_lock_stripes(sim, client):
+    sim.load_apartments(sim.generate_apartments({"units": "8xstudio_apartment"}))
+    busy = "studio_apartment_f1_01"
+    other = next(apt for apt in sim.APARTMENTS if sim.state_lock(apt) is not sim.state_lock(busy))
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with sim.state_lock(busy):
+            held.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    assert held.wait(5)
+    read = []
+    reader = threading.Thread(target=lambda: read.append(
+        sim.app.test_client().get(f"/{busy}/items/AQI_temp/state").status_code))
+    try:
+        # another stripe is not held up by the busy apartment
+        assert client.get(f"/{other}/items/AQI_temp/state").status_code == 200
+        reader.start()
+        time.sleep(0.1)
+        assert read == []
+    finally:
+        release.set()
+        holder.join()
+    reader.join(5)
+    assert read == [200]
+
+
+# ---------------------------------------------------------------------------
+# Tick scheduler
+# ---------------------------------------------------------------------------
+def test_scheduler_rearms_against_deadline(sim):
+    ran = []
+
+    def job():
+        ran.append(time.monotonic())
+
+    sim.schedule(0, job, interval=0.05)
+    assert wait_for(lambda: len(ran) >= 4)
+    with sim.scheduler_cond:
+        sim.scheduler_heap[:] = [entry for entry in sim.scheduler_heap if entry[2] is not job]
+        sim.heapq.heapify(sim.scheduler_heap)
+    # a late run does not push the following deadlines back
+    assert ran[3] - ran[0] == pytest.approx(0.15, abs=0.05)
+
+
+# ---------------------------------------------------------------------------
+# GET item state
+# ---------------------------------------------------------------------------
+@pytest.mark.parametrize("item, device, field", [
+    ("Studio_AQI_temp", "aqi", "temp"),
+    ("Studio_socket_status", "wallsocket", "socket_status"),
+    ("Studio_curtainstate", "curtain", "curtainstate"),
+    ("Studio_PeopleCounter_total_in", "peoplecounter", "total_in"),
+    ("Studio_CircuitBreaker_voltage_A", "scb", "voltage_A"),
+    ("Studio_Thermostat_setpoint_temperature", "thermostat", "setpoint_temperature"),
+    ("DoorLock_door_auto_relock", "doorlock", "auto_relock"),
+])
+def test_get_item_state(sim, client, item, device, field):
+    response = client.get(f"/studio_apartment/items/{item}/state")
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == str(sim.latest_data["studio_apartment"][device][field])
+
+
+# item names the old endswith() chain answered from another device
+CHANGED_ITEMS = {
+    "Thermostat_co2": ("thermostat", "co2"),
+    "Thermostat_valve_status": ("thermostat", "valve_status"),
+    "Thermostat_fan_status": ("thermostat", "fan_status"),
+    "Curtain_curtain_battery": ("curtain", "battery"),
+    "PeopleCounter_battery": ("peoplecounter", "battery"),
+    "DoorLock_door_battery": ("doorlock", "battery"),
+    "WaterMeter_battery": ("watermeter", "battery"),
+    "GasMeter_battery": ("gasmeter", "battery"),
+}
+
+
+@pytest.mark.parametrize("item", sorted(CHANGED_ITEMS))
+def test_changed_item_resolutions(sim, client, item):
+    device, field = CHANGED_ITEMS[item]
+    assert sim.resolve_item(item) == sim.resolve_item(f"Studio_{item}") == (device, field)
+    assert sim.legacy_resolve_item(item) != (device, field)
+    response = client.get(f"/studio_apartment/items/{item}/state")
+    assert response.get_data(as_text=True) == str(sim.latest_data["studio_apartment"][device][field])
+
+
+def test_postman_items_resolve_like_the_old_chain(sim):
+    for method, url in sim.load_postman_requests():
+        if method != "GET":
+            continue
+        parts = url.split("}}", 1)[-1].strip("/").split("/")
+        item = parts[2]
+        if len(parts) == 5:
+            assert sim.resolve_switch_item(item) == sim.legacy_resolve_switch_item(item), item
+        else:
+            assert sim.resolve_item(item) == CHANGED_ITEMS.get(item, sim.legacy_resolve_item(item)), item
+
+
+def test_get_wallswitch_item_state(sim, client):
+    room = sim.APARTMENTS["studio_apartment"]["rooms"][0]
+    response = client.get(f"/studio_apartment/items/Studio_Switch_current/{room}/state")
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == str(sim.latest_data["studio_apartment"]["wallswitch"][room]["current"])
+    assert client.get("/studio_apartment/items/Studio_Switch_current/attic/state").status_code == 404
+    assert client.get("/studio_apartment/items/Studio_Switch_current/state").status_code == 400
+
+
+def test_get_item_state_not_found(client):
+    assert client.get("/penthouse/items/Studio_AQI_temp/state").status_code == 404
+    assert client.get("/studio_apartment/items/Studio_unknown_item/state").status_code == 404
+    assert client.get("/studio_apartment/items/DoorLock_door_unknown/state").status_code == 404
+
+
+# ---------------------------------------------------------------------------
+# Bulk state reads
+# ---------------------------------------------------------------------------
+def test_apartment_state(sim, client):
+    body = client.get("/studio_apartment/state").get_json()
+    assert body == json.loads(json.dumps(sim.latest_data["studio_apartment"]))
+    assert client.get("/penthouse/state").status_code == 404
+
+
+def test_state_projection(sim, client):
+    room = sim.APARTMENTS["studio_apartment"]["rooms"][0]
+    body = client.get(f"/state?fields=aqi,scb.voltage_A,wallswitch.{room}").get_json()
+    assert set(body) == set(sim.APARTMENTS)
+    studio = body["studio_apartment"]
+    assert set(studio) == {"aqi", "scb", "wallswitch"}
+    assert studio["aqi"] == sim.latest_data["studio_apartment"]["aqi"]
+    assert studio["scb"] == {"voltage_A": sim.latest_data["studio_apartment"]["scb"]["voltage_A"]}
+    assert set(studio["wallswitch"]) == {room}
+    assert "unknown device" in client.get("/state?fields=toaster").get_json()["error"]
+
+
+# ---------------------------------------------------------------------------
+# /changes
+# ---------------------------------------------------------------------------
+def test_changes_since(sim, client):
+    sim.latest_data["studio_apartment"]["wallsocket"]["socket_status"] = 0
+    version = client.get("/changes?timeout=0").get_json()["version"]
+    client.put("/studio_apartment/items/Update_Apartment_smart_Socket/state?socket_status=on")
+
+    body = client.get(f"/changes?since={version}&timeout=0&apartment=studio_apartment&device=wallsocket").get_json()
+    assert body["gap"] is False
+    assert body["version"] > version
+    assert {"apartment": "studio_apartment", "device": "wallsocket", "field": "socket_status", "value": 1,
+            "version": version + 1} in body["changes"]
+
+    # nothing newer than the head
+    body = client.get(f"/changes?since={body['version']}&timeout=0").get_json()
+    assert body["changes"] == []
+
+
+def test_changes_long_poll(sim, client):
+    sim.latest_data["1_bedroom"]["wallsocket"]["socket_status"] = 1
+    version = client.get("/changes?timeout=0").get_json()["version"]
+    timer = threading.Timer(0.2, client.put, ("/1_bedroom/items/Update_Apartment_smart_Socket/state?socket_status=off",))
+    timer.start()
+    started = time.monotonic()
+    body = client.get(f"/changes?since={version}&timeout=5&apartment=1_bedroom").get_json()
+    timer.join()
+    assert time.monotonic() - started < 5
+    assert [(change["field"], change["value"]) for change in body["changes"]] == [("socket_status", 0)]
+
+
+def test_changes_stream(sim, client):
+    sim.latest_data["studio_apartment"]["wallsocket"]["socket_status"] = 0
+    version = client.get("/changes?timeout=0").get_json()["version"]
+    client.put("/studio_apartment/items/Update_Apartment_smart_Socket/state?socket_status=on")
+    response = client.get("/changes/stream?device=wallsocket", headers={"Last-Event-ID": str(version)}, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    event = next(response.response)
+    response.close()
+    event = event.decode() if isinstance(event, bytes) else event
+    assert event.startswith(f"id: {version + 1}\ndata: ")
+    assert json.loads(event.split("data: ", 1)[1])["field"] == "socket_status"
+
+
+def test_changes_gap_and_errors(client):
+    assert client.get("/changes?since=1000000000&timeout=0").get_json()["gap"] is True
+    assert client.get("/changes?since=abc").status_code == 400
+    assert client.get("/changes?apartment=penthouse&timeout=0").status_code == 404
+
+
+# ---------------------------------------------------------------------------
+# Control PUTs
+# ---------------------------------------------------------------------------
+def test_put_returns_202_with_location(sim, client, downlinks, monkeypatch):
+    monkeypatch.setattr(sim, "UPLINK_AFTER_DOWNLINK", 0.05)
+    sim.latest_data["studio_apartment"]["wallsocket"]["socket_status"] = 0
+    response = client.put("/studio_apartment/items/Update_Apartment_smart_Socket/state?socket_status=on")
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body["new_state"]["socket_status"] == 1
+    assert response.headers["Location"] == f"/commands/{body['command_id']}"
+
+    def record():
+        return client.get(response.headers["Location"]).get_json()
+
+    assert wait_for(lambda: record()["reported_at"] is not None)
+    command = record()
+    assert command["status"] == "sent"
+    assert command["sent"] == command["downlinks"] == 1
+    assert command["topic"] == "milesight/downlink/socket_studio_01"
+    assert wait_for(lambda: downlinks)
+    assert downlinks == [("milesight/downlink/socket_studio_01",
+                          json.dumps({"confirmed": True, "fport": 85, "data": "CAEA/w=="}))]
+
+
+def test_put_errors(client):
+    assert client.put("/penthouse/items/Update_Apartment_smart_Socket/state?socket_status=on").status_code == 404
+    response = client.put("/studio_apartment/items/Update_Apartment_smart_Socket/state")
+    assert response.status_code == 400
+    assert "socket_status" in response.get_json()["error"]
+    assert client.get("/commands/999999").status_code == 404
+
+
+def test_put_with_full_queue(sim, client, monkeypatch):
+    # the senders stay blocked on the real queue, so this one never drains
+    full = queue.Queue(maxsize=1)
+    full.put_nowait(("sim/test_01/uplink", "{}"))
+    monkeypatch.setattr(sim, "mqtt_queue", full)
+    sim.latest_data["studio_apartment"]["wallsocket"]["socket_status"] = 1
+    response = client.put("/studio_apartment/items/Update_Apartment_smart_Socket/state?socket_status=off")
+    assert response.status_code == 503
+    body = response.get_json()
+    assert "queue full" in body["error"]
+    assert response.headers["Location"] == f"/commands/{body['command_id']}"
+    # the state change stays applied; the command is kept as failed
+    assert sim.latest_data["studio_apartment"]["wallsocket"]["socket_status"] == 0
+    command = client.get(response.headers["Location"]).get_json()
+    assert (command["status"], command["sent"], command["reported_at"]) == ("failed", 0, None)
+    assert "queue full" in command["error"]
+
+
+# ---------------------------------------------------------------------------
+# Batch control
+# ---------------------------------------------------------------------------
+def test_batch_operations_are_independent(sim, client, downlinks):
+    room = sim.APARTMENTS["1_bedroom"]["rooms"][0]
+    sim.latest_data["1_bedroom"]["wallsocket"]["socket_status"] = 0
+    response = client.put("/items/Update_Apartments_batch/state", json={"operations": [
+        {"apartment": "1_bedroom", "device": "wallsocket", "command": {"socket_status": True}},
+        {"apartment": "1_bedroom", "device": "toaster", "command": {}},
+        {"apartment": "penthouse", "device": "wallsocket", "command": {"socket_status": "on"}},
+        {"apartment": "1_bedroom", "device": "wallswitch", "room": room, "command": {"switch_1": "on"}},
+    ]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [result["code"] for result in body["results"]] == [202, 400, 404, 202]
+    assert (body["applied"], body["failed"]) == (2, 2)
+    assert sim.latest_data["1_bedroom"]["wallsocket"]["socket_status"] == 1
+    assert sim.latest_data["1_bedroom"]["wallswitch"][room]["switch_1"] == 1
+    assert wait_for(lambda: len(downlinks) == 2)
+    assert sorted(topic for topic, _ in downlinks) == ["milesight/downlink/socket_1bed_01",
+                                                       f"milesight/downlink/switch_1bed_01_{room}"]
+
+
+def test_batch_queues_one_mqtt_batch(sim, client, monkeypatch):
+    batches = []
+
+    def publish_batch(messages, commands=None):
+        batches.append((list(messages), dict(commands or {})))
+
+    monkeypatch.setattr(sim, "mqtt_publish_batch", publish_batch)
+    operations = [{"apartment": apt, "device": "curtain", "command": {"curtainstate": 40}} for apt in sim.APARTMENTS]
+    operations.append({"apartment": "studio_apartment", "device": "thermostat",
+                       "command": {"power": "on", "setpoint": "23"}})
+    body = client.put("/items/Update_Apartments_batch/state", json={"operations": operations}).get_json()
+    assert [result["code"] for result in body["results"]] == [202] * len(operations)
+
+    (messages, commands), = batches
+    command_ids = [result["command_id"] for result in body["results"]]
+    assert len(set(command_ids)) == len(operations)
+    assert commands == {command_id: client.get(f"/commands/{command_id}").get_json()["downlinks"]
+                        for command_id in command_ids}
+    assert commands[command_ids[-1]] == 2
+    assert len(messages) == sum(commands.values())
+
+
+def test_batch_with_full_queue(sim, client, monkeypatch):
+    full = queue.Queue(maxsize=1)
+    full.put_nowait(("sim/test_01/uplink", "{}"))
+    monkeypatch.setattr(sim, "mqtt_queue", full)
+    body = client.put("/items/Update_Apartments_batch/state", json={"operations": [
+        {"apartment": apt, "device": "wallsocket", "command": {"socket_status": "off"}} for apt in sim.APARTMENTS
+    ]}).get_json()
+    assert [result["code"] for result in body["results"]] == [503] * len(sim.APARTMENTS)
+    for result in body["results"]:
+        assert client.get(f"/commands/{result['command_id']}").get_json()["status"] == "failed"
+
+
+@pytest.mark.parametrize("body", [None, {}, {"operations": []}, {"operations": "all"}])
+def test_batch_requires_operations(client, body):
+    assert client.put("/items/Update_Apartments_batch/state", json=body).status_code == 400
+
+
+# ---------------------------------------------------------------------------
+# Downlink tables
+# ---------------------------------------------------------------------------
+# command bytes the control handlers encoded per request before the tables
+BASELINE_COMMANDS = {
+    "WALLSWITCH_DOWNLINKS": {control: bytes([8, control, 255]) for control in range(256)},
+    "WALLSOCKET_DOWNLINKS": {True: bytes([8, 1, 0, 255]), False: bytes([8, 0, 0, 255])},
+    "CURTAIN_DOWNLINKS": {pos: bytes([9, pos, 255]) for pos in range(101)},
+    "SCB_DOWNLINKS": {"on": bytes.fromhex("AA03010101FC0C55"), "off": bytes.fromhex("AA030101003DCC55")},
+    "WATERMETER_DOWNLINKS": {"OPEN": bytes([12, 1, 255]), "CLOSED": bytes([12, 0, 255])},
+    "GASMETER_DOWNLINKS": {"OPEN": bytes([13, 1, 255]), "CLOSED": bytes([13, 0, 255])},
+    "THERMOSTAT_POWER_DOWNLINKS": {"on": bytes([0, 1, 1]), "off": bytes([0, 1, 0])},
+    "THERMOSTAT_FAN_DOWNLINKS": {fan: bytes([1, 1, code])
+                                 for code, fan in enumerate(["high", "medium", "low", "auto"])},
+    "THERMOSTAT_MODE_DOWNLINKS": {mode: bytes([2, 1, code])
+                                  for code, mode in enumerate(["off", "cool", "heat", "vent", "dehumidify", "auto"])},
+    "DOORLOCK_REMOTE_DOWNLINKS": {"unlock": bytes.fromhex("360101"), "lock": bytes.fromhex("360100")},
+}
+
+
+@pytest.mark.parametrize("table", sorted(BASELINE_COMMANDS))
+def test_downlink_tables_match_per_request_encoding(sim, table):
+    downlinks = getattr(sim, table)
+    assert downlinks.keys() == BASELINE_COMMANDS[table].keys()
+    for key, raw in BASELINE_COMMANDS[table].items():
+        data = base64.b64encode(raw).decode()
+        assert (downlinks[key].raw, downlinks[key].data) == (raw, data)
+        assert downlinks[key].payload == json.dumps({"confirmed": True, "fport": 85, "data": data}).encode()
+
+
+# ---------------------------------------------------------------------------
+# Uplink serializers
+# ---------------------------------------------------------------------------
+DEVICE_ID_KEYS = {"wallswitch": "switch_device_id", "wallsocket": "socket_device_id"}
+
+
+def uplink_states(sim):
+    """(device, device id, state) of every uplink the loaded apartments send."""
+    for apt, cfg in sim.APARTMENTS.items():
+        for device in sim.UPLINK_SERIALIZERS:
+            device_id = cfg[DEVICE_ID_KEYS.get(device, f"{device}_device_id")]
+            if device == "wallswitch":
+                for room in cfg["rooms"]:
+                    yield device, f"{device_id}_{room}", sim.latest_data[apt][device][room]
+            else:
+                yield device, device_id, sim.latest_data[apt][device]
+
+
+def baseline_payload(device, device_id, state):
+    """Uplink dict the original publish_* functions built."""
+    def fields(*names):
+        return {name: state[name] for name in names}
+
+    if device == "aqi":
+        return {"id": device_id, "gid": device_id, "temperature": state["temp"], "humidity": state["humd"],
+                "co2": state["co2"], "battery": state["battery"], "sensor_name": "AQI"}
+    if device in ("wallswitch", "wallsocket"):
+        status = ("switch_1", "switch_2") if device == "wallswitch" else ("socket_status",)
+        return {"id": device_id, "gid": device_id,
+                **fields("current", "voltage", "active_power", "power_consumption", "power_factor", *status),
+                "sensor_name": "Switch" if device == "wallswitch" else "Socket"}
+    if device == "curtain":
+        return {"id": device_id, "gid": device_id, **fields("battery", "curtainstate"),
+                "sensor_name": "CurtainController"}
+    if device == "peoplecounter":
+        return fields("total_in", "total_out", "period_in", "period_out", "battery", "temperature")
+    if device == "doorlock":
+        return {field: state.get(field) for field in (
+            "id", "t", "battery", "remote_lock", "unlock_record", "alarm", "auto_relock", "normally_open_mode",
+            "tamper", "reporting_time", "last_access_method", "last_access_user_id", "last_access_timestamp",
+            "last_manage_action", "last_manage_user_id")}
+    if device == "thermostat":
+        return {**fields("temperature", "humidity", "setpoint_temperature"),
+                "setpoint_timestamp": state.get("last_setpoint_timestamp", ""),
+                **fields("mode", "status", "fan_setting", "valve_status", "fan_status", "co2", "power")}
+    return dict(state)  # scb, watermeter, gasmeter
+
+
+@pytest.mark.parametrize("encoder", ["template", "json"])
+def test_uplink_payloads_match_baseline(sim, client, monkeypatch, encoder):
+    monkeypatch.setattr(sim, "UPLINK_ENCODER", encoder)
+    for device, device_id, state in uplink_states(sim):
+        expected = json.dumps(baseline_payload(device, device_id, state))
+        assert sim.serialize_uplink(device, device_id, state) == expected, device
+
+
+def test_uplink_template_encodes_any_value_like_json(sim, client):
+    values = [True, None, float("nan"), -float("inf"), "n/a", 2 ** 70, 0.1]
+    if sim.np is not None:
+        values += [sim.np.float64(21.5), sim.np.int64(7), sim.np.bool_(False)]
+    for device, field in [("aqi", "temp"), ("scb", "current"), ("doorlock", "battery")]:
+        state = dict(sim.latest_data["studio_apartment"][device])
+        for value in values:
+            plain = value.item() if sim.np is not None and isinstance(value, sim.np.generic) else value
+            expected = json.dumps(baseline_payload(device, "dev_01", dict(state, **{field: plain})))
+            state[field] = value
+            assert sim.serialize_uplink(device, "dev_01", state) == expected, (device, value)
+
+
+def test_orjson_uplinks_are_str(sim, client, monkeypatch):
+    pytest.importorskip("orjson")
+    monkeypatch.setattr(sim, "UPLINK_ENCODER", "orjson")
+    for device, device_id, state in uplink_states(sim):
+        payload = sim.serialize_uplink(device, device_id, state)
+        assert isinstance(payload, str)
+        assert json.loads(payload) == baseline_payload(device, device_id, state), device
+
+
+# ---------------------------------------------------------------------------
+# Shards
+# ---------------------------------------------------------------------------
+def test_partition_apartments(sim, building):
+    apartments = sim.generate_apartments({"units": sim.parse_units("40x1_bedroom")}, building)
+    parts = sim.partition_apartments(apartments, 3)
+    assert sorted(apt for part in parts for apt in part) == sorted(apartments)
+    for index, part in enumerate(parts):
+        assert all(sim.shard_of(apt, 3) == index for apt in part)
+    assert parts == sim.partition_apartments(apartments, 3)
+
+
+def test_shard_tick_worker_reports_empty_partition(sim, client, building):
+    results = queue.Queue()
+    sim._shard_tick_worker({}, 0.05, results)
+    sim._shard_tick_worker(dict(list(building.items())[:1]), 0.05, results)
+    sim.load_apartments(building)
+    assert results.get_nowait() == 0.0
+    assert results.get_nowait() > 0
+
+
+# ---------------------------------------------------------------------------
+# asyncio runtime
+# ---------------------------------------------------------------------------
+async def asgi_request(sim, method, path, query=""):
+    """One request through sim.asgi_app; returns (status, body bytes)."""
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode(), "headers": []}
+    await sim.asgi_app(scope, receive, send)
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def test_asgi_app_serves_flask_routes_and_long_polls(sim, client):
+    sim.latest_data["studio_apartment"]["wallsocket"]["socket_status"] = 0
+    version = client.get("/changes?timeout=0").get_json()["version"]
+
+    async def run():
+        poll = asyncio.ensure_future(
+            asgi_request(sim, "GET", "/changes", f"since={version}&timeout=5&apartment=studio_apartment"))
+        await asyncio.sleep(0.1)
+        assert not poll.done()
+        put = await asgi_request(sim, "PUT", "/studio_apartment/items/Update_Apartment_smart_Socket/state",
+                                 "socket_status=on")
+        get = await asgi_request(sim, "GET", "/studio_apartment/items/Studio_socket_status/state")
+        return put, get, await asyncio.wait_for(poll, 1)
+
+    (put_status, _), get, (poll_status, poll_body) = asyncio.run(run())
+    assert put_status == 202
+    assert get == (200, b"1")
+    assert poll_status == 200
+    changes = json.loads(poll_body)["changes"]
+    assert [(change["field"], change["value"]) for change in changes] == [("socket_status", 1)]
+
+
+class FlakyClient:
+    """Stands in for the loop-driven paho client; the publish after `drop_after` finds no connection."""
+
+    def __init__(self, connected, drop_after):
+        self.connected, self.drop_after, self.published = connected, drop_after, []
+
+    def publish(self, topic, payload, *args):
+        if len(self.published) == self.drop_after:
+            self.drop_after = None
+            asyncio.get_running_loop().call_later(0.05, self.connected.set)  # reconnect
+            return types.SimpleNamespace(rc=mqtt.MQTT_ERR_NO_CONN, mid=0)
+        self.published.append((topic, payload))
+        return types.SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=len(self.published))
+
+
+class AsyncOnlyQueue(queue.Queue):
+    """An mqtt_queue only the asyncio sender drains: a pool thread that was still busy when the
+    test swapped it in, and so reads it next, blocks on the pool's own queue instead."""
+
+    def __init__(self, pool_queue):
+        super().__init__()
+        self.pool_queue = pool_queue
+
+    def get(self, block=True, timeout=None):
+        if block:
+            return self.pool_queue.get(block, timeout)
+        return super().get(False)
+
+
+def test_async_sender_resumes_a_batch_after_reconnect(sim, client, monkeypatch):
+    monkeypatch.setattr(sim, "mqtt_queue", AsyncOnlyQueue(sim.mqtt_queue))
+    topic = "milesight/downlink/thermo_studio_01"
+    command_id = sim.new_command("studio_apartment", "thermostat", topic, 2)
+    downlinks = [(topic, "power", 0, False), (topic, "setpoint", 0, False)]
+    uplink = ("sim/aqi_studio_01/uplink", "{}", 0, False)
+
+    async def run():
+        monkeypatch.setattr(sim, "mqtt_wakeup", asyncio.Event())
+        connected = threading.Event()
+        connected.set()
+        flaky = FlakyClient(connected, drop_after=1)
+        window = sim.InflightWindow(10)
+        window.room = asyncio.Event()
+        sender = asyncio.ensure_future(sim.mqtt_async_sender(flaky, connected, window))
+        sim.mqtt_publish_batch(downlinks, {command_id: 2})
+        sim.mqtt_publish_batch([uplink])
+        while len(flaky.published) < 3:
+            await asyncio.sleep(0.01)
+        sender.cancel()
+        return flaky.published
+
+    published = asyncio.run(asyncio.wait_for(run(), 5))
+    assert published == [(topic, payload) for topic, payload, _, _ in downlinks + [uplink]]
+    command = client.get(f"/commands/{command_id}").get_json()
+    assert (command["status"], command["sent"]) == ("sent", 2)
+
+
+# ---------------------------------------------------------------------------
+# Production serving
+# ---------------------------------------------------------------------------
+def test_state_service_answers_forwarded_requests(sim, client, monkeypatch):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        service_port = probe.getsockname()[1]
+    monkeypatch.setattr(sim, "HTTP_SERVER_PORT", service_port - sim.STATE_SERVICE_PORT_OFFSET)
+    service = sim.start_state_service({"HTTP_SERVER_PORT": sim.HTTP_SERVER_PORT})
+    try:
+        # a plain subprocess: nothing for forked gunicorn workers to inherit and join
+        assert multiprocessing.active_children() == []
+        status, _, body = sim.call_wsgi(sim.state_service_app, EnvironBuilder(
+            path="/studio_apartment/items/Update_Apartment_smart_Socket/state",
+            method="PUT", query_string="socket_status=on").get_environ())
+        assert status == 202
+        assert json.loads(body)["new_state"]["socket_status"] == 1
+        status, _, body = sim.call_wsgi(sim.state_service_app, EnvironBuilder(
+            path="/studio_apartment/items/Studio_socket_status/state").get_environ())
+        assert (status, body) == (200, b"1")
+    finally:
+        sim._drop_service_connection()
+        service.terminate()
+        service.wait()
+
+
+# ---------------------------------------------------------------------------
+# Uplink batching and coalescing
+# ---------------------------------------------------------------------------
+def test_uplinks_are_batched_and_coalesced(sim, client, monkeypatch):
+    batches, armed = [], []
+    monkeypatch.setattr(sim, "mqtt_publish_batch", lambda messages, commands=None: batches.append(list(messages)))
+    monkeypatch.setattr(sim, "schedule", lambda delay, fn, *args, **kwargs: armed.append(fn))
+    apt = "1_bedroom"
+
+    # every room switch of a wallswitch tick goes out in one batch
+    monkeypatch.setattr(sim, "UPLINK_COALESCE_WINDOW", 0)
+    sim.tick_device("wallswitch", apt)
+    topics = [f"sim/{sim.APARTMENTS[apt]['switch_device_id']}_{room}/uplink" for room in sim.APARTMENTS[apt]["rooms"]]
+    assert [[message[0] for message in batch] for batch in batches] == [topics]
+
+    # within the window a newer payload replaces the pending one on its topic
+    batches.clear()
+    monkeypatch.setattr(sim, "UPLINK_COALESCE_WINDOW", 60)
+    coalesced = sim.uplinks_coalesced
+    sim.latest_data[apt]["curtain"]["curtainstate"] = 10
+    sim.publish_device("curtain", apt)
+    sim.latest_data[apt]["curtain"]["curtainstate"] = 20
+    sim.publish_device("curtain", apt)
+    assert armed == [sim.flush_uplinks] and batches == []
+    sim.flush_uplinks()
+    (message,), = batches
+    assert json.loads(message[1])["curtainstate"] == 20
+    assert sim.uplinks_coalesced == coalesced + 1
+
+
+# ---------------------------------------------------------------------------
+# QoS / retain and the in-flight window
+# ---------------------------------------------------------------------------
+def test_parse_device_values(sim):
+    qos = sim.parse_device_values("1,doorlock=2", sim.parse_qos)
+    assert qos == dict(dict.fromkeys(sim.DEVICE_QOS, 1), doorlock=2)
+    assert sim.parse_device_values("doorlock=on", sim.parse_flag) == {"doorlock": True}
+    for spec, convert in [("3", sim.parse_qos), ("lift=1", sim.parse_qos), ("doorlock=maybe", sim.parse_flag)]:
+        with pytest.raises(ValueError):
+            sim.parse_device_values(spec, convert)
+
+
+def test_qos1_uplinks_are_acknowledged(sim, client, monkeypatch):
+    monkeypatch.setitem(sim.DEVICE_QOS, "aqi", 1)
+    monkeypatch.setitem(sim.DEVICE_RETAIN, "aqi", True)
+    with sim.state_lock("studio_apartment"):
+        (topic, _, qos, retain), = sim.device_uplinks("aqi", "studio_apartment")
+    assert (topic, qos, retain) == ("sim/aqi_studio_01/uplink", 1, True)
+
+    def acked():
+        return client.get("/mqtt/stats").get_json()["1"]["acked"]
+
+    before = acked()
+    sim.publish_device("aqi", "studio_apartment")
+    assert wait_for(lambda: acked() == before + 1)
+    stats = client.get("/mqtt/stats").get_json()["1"]
+    assert stats["in_flight"] == 0
+    assert stats["ack_ms"]["p50"] is not None
+
+
+# ---------------------------------------------------------------------------
+# Simulation clock and seeds
+# ---------------------------------------------------------------------------
+@pytest.fixture
+def sim_settings(sim, monkeypatch):
+    """monkeypatch for SIM_* settings; sim_clock and the streams are rebuilt from the defaults afterwards."""
+    yield monkeypatch
+    monkeypatch.undo()
+    sim.configure_simulation()
+
+
+def test_command_times_are_simulated(sim, client, sim_settings):
+    # at 10x the 1 s follow-up uplink comes 100 ms after the PUT
+    sim_settings.setattr(sim, "SIM_SPEED", 10.0)
+    sim_settings.setattr(sim, "SIM_START", datetime(2030, 1, 1, tzinfo=timezone.utc))
+    sim.configure_simulation()
+    response = client.put("/studio_apartment/items/Update_Apartment_smart_Socket/state?socket_status=on")
+    location = response.headers["Location"]
+    assert wait_for(lambda: client.get(location).get_json()["reported_at"] is not None)
+    command = client.get(location).get_json()
+    created, sent, reported = (datetime.fromisoformat(command[key])
+                               for key in ("created_at", "sent_at", "reported_at"))
+    assert created.date() == datetime(2030, 1, 1).date()
+    assert created <= sent <= reported
+    # reported_at is the follow-up tick's scheduled time, armed right after the command was created
+    assert 0 <= (reported - created).total_seconds() - sim.UPLINK_AFTER_DOWNLINK < 0.5
+
+
+def test_seeded_readings_repeat(sim, client, building, sim_settings):
+    sim_settings.setattr(sim, "SIM_START", datetime(2030, 1, 1, tzinfo=timezone.utc))
+
+    def run(seed):
+        sim_settings.setattr(sim, "SIM_SEED", seed)
+        sim.configure_simulation()
+        sim.load_apartments(building)
+        for step in range(5):
+            with sim.sim_clock.ticking(step * 30.0):
+                for apt in building:
+                    for update in sim.DEVICE_UPDATERS.values():
+                        with sim.state_lock(apt):
+                            update(apt)
+        return client.get("/state").get_data()
+
+    first = run(42)
+    assert run(42) == first
+    assert run(43) != first
+
+
+# ---------------------------------------------------------------------------
+# Offline export
+# ---------------------------------------------------------------------------
+def test_export_jsonl(sim, client, building, sim_settings, tmp_path):
+    sim_settings.setattr(sim, "SIM_START", datetime(2030, 1, 1, tzinfo=timezone.utc))
+    sim.configure_simulation()
+    path = str(tmp_path / "uplinks.jsonl.gz")
+    count = sim.run_export(path, 60)
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        rows = [json.loads(line) for line in fh]
+    assert count == len(rows) > 0
+    assert all(row["ts"].startswith("2030-01-01T00:0") for row in rows)
+    assert {row["topic"].split("/")[0] for row in rows} == {"sim"}
+    assert all(isinstance(row["payload"], dict) for row in rows)
+
+
+def test_export_jsonl_escapes_topics(sim, tmp_path):
+    path = str(tmp_path / "uplinks.jsonl")
+    export = sim.JsonlExport(path)
+    export.write(0.0, "2030-01-01T00:00:00+00:00", [('sim/lab "b"\\1/uplink', '{"id": 1}', 0, False)])
+    export.close()
+    with open(path, encoding="utf-8") as fh:
+        row = json.loads(fh.read())
+    assert row == {"ts": "2030-01-01T00:00:00+00:00", "topic": 'sim/lab "b"\\1/uplink', "payload": {"id": 1}}
+
+
+# ---------------------------------------------------------------------------
+# Report on change and delta payloads
+# ---------------------------------------------------------------------------
+@pytest.mark.parametrize("encoder", ["json", "orjson"])
+def test_report_on_change_deltas(sim, client, monkeypatch, encoder):
+    if encoder == "orjson":
+        pytest.importorskip("orjson")
+    monkeypatch.setattr(sim, "UPLINK_ENCODER", encoder)
+    monkeypatch.setattr(sim, "REPORT_ON_CHANGE", True)
+    monkeypatch.setattr(sim, "REPORT_DELTAS", True)
+    apt = "studio_apartment"
+
+    def uplinks(device):
+        with sim.state_lock(apt):
+            messages = sim.device_uplinks(device, apt)
+        assert all(isinstance(payload, str) for _, payload, _, _ in messages)
+        return [json.loads(payload) for _, payload, _, _ in messages]
+
+    first = uplinks("wallsocket")
+    assert len(first) == 1 and "current" in first[0]  # first uplink is a full payload
+    assert uplinks("wallsocket") == []  # nothing changed
+
+    sim.latest_data[apt]["wallsocket"]["socket_status"] ^= 1
+    delta, = uplinks("wallsocket")
+    assert set(delta) == {"id", "gid", "socket_status", "sensor_name"}
+
+    # battery jitter alone does not make an idle curtain dirty
+    uplinks("curtain")
+    sim.latest_data[apt]["curtain"]["battery"] -= 1
+    assert uplinks("curtain") == []
+
+    # heartbeat: a full payload once REPORT_MAX_INTERVAL has passed
+    with sim.sim_clock.ticking(sim.sim_clock.time() + sim.REPORT_MAX_INTERVAL + 1):
+        heartbeat, = uplinks("curtain")
+    assert set(heartbeat) == {"id", "gid", "battery", "curtainstate", "sensor_name"}
+
+
+# ---------------------------------------------------------------------------
+# Load generator
+# ---------------------------------------------------------------------------
+def test_loadgen_endpoints(sim):
+    reads, writes = sim.loadgen_endpoints()
+    assert reads and writes
+    assert {method for method, _ in reads} == {"GET"} and {method for method, _ in writes} == {"PUT"}
+    assert all(template.startswith("/") and "{{base_url}}" not in template for _, template in reads + writes)
+
+
+def test_loadgen_drives_a_server(sim, client, capsys):
+    server = make_server("127.0.0.1", 0, sim.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        sim.run_loadgen(f"http://127.0.0.1:{server.server_port}", 1.0, 200, 0.1, 4)
+    finally:
+        server.shutdown()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith(f"http://127.0.0.1:{server.server_port}: {len(sim.APARTMENTS)} apartments")
+    total = next(line for line in lines if line.endswith("  total")).split()
+    assert float(total[0].replace(",", "")) > 100  # about 200 req/s offered
+    assert total[4] == "0.0%"  # no errors
+
+
+# ---------------------------------------------------------------------------
+# In-memory transport
+# ---------------------------------------------------------------------------
+def test_memory_client_qos_accounting(sim, monkeypatch):
+    monkeypatch.setattr(sim, "MQTT_TRANSPORT", "memory")
+    sim.memory_sink.reset()
+    client, connected, window = sim._new_mqtt_client(inflight=2)
+    assert isinstance(client, sim.MemoryClient)
+    client.connect_async(sim.MQTT_SERVER, sim.MQTT_PORT)
+    assert connected.is_set()
+    before = {qos: dict(stats) for qos, stats in sim.mqtt_stats().items() if qos in ("0", "1", "2")}
+    for qos in (0, 1, 2, 1, 1):
+        sim.publish_message(client, connected, window, ("sim/test_01/uplink", "{}", qos, False))
+    sim.publish_message(client, connected, window, ("milesight/downlink/test_01", "{}", 0, False))
+    after = sim.mqtt_stats()
+    for qos, sent in (("0", 2), ("1", 3), ("2", 1)):
+        assert after[qos]["published"] - before.get(qos, {}).get("published", 0) == sent
+        assert after[qos]["acked"] - before.get(qos, {}).get("acked", 0) == sent
+    assert window.waiting == 0 and not window.pending
+    sink = after["sink"]
+    assert (sink["uplink"]["messages"], sink["uplink"]["bytes"]) == (5, 10)
+    assert sink["downlink"]["messages"] == 1
+    assert sink["downlink"]["recent"][0]["topic"] == "milesight/downlink/test_01"
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+def metric_value(text, series):
+    """Value of `series` (name plus labels, as rendered) in a /metrics body, 0 if it is not there yet."""
+    return next((float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(series + " ")), 0.0)
+
+
+def test_metrics_endpoint(sim, client):
+    route = 'sim_http_request_seconds_count{method="GET",route="/<apartment>/items/<item_name>/state"}'
+    before = metric_value(client.get("/metrics").get_data(as_text=True), route)
+    assert client.get("/studio_apartment/items/Studio_socket_status/state").status_code == 200
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert metric_value(text, route) == before + 1
+    assert "# TYPE sim_tick_seconds histogram" in text
+    assert metric_value(text, "sim_apartments") == len(sim.APARTMENTS)
+    assert metric_value(text, "sim_scheduled_ticks") == len(sim.scheduler_heap)
+
+
+def test_metrics_on_the_asyncio_runtime(sim, client, monkeypatch):
+    # /changes is answered by a coroutine, not Flask, and is timed all the same
+    route = 'sim_http_request_seconds_count{method="GET",route="/changes"}'
+    before = metric_value(sim.render_metrics(), route)
+    status, _ = asyncio.run(asgi_request(sim, "GET", "/changes", "timeout=0"))
+    assert status == 200
+    assert metric_value(sim.render_metrics(), route) == before + 1
+
+    # the event loop is the scheduler: updater slots plus pending timed callbacks
+    monkeypatch.setattr(sim, "event_loop", object())
+    monkeypatch.setattr(sim, "updater_slots", {"aqi": 3, "curtain": 3})
+    monkeypatch.setattr(sim, "loop_callbacks", 2)
+    assert metric_value(sim.render_metrics(), "sim_scheduled_ticks") == 8
+
+
+# ---------------------------------------------------------------------------
+# Tick overrun policies (threads scheduler)
+# ---------------------------------------------------------------------------
+INTERVAL = 1000.0  # simulated seconds, so no slot after the backlog comes due during the test
+
+
+@pytest.mark.parametrize("policy, behind, overruns", [
+    ("compress", [0, 1, 2, 3, 4, 5], 5),  # every missed slot, back to back; the last one is on time
+    ("skip", [5], 1),  # only the latest due slot
+    ("spread", [0], 1),  # one slot now, the next one half an interval later
+])
+def test_overrun_policies(sim, client, monkeypatch, policy, behind, overruns):
+    monkeypatch.setattr(sim, "TICK_OVERRUN_POLICY", policy)
+    device = f"overrun_{policy}"
+    ran = []
+    deadline = sim.sim_clock.time() - 5.5 * INTERVAL
+    sim.schedule_at(deadline, lambda name: ran.append(sim.sim_clock.time()), device, interval=INTERVAL)
+    try:
+        assert wait_for(lambda: len(ran) >= len(behind))
+        time.sleep(0.1)
+        assert [round((at - deadline) / INTERVAL) for at in ran] == behind
+
+        with sim.scheduler_cond:
+            run_at, _, _, _, _, next_deadline = next(entry for entry in sim.scheduler_heap
+                                                     if entry[3] == (device,))
+        assert next_deadline == deadline + (behind[-1] + 1) * INTERVAL
+        if policy == "spread":
+            # the backlog is paced: the next slot is already due but runs half an interval from now
+            assert next_deadline < sim.sim_clock.time() < run_at
+        else:
+            assert run_at == next_deadline > sim.sim_clock.time()
+    finally:
+        with sim.scheduler_cond:
+            sim.scheduler_heap[:] = [entry for entry in sim.scheduler_heap if entry[3] != (device,)]
+            sim.heapq.heapify(sim.scheduler_heap)
+
+    metrics = sim.render_metrics()
+    assert f'sim_tick_overruns_total{{device="{device}"}} {overruns}' in metrics
+    if policy == "skip":
+        assert f'sim_ticks_skipped_total{{device="{device}"}} 5' in metrics